@@ -0,0 +1,417 @@
+#!/usr/bin/env python3
+
+r"""mock_homeserver.py.
+
+A minimal local stand-in for a Matrix homeserver, used to benchmark
+matrix-nio-send.py reproducibly without a real server.
+
+It implements just enough of the client-server API for matrix-nio-send.py:
+login, sync, keys upload/query/claim, to-device, room alias resolution,
+media upload and sending of room events. By default, all rooms are
+unencrypted. With --encrypted all rooms are encrypted and every room has
+--members other members with one device each, whose keys are created
+with vodozemac, so that the client has to share its Megolm sessions
+with them via Olm encrypted to-device messages. The server has a
+configurable latency per request and an optional rate limit on sent
+events (answered with 429 M_LIMIT_EXCEEDED like a real homeserver).
+With --capacity the server works on at most that many requests at the
+same time, further requests wait, so the latency grows with the number
+of parallel requests like on a loaded homeserver.
+With --lose-responses a fraction of the sent events is recorded, but
+never answered, like a response that got lost on the way back, to test
+retries of sends.
+
+Every sent event and every upload is recorded with its arrival time.
+The records can be fetched via GET /_mock/stats and cleared via
+POST /_mock/reset. Event sends are deduplicated by transaction id,
+like a real homeserver does.
+
+Usage:
+```
+$ benchmarks/mock_homeserver.py --port 8008 --latency 0.02 --rooms 100
+$ benchmarks/mock_homeserver.py --port 8008 --encrypted --members 20
+$ benchmarks/mock_homeserver.py --port 8008 --lose-responses 0.2
+$ benchmarks/mock_homeserver.py --port 8008 --latency 0.02 --capacity 8
+```
+
+"""
+
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+USER_ID = "@bench:mock.local"
+DEVICE_ID = "BENCHDEVICE"
+ACCESS_TOKEN = "mock_access_token"
+
+
+def room_id(i) -> str:
+    """Return the room id of the i-th mock room."""
+    return f"!room{i}:mock.local"
+
+
+def member_id(i) -> str:
+    """Return the user id of the i-th other member of the rooms."""
+    return f"@member{i}:mock.local"
+
+
+def canonical_json(value) -> bytes:
+    """Return the canonical JSON of value, as signed by Matrix devices."""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"),
+                      sort_keys=True).encode("utf-8")
+
+
+class MockDevice(object):
+    """Device of another member, with real Olm keys."""
+
+    def __init__(self, user_id, device_id):
+        """Create device with a new Olm account."""
+        import vodozemac  # only needed for --encrypted
+        self.user_id = user_id
+        self.device_id = device_id
+        self.account = vodozemac.Account()
+
+    def signed(self, value) -> dict:
+        """Return value with the signature of this device added."""
+        signature = self.account.sign(canonical_json(value)).to_base64()
+        return dict(value, signatures={
+            self.user_id: {f"ed25519:{self.device_id}": signature}})
+
+    def device_keys(self) -> dict:
+        """Return the signed device keys, as answered by /keys/query."""
+        return self.signed({
+            "user_id": self.user_id,
+            "device_id": self.device_id,
+            "algorithms": ["m.olm.v1.curve25519-aes-sha2",
+                           "m.megolm.v1.aes-sha2"],
+            "keys": {
+                f"curve25519:{self.device_id}":
+                    self.account.curve25519_key.to_base64(),
+                f"ed25519:{self.device_id}":
+                    self.account.ed25519_key.to_base64(),
+            },
+        })
+
+    def claim_one_time_key(self) -> dict:
+        """Return a new signed one-time key, as answered by /keys/claim."""
+        self.account.generate_one_time_keys(1)
+        key_id, key = next(iter(self.account.one_time_keys.items()))
+        self.account.mark_keys_as_published()
+        return {f"signed_curve25519:{key_id}":
+                self.signed({"key": key.to_base64()})}
+
+
+class MockHomeserver(object):
+    """State and request handlers of the mock homeserver."""
+
+    def __init__(self, rooms=100, latency=0.0, rate_limit=0.0,
+                 encrypted=False, members=0, lose_responses=0.0,
+                 capacity=0):
+        """Create mock homeserver.
+
+        Arguments:
+        ---------
+        rooms : int
+            number of rooms the user is joined to
+        latency : float
+            seconds every request is delayed before it is answered
+        rate_limit : float
+            max number of sent events per second, 0 means unlimited
+        encrypted : bool
+            whether the rooms are encrypted
+        members : int
+            number of other members of every room, with one device each
+        lose_responses : float
+            fraction of newly sent events that are recorded, but whose
+            response is never sent
+        capacity : int
+            max number of requests that are delayed by latency at the
+            same time, 0 means unlimited
+
+        """
+        self.rooms = rooms
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.encrypted = encrypted
+        self.lose_responses = lose_responses
+        self.capacity = asyncio.Semaphore(capacity) if capacity else None
+        self.devices = {member_id(i): MockDevice(member_id(i), f"MEMBER{i}")
+                        for i in range(members)}
+        self.routes = [
+            ("POST", r"/login$", self.login),
+            ("GET", r"/sync$", self.sync),
+            ("POST", r"/keys/upload$", self.keys_upload),
+            ("POST", r"/keys/query$", self.keys_query),
+            ("POST", r"/keys/claim$", self.keys_claim),
+            ("PUT", r"/sendToDevice/[^/]+/[^/]+$", self.send_to_device),
+            ("GET", r"/directory/room/(?P<alias>[^/]+)$", self.alias),
+            ("GET", r"/rooms/(?P<room>[^/]+)/joined_members$",
+             self.joined_members),
+            ("PUT", r"/rooms/(?P<room>[^/]+)/send/(?P<type>[^/]+)/"
+             r"(?P<txn>[^/]+)$", self.send),
+            ("POST", r"/upload$", self.upload),
+            ("POST", r"/logout$", self.empty),
+            ("GET", r"/_mock/stats$", self.stats),
+            ("POST", r"/_mock/reset$", self.reset),
+        ]
+        self.reset_state()
+
+    def reset_state(self) -> None:
+        """Clear all recorded events, uploads and requests."""
+        # [arrival time, room id, txn id, body size, event type]
+        self.events = []
+        self.txns = {}  # (room id, txn id) -> event id
+        self.uploads = []  # [start time, end time, bytes]
+        self.to_device = 0  # number of to-device messages received
+        self.first_request = None
+        self.requests = 0
+        self.rate_limited = 0
+        self.lost_responses = 0
+        self.window_start = time.time()
+        self.window_count = 0
+
+    def app(self) -> web.Application:
+        """Return the aiohttp application."""
+        app = web.Application(client_max_size=1024 ** 4)
+        app.router.add_route("*", "/{tail:.*}", self.dispatch)
+        return app
+
+    async def dispatch(self, request):
+        """Route a request to its handler."""
+        now = time.time()
+        path = request.path
+        if not path.startswith("/_mock/"):
+            self.requests += 1
+            if self.first_request is None:
+                self.first_request = now
+        for method, pattern, handler in self.routes:
+            if request.method != method:
+                continue
+            m = re.search(pattern, path)
+            if m:
+                if self.latency and not path.startswith("/_mock/"):
+                    if self.capacity:
+                        async with self.capacity:
+                            await asyncio.sleep(self.latency)
+                    else:
+                        await asyncio.sleep(self.latency)
+                return await handler(request, **m.groupdict())
+        return web.json_response(
+            {"errcode": "M_UNRECOGNIZED", "error": f"{method} {path}"},
+            status=404)
+
+    async def login(self, request):
+        """Handle POST /login."""
+        return web.json_response({"user_id": USER_ID,
+                                  "device_id": DEVICE_ID,
+                                  "access_token": ACCESS_TOKEN})
+
+    async def sync(self, request):
+        """Handle GET /sync, all rooms are returned on initial syncs.
+
+        Of filters only {"room": {"rooms": []}} is understood, which
+        excludes all rooms.
+
+        """
+        since = request.query.get("since")
+        full_state = request.query.get("full_state") == "true"
+        if (since and not full_state and
+                request.query.get("timeout", "0") != "0"):
+            # nothing new happens on this server, simulate long polling,
+            # like Synapse a full_state sync is answered right away
+            await asyncio.sleep(min(
+                int(request.query["timeout"]) / 1000, 1.0))
+        join = {}
+        sync_filter = json.loads(request.query.get("filter") or "{}")
+        if (sync_filter.get("room", {}).get("rooms") != [] and
+                (not since or full_state)):
+            for i in range(self.rooms):
+                events = [
+                    {"type": "m.room.create", "state_key": "",
+                     "sender": USER_ID, "event_id": f"$create{i}",
+                     "origin_server_ts": 0,
+                     "content": {"creator": USER_ID}},
+                ]
+                for user_id in [USER_ID] + list(self.devices):
+                    events.append(
+                        {"type": "m.room.member", "state_key": user_id,
+                         "sender": user_id,
+                         "event_id": f"$member{i}{user_id}",
+                         "origin_server_ts": 0,
+                         "content": {"membership": "join"}})
+                if self.encrypted:
+                    events.append(
+                        {"type": "m.room.encryption", "state_key": "",
+                         "sender": USER_ID, "event_id": f"$encryption{i}",
+                         "origin_server_ts": 0,
+                         "content": {"algorithm": "m.megolm.v1.aes-sha2"}})
+                join[room_id(i)] = {
+                    "state": {"events": events},
+                    "timeline": {"events": [], "limited": False},
+                    "ephemeral": {"events": []},
+                    "account_data": {"events": []},
+                    "summary": {"m.joined_member_count": len(events) - 1 -
+                                int(self.encrypted)},
+                }
+        return web.json_response({
+            "next_batch": f"s{time.time_ns()}",
+            "rooms": {"join": join, "invite": {}, "leave": {}},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {"signed_curve25519": 50},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+        })
+
+    async def keys_upload(self, request):
+        """Handle POST /keys/upload."""
+        await request.read()
+        return web.json_response(
+            {"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def keys_query(self, request):
+        """Handle POST /keys/query, answers the keys of the other members."""
+        body = await request.json()
+        device_keys = {}
+        for user_id in body.get("device_keys", {}):
+            device = self.devices.get(user_id)
+            if device:
+                device_keys[user_id] = {
+                    device.device_id: device.device_keys()}
+        return web.json_response({"device_keys": device_keys, "failures": {}})
+
+    async def keys_claim(self, request):
+        """Handle POST /keys/claim, creates one-time keys on the fly."""
+        body = await request.json()
+        one_time_keys = {}
+        for user_id, devices in body.get("one_time_keys", {}).items():
+            device = self.devices.get(user_id)
+            if device and device.device_id in devices:
+                one_time_keys[user_id] = {
+                    device.device_id: device.claim_one_time_key()}
+        return web.json_response({"one_time_keys": one_time_keys,
+                                  "failures": {}})
+
+    async def send_to_device(self, request):
+        """Handle PUT /sendToDevice/{type}/{txn}, messages are counted."""
+        body = await request.json()
+        for devices in body.get("messages", {}).values():
+            self.to_device += len(devices)
+        return web.json_response({})
+
+    async def empty(self, request):
+        """Handle requests that just need an empty JSON object."""
+        return web.json_response({})
+
+    async def alias(self, request, alias):
+        """Handle GET /directory/room/{alias}, #roomN:... -> !roomN:..."""
+        m = re.match(r"#room(\d+):", alias)
+        if not m:
+            return web.json_response(
+                {"errcode": "M_NOT_FOUND", "error": "Room alias not found."},
+                status=404)
+        return web.json_response({"room_id": room_id(int(m.group(1))),
+                                  "servers": ["mock.local"]})
+
+    async def joined_members(self, request, room):
+        """Handle GET /rooms/{room}/joined_members."""
+        return web.json_response(
+            {"joined": {user_id: {} for user_id in
+                        [USER_ID] + list(self.devices)}})
+
+    async def send(self, request, room, type, txn):
+        """Handle PUT /rooms/{room}/send/{type}/{txn}."""
+        body = await request.read()
+        now = time.time()
+        if (room, txn) in self.txns:  # retry of an already sent event
+            return web.json_response({"event_id": self.txns[(room, txn)]})
+        if self.rate_limit:
+            if now - self.window_start >= 1.0:
+                self.window_start = now
+                self.window_count = 0
+            if self.window_count >= self.rate_limit:
+                self.rate_limited += 1
+                retry_after = int((1.0 - (now - self.window_start)) * 1000)
+                return web.json_response(
+                    {"errcode": "M_LIMIT_EXCEEDED",
+                     "error": "Too Many Requests",
+                     "retry_after_ms": max(retry_after, 1)}, status=429)
+            self.window_count += 1
+        event_id = f"${uuid.uuid4().hex}"
+        self.txns[(room, txn)] = event_id
+        self.events.append([now, room, txn, len(body), type])
+        if random.random() < self.lose_responses:
+            self.lost_responses += 1
+            await asyncio.sleep(3600)  # until the client gives up
+        return web.json_response({"event_id": event_id})
+
+    async def upload(self, request):
+        """Handle POST /upload, the body is read and discarded."""
+        start = time.time()
+        size = 0
+        async for chunk in request.content.iter_any():
+            size += len(chunk)
+        self.uploads.append([start, time.time(), size])
+        return web.json_response(
+            {"content_uri": f"mxc://mock.local/{uuid.uuid4().hex}"})
+
+    async def stats(self, request):
+        """Handle GET /_mock/stats."""
+        return web.json_response({
+            "first_request": self.first_request,
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "lost_responses": self.lost_responses,
+            "events": self.events,
+            "uploads": self.uploads,
+            "to_device": self.to_device,
+        })
+
+    async def reset(self, request):
+        """Handle POST /_mock/reset."""
+        self.reset_state()
+        return web.json_response({})
+
+
+def main() -> None:
+    """Run the mock homeserver until Control-C is hit."""
+    ap = argparse.ArgumentParser(
+        description="Minimal mock Matrix homeserver for benchmarking.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8008)
+    ap.add_argument("--rooms", type=int, default=100,
+                    help="Number of rooms the user is joined to.")
+    ap.add_argument("--latency", type=float, default=0.0,
+                    help="Seconds every request is delayed.")
+    ap.add_argument("--rate-limit", type=float, default=0.0,
+                    help="Max sent events per second, 0 is unlimited.")
+    ap.add_argument("--encrypted", action="store_true",
+                    help="Make all rooms encrypted.")
+    ap.add_argument("--members", type=int, default=0,
+                    help="Number of other members, with one device each, "
+                    "in every room.")
+    ap.add_argument("--lose-responses", type=float, default=0.0,
+                    help="Fraction of sent events that are recorded, but "
+                    "never answered.")
+    ap.add_argument("--capacity", type=int, default=0,
+                    help="Max number of requests worked on at the same "
+                    "time, 0 is unlimited.")
+    pargs = ap.parse_args()
+    server = MockHomeserver(pargs.rooms, pargs.latency, pargs.rate_limit,
+                            pargs.encrypted, pargs.members,
+                            pargs.lose_responses, pargs.capacity)
+    web.run_app(server.app(), host=pargs.host, port=pargs.port,
+                access_log=None)
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
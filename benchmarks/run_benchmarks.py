@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+r"""run_benchmarks.py.
+
+Reproducible benchmarks for matrix-nio-send.py against a local
+mock homeserver (see mock_homeserver.py).
+
+Measured are:
+- startup time: from process start until the first request
+  reaches the server (imports, reading credentials, opening the store)
+- end-to-end latency: from process start until the message event
+  reaches the server, and total process run time
+- throughput: sent events per second when sending to 1, 10 and 100 rooms
+- upload: MB/s of an upload of a local file
+- batch: run time of jobs read with --batch that update status
+  messages, the first run sends them, the following runs edit them
+
+Results are written as JSON, so that runs of different versions can be
+compared with --compare.
+
+Usage:
+```
+$ benchmarks/run_benchmarks.py --output before.json
+$ # ... change matrix-nio-send.py ...
+$ benchmarks/run_benchmarks.py --output after.json
+$ benchmarks/run_benchmarks.py --compare before.json after.json
+```
+
+"""
+
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from mock_homeserver import (  # noqa: E402
+    ACCESS_TOKEN, DEVICE_ID, USER_ID, MockHomeserver, room_id)
+
+PROGRAM = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "matrix-nio-send.py"))
+ROOM_COUNTS = (1, 10, 100)
+
+
+class Bench(object):
+    """Run matrix-nio-send.py against a mock homeserver and measure it."""
+
+    def __init__(self, pargs):
+        """Start mock homeserver in a background thread, create work dir."""
+        self.pargs = pargs
+        self.workdir = tempfile.mkdtemp(prefix="matrix-nio-send-bench-")
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.port = s.getsockname()[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        self.server = MockHomeserver(max(ROOM_COUNTS), pargs.latency,
+                                     pargs.rate_limit)
+        started = threading.Event()
+        self.thread = threading.Thread(target=self.serve, args=(started,),
+                                       daemon=True)
+        self.thread.start()
+        started.wait()
+        self.credentials = os.path.join(self.workdir, "credentials.json")
+        with open(self.credentials, "w") as f:
+            json.dump({"homeserver": self.url, "device_id": DEVICE_ID,
+                       "user_id": USER_ID, "room_id": room_id(0),
+                       "access_token": ACCESS_TOKEN}, f)
+        self.store = os.path.join(self.workdir, "store")
+        os.makedirs(self.store)
+        # first run creates the store and uploads keys, don't measure it
+        self.run("-m", "warm-up")
+
+    def serve(self, started) -> None:
+        """Run the mock homeserver, in background thread."""
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        runner = web.AppRunner(self.server.app(), access_log=None)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, "127.0.0.1", self.port)
+        loop.run_until_complete(site.start())
+        started.set()
+        loop.run_forever()
+
+    def stats(self) -> dict:
+        """Fetch and reset the records of the mock homeserver."""
+        with urllib.request.urlopen(self.url + "/_mock/stats") as r:
+            stats = json.load(r)
+        req = urllib.request.Request(self.url + "/_mock/reset", data=b"",
+                                     method="POST")
+        urllib.request.urlopen(req).close()
+        return stats
+
+    def run(self, *args, stdin=None) -> (float, float, dict):
+        """Run matrix-nio-send.py once.
+
+        stdin are the bytes piped into the program, None for none.
+
+        Returns time of process start, process run time in seconds
+        and the records of the mock homeserver.
+
+        """
+        self.stats()  # reset
+        cmd = [sys.executable, PROGRAM, "-t", self.credentials,
+               "-s", self.store] + list(args)
+        start = time.time()
+        if stdin is None:
+            proc = subprocess.run(cmd, stdin=subprocess.DEVNULL,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+        else:
+            proc = subprocess.run(cmd, input=stdin,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT)
+        duration = time.time() - start
+        if proc.returncode != 0:
+            sys.exit(f"Command {cmd} failed:\n{proc.stdout.decode()}")
+        return start, duration, self.stats()
+
+    def bench_latency(self) -> dict:
+        """Measure startup time and end-to-end latency of one message."""
+        startup, latency, runtime = [], [], []
+        for i in range(self.pargs.repeat):
+            start, duration, stats = self.run("-m", f"latency {i}")
+            if not stats["events"]:
+                sys.exit("No event reached the mock homeserver.")
+            startup.append(stats["first_request"] - start)
+            latency.append(stats["events"][0][0] - start)
+            runtime.append(duration)
+        return {"startup_s": summarize(startup),
+                "latency_s": summarize(latency),
+                "runtime_s": summarize(runtime)}
+
+    def bench_throughput(self, rooms) -> dict:
+        """Measure sent events per second when sending to many rooms."""
+        messages = [f"throughput {i}" for i in range(self.pargs.messages)]
+        room_args = [room_id(i) for i in range(rooms)]
+        rates, runtime = [], []
+        for _ in range(self.pargs.repeat):
+            start, duration, stats = self.run(
+                "-m", *messages, "-r", *room_args)
+            times = [e[0] for e in stats["events"]]
+            if len(times) != rooms * len(messages):
+                sys.exit(f"Expected {rooms * len(messages)} events, "
+                         f"got {len(times)}.")
+            span = max(times) - min(times)
+            rates.append((len(times) - 1) / span if span > 0 else 0.0)
+            runtime.append(duration)
+        return {"events_per_s": summarize(rates),
+                "runtime_s": summarize(runtime),
+                "events": rooms * len(messages)}
+
+    def bench_upload(self) -> dict:
+        """Measure upload speed of a local file."""
+        path = os.path.join(self.workdir, "upload.bin")
+        with open(path, "wb") as f:
+            for _ in range(self.pargs.upload_mb):
+                f.write(os.urandom(1024 * 1024))
+        rates, runtime = [], []
+        for _ in range(self.pargs.repeat):
+            start, duration, stats = self.run("-f", path, "-m", "")
+            if not stats["uploads"]:
+                sys.exit("No upload reached the mock homeserver.")
+            ustart, uend, size = stats["uploads"][0]
+            rates.append(size / (1024 * 1024) / max(uend - ustart, 1e-9))
+            runtime.append(duration)
+        return {"mb_per_s": summarize(rates),
+                "runtime_s": summarize(runtime),
+                "size_mb": self.pargs.upload_mb}
+
+    def bench_batch(self) -> dict:
+        """Measure sending --batch jobs that update status messages."""
+        lines = "".join(
+            json.dumps({"message": f"batch {i}", "status_key": f"batch-{i}"})
+            + "\n" for i in range(self.pargs.messages)).encode()
+        runtime = []
+        for _ in range(self.pargs.repeat):
+            start, duration, stats = self.run("--batch", stdin=lines)
+            if len(stats["events"]) != self.pargs.messages:
+                sys.exit(f"Expected {self.pargs.messages} events, "
+                         f"got {len(stats['events'])}.")
+            runtime.append(duration)
+        return {"runtime_s": summarize(runtime),
+                "jobs": self.pargs.messages}
+
+    def close(self) -> None:
+        """Remove work dir."""
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+def summarize(values) -> dict:
+    """Return median, min, max and mean of a list of numbers."""
+    return {"median": statistics.median(values), "min": min(values),
+            "max": max(values), "mean": statistics.mean(values),
+            "n": len(values)}
+
+
+def git_revision() -> str:
+    """Return the git revision of the program, or None."""
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(PROGRAM), capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def flatten(results, prefix="") -> dict:
+    """Flatten results to {"a.b.median": value} for comparison."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if "median" in value:
+                flat[prefix + key] = value["median"]
+            else:
+                flat.update(flatten(value, prefix + key + "."))
+    return flat
+
+
+def compare(old_file, new_file) -> None:
+    """Print a table comparing the medians of two result files."""
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+    old_flat = flatten(old["results"])
+    new_flat = flatten(new["results"])
+    print(f"{'metric':<40} {old.get('revision') or 'old':>12} "
+          f"{new.get('revision') or 'new':>12} {'change':>8}")
+    for key in sorted(set(old_flat) | set(new_flat)):
+        a, b = old_flat.get(key), new_flat.get(key)
+        if a is None or b is None:
+            print(f"{key:<40} {a!s:>12} {b!s:>12}")
+            continue
+        change = f"{(b - a) / a * 100:+.1f}%" if a else ""
+        print(f"{key:<40} {a:>12.4f} {b:>12.4f} {change:>8}")
+
+
+def main() -> None:
+    """Run the benchmarks, or compare two result files."""
+    ap = argparse.ArgumentParser(
+        description="Benchmark matrix-nio-send.py against a local mock "
+        "homeserver.")
+    ap.add_argument("--latency", type=float, default=0.0,
+                    help="Seconds the mock homeserver delays every request.")
+    ap.add_argument("--rate-limit", type=float, default=0.0,
+                    help="Max events per second the mock homeserver "
+                    "accepts before answering with 429, 0 is unlimited.")
+    ap.add_argument("--repeat", type=int, default=5,
+                    help="Number of runs per measurement.")
+    ap.add_argument("--messages", type=int, default=10,
+                    help="Number of messages per room in the throughput "
+                    "benchmark.")
+    ap.add_argument("--upload-mb", type=int, default=16,
+                    help="Size of the uploaded file in MB.")
+    ap.add_argument("--output", type=str, default=None,
+                    help="Write results as JSON to this file. By default, "
+                    "they are printed.")
+    ap.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                    help="Compare two result files instead of running.")
+    pargs = ap.parse_args()
+    if pargs.compare:
+        compare(*pargs.compare)
+        return
+
+    bench = Bench(pargs)
+    try:
+        results = {"latency": bench.bench_latency(),
+                   "throughput": {f"rooms_{n}": bench.bench_throughput(n)
+                                  for n in ROOM_COUNTS},
+                   "upload": bench.bench_upload(),
+                   "batch": bench.bench_batch()}
+    finally:
+        bench.close()
+    output = {
+        "revision": git_revision(),
+        "timestamp": time.time(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": {"latency": pargs.latency, "rate_limit": pargs.rate_limit,
+                   "repeat": pargs.repeat, "messages": pargs.messages,
+                   "upload_mb": pargs.upload_mb},
+        "results": results,
+    }
+    if pargs.output:
+        with open(pargs.output, "w") as f:
+            json.dump(output, f, indent=2)
+    else:
+        print(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
+
+# EOF
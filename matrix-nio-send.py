@@ -77,6 +77,14 @@ a credentials file it will first look in local directory and then
 as secondary choice it will look in directory
 $HOME/.config/matrix-nio-send/.
 
+If $XDG_RUNTIME_DIR is set, the paths of the found credentials file
+and store directory are cached in $XDG_RUNTIME_DIR/matrix-nio-send/,
+readable only by the user. As long as the credentials file can be
+read, further runs do not have to search for it, e.g. on slow network
+home directories. A credentials file or store created later in a
+location that is searched first, e.g. a local credentials.json, is
+only used after the cache is cleared at logout, or removed.
+
 If you want to re-use an existing device id and an existing
 access token, you can do so as well, just manually edit the
 credentials file. However, for end-to-end encryption this will
@@ -89,6 +97,9 @@ The default location for the store directory is a local directory named
 `store`. Alternatively, as a secondary choice the program looks for a store
 directory in $HOME/.local/shared/matrix-nio-send/store/. The user can always
 specify a different location via the --store argument.
+Several instances of the program, e.g. cron jobs, can use the same
+store at the same time. They only wait for each other while one of them
+changes the encryption state, not while uploading or sending.
 
 The program can accept verification request and verify other devices
 via emojis. Do do so use the --verify option and the program will
@@ -110,6 +121,11 @@ cannot be turned off.
   pip3 install --user --upgrade markdown
 - python3 package python_magic must be installed to support image sending
   pip3 install --user --upgrade python_magic
+- optionally, python3 package pyyaml to read YAML config files
+  pip3 install --user --upgrade pyyaml
+- optionally, python3 package tomli to read TOML config files on
+  Python versions older than 3.11
+  pip3 install --user --upgrade tomli
 - this file must be installed, and should have execution permissions
   chmod 755 matrix-nio-send.py
 
@@ -142,6 +158,8 @@ $ matrix-nio-send.py --credentials usr1room2 # select credentials file
 $ matrix-nio-send.py -m "hi" --room '!YourRoomId:example.org'
 $ # some shells require the ! of the room id to be escaped with \
 $ matrix-nio-send.py -m "hi" --room r"\!YourRoomId:example.org"
+$ # rooms can also be given by their alias
+$ matrix-nio-send.py -m "hi" --room '#YourRoomAlias:example.org'
 $ # send 2 images and 1 text
 $ matrix-nio-send.py -i photo1.jpg photo2.img -m "Do you like my 2 photos?"
 $ # send 1 image and no text
@@ -151,15 +169,87 @@ $ matrix-nio-send.py -a song.mp3 -m "Do you like this song?" \
     -r "!someroom1:example.com" "!someroom2:example.com"
 $ # send a .pdf file and a video with a text
 $ matrix-nio-send.py -f example.pdf video.mp4 -m "Here are the promised files"
+$ # send directory logs/ and all .conf files below /etc/app as archives
+$ matrix-nio-send.py -f logs/ '/etc/app/**/*.conf' -m "Logs and config"
+$ # update one status message instead of sending a new one every time
+$ matrix-nio-send.py --status-key backup -m "Backup 40% done"
+$ # render one markdown message per line of JSON with template alert.md
+$ alerts.sh | matrix-nio-send.py -z --template alert.md --split "\n"
+$ # send with the settings of profile "alerts" from a config file
+$ df -h | matrix-nio-send.py --config config.yaml --profile alerts
+$ # send the same alert at most once every 10 minutes
+$ echo "disk full" | matrix-nio-send.py --dedup 600 --dedup-mode collapse
+$ # send every file that gets dropped into directory spool/
+$ matrix-nio-send.py --watch spool/
+$ # receive webhooks and serve Prometheus metrics
+$ matrix-nio-send.py --webhook 8008 --metrics 9100
+$ # show where the time goes
+$ matrix-nio-send.py -m "hi" --timings --timings-json timings.json
+$ matrix-nio-send.py -m "hi" --profiler cprofile --profiler-output send.pstats
+$ # receive messages via HTTP, e.g. from Alertmanager, and send them
+$ matrix-nio-send.py --webhook 8008 &
+$ curl -d '{"message": "disk full", "notice": true}' http://127.0.0.1:8008/
+$ # send a reminder in 2 hours, and one tomorrow morning
+$ matrix-nio-send.py --scheduler & # resident, sends jobs when due
+$ matrix-nio-send.py -m "Stretch your legs" --in 2h
+$ matrix-nio-send.py -m "Standup meeting" --at "2026-12-24 09:00"
+$ # send a batch of jobs, the high priority page is sent first
+$ printf '%s\n' '{"message": "digest", "room": "#digest:example.org"}' \
+    '{"message": "disk full", "priority": "high"}' | matrix-nio-send.py --batch
+$ # broadcast to many rooms with 4 processes, each with its own device
+$ matrix-nio-send.py -t shard1.json -s store/shard1 # once per device
+$ matrix-nio-send.py -m "Maintenance tonight" -r $(cat rooms.txt) \
+    --shard-credentials shard1.json shard2.json shard3.json shard4.json
+$ # retry quickly, a cron job that runs again does not send twice
+$ df -h | matrix-nio-send.py --code --job-id "df-$(date +%F)" \
+    --send-timeout 5 --send-retries 5
+```
+
+# Config file
+
+A config file defines named profiles. A profile bundles rooms, format,
+notice flag, split string and attachments, so that a whole send job
+can be selected with a single `--profile` argument. Example `config.yaml`:
+
+```
+default_profile: alerts
+profiles:
+  alerts:
+    room: ["#alerts:example.org", "!SomeRoomId:example.org"]
+    format: markdown   # text, html, markdown or code
+    notice: true
+    split: "\n\n\n"
+  reports:
+    room: "#reports:example.org"
+    format: code
+    file: ["/var/log/report.pdf"]
 ```
 
 # Usage
 ```
-usage: matrix-nio-send.py [-h] [-d] [-t CREDENTIALS] [-r ROOM [ROOM ...]]
+usage: matrix-nio-send.py [-h] [-d] [--log-format {text,json}]
+                          [-t CREDENTIALS] [-r ROOM [ROOM ...]]
                           [-m MESSAGE [MESSAGE ...]] [-i IMAGE [IMAGE ...]]
-                          [-a AUDIO [AUDIO ...]] [-f FILE [FILE ...]] [-w]
-                          [-z] [-c] [-p SPLIT] [-k CONFIG] [-n] [-e]
-                          [-s STORE] [-v VERIFY]
+                          [-a AUDIO [AUDIO ...]] [-f FILE [FILE ...]]
+                          [--archive-format {tar.gz,tar}]
+                          [--archive-temp-file] [-w] [-z] [-c]
+                          [--language LANGUAGE] [-p SPLIT] [--template NAME]
+                          [--attach-threshold BYTES] [-k CONFIG]
+                          [--profile PROFILE] [-n] [--status-key KEY] [-e]
+                          [-s STORE] [--priority {high,bulk}] [--batch]
+                          [--at TIME] [--in DURATION] [--scheduler]
+                          [--dedup SECONDS] [--dedup-mode {drop,collapse}]
+                          [--watch DIR] [--webhook [HOST:]PORT]
+                          [--webhook-queue-size WEBHOOK_QUEUE_SIZE]
+                          [--webhook-token WEBHOOK_TOKEN]
+                          [--shard-credentials FILE [FILE ...]]
+                          [--crypto-executor {none,thread}] [--job-id ID]
+                          [--send-retries N] [--send-timeout SECONDS]
+                          [--concurrency LIMIT] [--timings]
+                          [--timings-json FILE]
+                          [--profiler {cprofile,pyinstrument}]
+                          [--profiler-output FILE] [--metrics [HOST:]PORT]
+                          [--metrics-textfile FILE] [-v VERIFY]
 
 On first run this program will configure itself. On further runs this
 program implements a simple Matrix sender. It sends one or multiple text
@@ -174,7 +264,14 @@ option or read the full documentation in the source code.
 
 optional arguments:
   -h, --help            show this help message and exit
-  -d, --debug           Print debug information
+  -d, --debug           Print debug information. Messages are truncated to
+                        200 characters in the debug output.
+  --log-format {text,json}
+                        Format of log output on stderr. "text" is human
+                        readable. "json" writes one JSON object per line
+                        with the keys "ts", "level", "logger" and "msg",
+                        which is easy to process by log collectors. Default
+                        is "text".
   -t CREDENTIALS, --credentials CREDENTIALS
                         On first run, information about homeserver, user,
                         room id, etc. will be written to a credentials file.
@@ -192,8 +289,13 @@ optional arguments:
                         (or they) will be used instead of the one from the
                         credentials file. The user must have access to the
                         specified room in order to send messages there.
-                        Messages cannot be sent to arbitrary rooms. When
-                        specifying the room id some shells require the
+                        Messages cannot be sent to arbitrary rooms. Rooms
+                        can be specified by room id (e.g.
+                        "!SomeRoomId:example.org") or by room alias (e.g.
+                        "#someroomalias:example.org"). Resolved room aliases
+                        are cached in the store directory for a day, so that
+                        repeated runs do not have to ask the server again.
+                        When specifying the room id some shells require the
                         exclamation mark to be escaped with a blackslash.
   -m MESSAGE [MESSAGE ...], --message MESSAGE [MESSAGE ...]
                         Send this message. If not specified, and no input
@@ -214,7 +316,27 @@ optional arguments:
   -f FILE [FILE ...], --file FILE [FILE ...]
                         Send this file (e.g. PDF, DOC, MP4). This option can
                         be used multiple time to send multiple files. First
-                        files are send, then text messages are send.
+                        files are send, then text messages are send. A
+                        directory, or a glob pattern like 'logs/**/*.log'
+                        (quoted, so the shell does not expand it), is sent
+                        as one archive, see --archive-format. If a file
+                        changes while it is archived, the archive is not
+                        sent.
+  --archive-format {tar.gz,tar}
+                        Format of the archive that a directory or glob
+                        pattern given with --file is sent as. "tar.gz" is
+                        compressed. Since the size of an upload must be
+                        known before it starts, the files are read twice for
+                        "tar.gz", once to compute the size of the compressed
+                        archive, see --archive-temp-file. "tar" is not
+                        compressed and reads the files once. Neither needs a
+                        temporary file. Default is "tar.gz".
+  --archive-temp-file   Compress a "tar.gz" archive, see --archive-format,
+                        into a temporary file before it is uploaded, instead
+                        of compressing it twice. The files are then read
+                        once, but the whole compressed archive is written to
+                        disk, into $TMPDIR. Without this option no temporary
+                        file is used.
   -w, --html            Send message as format "HTML". If not specified,
                         message will be sent as format "TEXT". E.g. that
                         allows some text to be bold, etc. Only a subset of
@@ -229,6 +351,15 @@ optional arguments:
                         priority. This is useful for sending ASCII-art or
                         tabbed output like tables as a fixed-sized font will
                         be used for display.
+  --language LANGUAGE   Language of the code sent with --code, e.g.
+                        "python", "json" or "bash". The code is marked with
+                        the class "language-LANGUAGE" so that clients can
+                        highlight it. If the Python package pygments is
+                        installed, the code is also highlighted by this
+                        program, with colors that all clients show. Code
+                        larger than 48 KiB is not highlighted, so that it
+                        fits into one event. By default, the language of the
+                        code is not given.
   -p SPLIT, --split SPLIT
                         If set, split the message(s) into multiple messages
                         wherever the string specified with --split occurs.
@@ -237,13 +368,66 @@ optional arguments:
                         newlines. Then with --split set to "\n\n\n" each
                         article will be printed in a separate message. By
                         default, i.e. if not set, no messages will be split.
+  --template NAME       Render the messages from this template. Each
+                        message, e.g. from --message or the pipe, is then a
+                        JSON object with the values of the variables of the
+                        template, e.g. {"host": "db1", "load": 3.5}. Use
+                        --split "\n" to send one message per line of JSON.
+                        The template uses the syntax of Python's
+                        str.format(), e.g. "**{host}** has load {load:.1f}".
+                        NAME is the path of the template file or the name of
+                        a file in the template directory "~/.config/matrix-
+                        nio-send/templates". With --batch and --webhook the
+                        jobs can give "template", the name of a file in the
+                        template directory, and "vars" instead of a message.
+                        Templates are compiled once, markdown templates are
+                        converted to HTML once, and kept in compiled form in
+                        "~/.cache/matrix-nio-send" until the template file
+                        changes. Values of variables are inserted as text,
+                        i.e. markdown or HTML in values is escaped, not
+                        interpreted. Variables inside HTML tags are refused
+                        for markdown and HTML. By default, no template is
+                        used.
+  --attach-threshold BYTES
+                        Messages larger than this many bytes, e.g. megabytes
+                        of log output piped into the program, are not sent
+                        as text event. They are compressed with gzip and
+                        sent as file. Before the file a short preview is
+                        sent with the first and the last 10 lines of the
+                        message. 0 sends every message as text event.
+                        Default is 32768.
   -k CONFIG, --config CONFIG
                         Location of a config file. By default, no config
                         file is used. If this option is provided, the
                         provided file name will be used to read
-                        configuration from.
+                        configuration from. The config file can be written
+                        in YAML (.yaml, .yml), TOML (.toml) or JSON (.json).
+                        It defines named profiles under the key "profiles".
+                        Each profile can set "room", "message", "image",
+                        "audio", "file", "format" (one of text, html,
+                        markdown, code), "notice", "split", "template",
+                        "credentials" and "store". The key "default_profile"
+                        names the profile to use if --profile is not given.
+                        The parsed config file is cached in compiled form in
+                        "~/.cache/matrix-nio-send" until the config file
+                        changes.
+  --profile PROFILE     Name of the profile of the config file to use. The
+                        profile provides default values for rooms, format,
+                        notice, split string and attachments. Arguments
+                        given on the command line take precedence. If
+                        --config is not given the config file
+                        "~/.config/matrix-nio-send/config.yaml" is used.
   -n, --notice          Send message as notice. If not specified, message
                         will be sent as text.
+  --status-key KEY      Send the message as status message. The first
+                        message with this key is sent to a room as usual,
+                        every later message with the same key is sent as
+                        edit of it. E.g. progress or heartbeat reports then
+                        update one message instead of filling the room
+                        history and notifying everyone every time. The event
+                        IDs are kept per key and room in the store. Messages
+                        sent as file, see --attach-threshold, are not edits.
+                        By default, messages are not status messages.
   -e, --encrypted       Send message end-to-end encrypted. Encryption is
                         always turned on and will always be used where
                         possible. It cannot be turned off. This flag does
@@ -257,7 +441,195 @@ optional arguments:
                         the provided directory name will be used as
                         persistent storage directory instead of the default
                         one. Preferably, for multiple executions of this
-                        program use the same store for the same device.
+                        program use the same store for the same device. The
+                        store directory can be shared between multiple
+                        different devices and users. Several instances of
+                        this program can use the same store at the same
+                        time, e.g. cron jobs. They coordinate via the file
+                        "store.lock" in the store, so that only the steps
+                        that change the encryption state, i.e. uploading
+                        keys, processing a sync, and sharing keys with and
+                        encrypting for an encrypted room, run one at a time.
+  --priority {high,bulk}
+                        Priority of the messages and files given on the
+                        command line, and of the jobs of --batch and
+                        --webhook that do not specify a "priority". High
+                        priority jobs are sent before queued bulk jobs and
+                        up to 16 of them in parallel, so a critical message
+                        is not delayed by a burst of bulk messages. Bulk
+                        jobs are sent one after the other in their original
+                        order. Default is "bulk".
+  --batch               Read jobs from stdin, one JSON object per line, in
+                        the same format as the requests of --webhook, e.g.
+                        {"message": "daily digest", "format": "markdown",
+                        "priority": "bulk", "room":
+                        ["#digest:example.org"]}. The jobs are sent together
+                        with the messages and files given on the command
+                        line, in the order of their priority (see
+                        --priority). Invalid lines are skipped.
+  --at TIME             Do not send now, but schedule the messages and files
+                        to be sent at this time, e.g. "2026-12-24 18:00" or
+                        "18:00" (the next 18:00, today or tomorrow). Without
+                        a time zone, e.g. "+01:00", local time is used. The
+                        jobs are kept in the store directory and sent by
+                        this program running with --scheduler and the same
+                        store. So reminders do not need one login and sync
+                        each.
+  --in DURATION         Like --at, but schedule the messages and files to be
+                        sent after this duration, e.g. "90s", "15m", "2h",
+                        "1d" or "1h30m".
+  --scheduler           Run as resident scheduler: send the jobs scheduled
+                        with --at and --in when they are due. Jobs that
+                        became due while the scheduler was not running are
+                        sent right away. Jobs scheduled while the scheduler
+                        runs are picked up within 1.0 seconds. The program
+                        runs until Control-C is hit. This option cannot be
+                        combined with messages, images, audio or files. It
+                        can be combined with --watch and --webhook.
+  --dedup SECONDS       Suppress identical messages. A message that was
+                        already sent to the same room in the same format
+                        within the last SECONDS seconds is not sent again.
+                        This is useful for flapping monitors that send the
+                        same alert many times. Sent messages are remembered
+                        in the store directory, so this works across
+                        multiple runs of the program. By default, no
+                        messages are suppressed.
+  --dedup-mode {drop,collapse}
+                        What to do with messages suppressed by --dedup.
+                        "drop" drops them silently. "collapse" drops them as
+                        well, but the next identical message sent after the
+                        time window gets the suffix "(repeated N times)".
+                        Default is "drop".
+  --watch DIR           Watch this directory and send every new file that
+                        appears in it, e.g. reports dropped into a spool
+                        directory. Images are sent as images, all other
+                        files as files. A file is sent once it has not
+                        changed for 2.0 seconds, so that partially written
+                        files are not sent. Hidden files and files ending in
+                        ".tmp", ".part" or "~" are ignored. Sent files are
+                        recorded in the store directory, so after a restart
+                        only new or modified files are sent. The program
+                        runs until Control-C is hit. This option cannot be
+                        combined with messages, images, audio or files.
+  --webhook [HOST:]PORT
+                        Listen for HTTP POST requests on this port and send
+                        the messages they contain, e.g. from Alertmanager or
+                        Grafana. By default, only connections from localhost
+                        (127.0.0.1) are accepted. The request body is JSON,
+                        e.g. {"message": "disk full", "format": "markdown",
+                        "notice": true, "room": ["#alerts:example.org"]}.
+                        "format", "notice", "room" and "priority" (see
+                        --priority) are optional. Alertmanager and Grafana
+                        payloads are understood as well. Requests are
+                        answered with 202 once queued, and with 503 if the
+                        queue is full. The program runs until Control-C is
+                        hit. This option cannot be combined with messages,
+                        images, audio or files.
+  --webhook-queue-size WEBHOOK_QUEUE_SIZE
+                        Number of messages received via --webhook that can
+                        wait to be sent. Further requests are rejected with
+                        503 until the queue drains. Default is 1000.
+  --webhook-token WEBHOOK_TOKEN
+                        If set, --webhook only accepts requests that carry
+                        this token, either as header "Authorization: Bearer
+                        TOKEN" or as query parameter "?token=TOKEN".
+  --shard-credentials FILE [FILE ...]
+                        Send to many rooms in parallel with multiple
+                        processes. This is useful for broadcasting to
+                        thousands of rooms, as encryption then runs on all
+                        cores. For each given credentials file one worker
+                        process is started. The rooms are split between the
+                        workers, each worker logs in as the device of its
+                        credentials file and sends to its rooms. Each worker
+                        uses its own store, a sub-directory of the store
+                        directory named after the credentials file, e.g.
+                        "./store/shard1/" for "shard1.json". Create the
+                        credentials files beforehand, e.g. by running this
+                        program once with "--credentials shard1.json --store
+                        ./store/shard1". The names of the credentials files
+                        must differ. Use about as many credentials files as
+                        there are CPU cores. The credentials file given with
+                        --credentials is only used to resolve the rooms.
+                        This option cannot be combined with --verify,
+                        --watch or --webhook.
+  --crypto-executor {none,thread}
+                        Where to encrypt and serialize events. "none" does
+                        it in the event loop, as matrix-nio does. "thread"
+                        does the Megolm encryption of events, the Olm
+                        encryption of room keys for the devices of a room
+                        and the serialization of events to JSON in a
+                        separate thread, so that other uploads and sends are
+                        not stalled. This helps when sending to many
+                        encrypted rooms with many devices, e.g. with --watch
+                        or --webhook. Default is "none".
+  --job-id ID           Identify this run as one logical send job. The
+                        transaction IDs of the events are derived from this
+                        ID and the room, instead of being random. If the
+                        same command is run again with the same job ID, e.g.
+                        by a retrying cron job or spooler after a timeout,
+                        the homeserver does not send the events a second
+                        time. Transaction IDs are only remembered per device
+                        and for a limited time by the homeserver. For
+                        --batch and --webhook the JSON object of a job can
+                        have the key "id" instead. Jobs scheduled with --at
+                        and --in always get an ID.
+  --send-retries N      How often an event is sent again if sending timed
+                        out, the connection failed, or the homeserver
+                        replied with M_LIMIT_EXCEEDED. All tries use the
+                        same transaction ID, so an event that arrived but
+                        whose response got lost is not sent twice. After a
+                        timeout the wait before the next try starts at 0.5
+                        seconds and doubles, after M_LIMIT_EXCEEDED the wait
+                        is what the homeserver asks for. Default is 3. 0
+                        disables retries.
+  --send-timeout SECONDS
+                        Timeout of a single try to send an event, see
+                        --send-retries. A short timeout together with
+                        retries lowers the latency when a request gets
+                        stuck. Default is the request timeout of matrix-nio,
+                        60 seconds.
+  --concurrency LIMIT   How many events are sent in parallel, and how many
+                        files are uploaded in parallel, e.g. when sending to
+                        many rooms, with --batch, --watch or --webhook.
+                        "adaptive" starts with 4, raises the limit while the
+                        server answers quickly, and halves it when the
+                        server answers with M_LIMIT_EXCEEDED, times out, or
+                        answers much slower than before. A number sets a
+                        fixed limit, 1 sends one event after the other. The
+                        limit chosen is shown by --timings. Default is
+                        "adaptive".
+  --timings             At the end, print a table to stderr that shows how
+                        much time was spent in each phase of the program:
+                        startup (interpreter and imports), finding and
+                        reading credentials, opening the store, resolving
+                        rooms, uploading keys, syncing, reading input,
+                        uploading and sending.
+  --timings-json FILE   At the end, write the timings of all phases (see
+                        --timings) as JSON to this file.
+  --profiler {cprofile,pyinstrument}
+                        Run the program under a profiler. "cprofile" uses
+                        the profiler of the Python standard library.
+                        "pyinstrument" requires the Python package
+                        pyinstrument to be installed. The result is printed
+                        to stderr, or written to the file given with
+                        --profiler-output.
+  --profiler-output FILE
+                        Write the result of --profiler to this file instead
+                        of printing it. For "cprofile" a pstats file is
+                        written, for "pyinstrument" an HTML file.
+  --metrics [HOST:]PORT
+                        Serve Prometheus metrics via HTTP on
+                        http://HOST:PORT/metrics while the program runs in a
+                        long running mode (--verify, --watch, --webhook,
+                        --scheduler). By default, HOST is 127.0.0.1. Metrics
+                        include sent events, send errors, send latency, rate
+                        limiting, uploaded bytes, upload latency, encryption
+                        time, syncs and queue depth.
+  --metrics-textfile FILE
+                        Write Prometheus metrics (see --metrics) to this
+                        file every 15.0 seconds in long running modes and
+                        once at the end of the program, e.g. for the
+                        textfile collector of the Prometheus node exporter.
   -v VERIFY, --verify VERIFY
                         Perform verification. By default, no verification is
                         performed. Possible values are: "emoji". If
@@ -276,10 +648,13 @@ optional arguments:
 - Don't change tabbing, spacing, or formating as file is automatically
   linted with `autopep8 --aggressive`
 - `pylama:format=pep8:linters=pep8`
-
-# Things to do, Things missing
-
-- help me add config file handling
+- Benchmarks: `benchmarks/run_benchmarks.py` measures startup time,
+  end-to-end latency, throughput to 1/10/100 rooms and upload speed
+  against a local mock homeserver (`benchmarks/mock_homeserver.py`)
+  and writes the results as JSON. Compare two versions with
+  `benchmarks/run_benchmarks.py --compare before.json after.json`.
+  For encrypted rooms run the mock homeserver with
+  `--encrypted --members 20`
 
 # Final Remarks
 
@@ -296,19 +671,80 @@ import asyncio
 import json
 import re  # regular expression
 import os
+import stat
+import struct
 import sys
+import time
 import select
 import getpass
+import glob
+import hashlib
+import hmac
 import argparse
+import bisect
+import codecs
+import collections
+import concurrent.futures
+import contextlib
+import cProfile
+import ctypes
+import ctypes.util
+import datetime
+import functools
+import html
 import logging
+import mmap
+import multiprocessing
+import pickle
+import pstats
+import queue
+import sqlite3
+import string
+import tarfile
+import tempfile
+import threading
 import traceback
+import uuid
 import textwrap
+import zlib
+from aiohttp import ClientConnectionError, web
 from PIL import Image
 from markdown import markdown
+try:  # not available on Windows, then processes cannot share a store
+    import fcntl
+except ImportError:
+    fcntl = None
+try:  # optional, only needed for YAML config files
+    import yaml
+except ImportError:
+    yaml = None
+try:  # optional, only needed to highlight --code with --language
+    import pygments.lexers
+    import pygments.styles
+    import pygments.util
+except ImportError:
+    pygments = None
+try:  # optional, only needed for TOML config files, Python 3.11+ has tomllib
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
 from nio import (
+    Api,
     AsyncClient,
     AsyncClientConfig,
+    JoinedMembersResponse,
+    KeysClaimResponse,
+    KeysQueryResponse,
+    KeysUploadResponse,
     LoginResponse,
+    RoomResolveAliasResponse,
+    RoomSendError,
+    RoomSendResponse,
+    ShareGroupSessionResponse,
+    SyncResponse,
     UploadResponse,
     KeyVerificationEvent,
     KeyVerificationStart,
@@ -317,7 +753,10 @@ from nio import (
     KeyVerificationMac,
     ToDeviceError,
 )
+from nio.crypto import Olm
 
+# end of imports, used to measure startup time of the program
+IMPORTS_DONE = time.perf_counter()
 # matrix-nio-send
 PROG_WITHOUT_EXT = os.path.splitext(os.path.basename(__file__))[0]
 # matrix-nio-send.py
@@ -339,7 +778,1214 @@ STORE_PATH_LASTRESORT = os.path.normpath(
 # e.g. ~/.local/share/matrix-nio-send/store/
 STORE_DIR_LASTRESORT = os.path.normpath(
     (os.path.expanduser(STORE_PATH_LASTRESORT + "/" + STORE_DIR_DEFAULT)))
+# e.g. ~/.cache/matrix-nio-send/
+CACHE_DIR = os.path.normpath(os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache/")),
+    PROG_WITHOUT_EXT))
+# file inside $XDG_RUNTIME_DIR/matrix-nio-send/ that caches the resolved
+# credentials file and store directory
+BOOTSTRAP_CACHE_FILE = "bootstrap.json"
+# max number of cached combinations of directory, --credentials and --store
+BOOTSTRAP_CACHE_MAX_ENTRIES = 16
+# config file used if --profile is given without --config
+CONFIG_FILE_DEFAULT = CREDENTIALS_DIR_LASTRESORT + "/config.yaml"
+# keys that may be used inside a profile of the config file
+CONFIG_PROFILE_KEYS = ("room", "message", "image", "audio", "file", "format",
+                       "notice", "split", "template", "credentials", "store")
+# message formats that may be used inside a profile of the config file
+CONFIG_FORMATS = ("text", "html", "markdown", "code")
+# directory in which --template looks for templates given by name
+TEMPLATE_DIR = CREDENTIALS_DIR_LASTRESORT + "/templates"
+# version of the compiled form of templates, increased when it changes
+TEMPLATE_COMPILER_VERSION = 1
+# stands in for a variable while a markdown template is converted to HTML,
+# letters and digits only so that markdown leaves it alone
+TEMPLATE_FIELD_TOKEN = "MNSTEMPLATEFIELD{}Z"
+# max number of converted markdown messages kept in memory, repeated
+# messages, e.g. alerts, are converted only once
+MARKDOWN_CACHE_SIZE = 128
+# pygments style whose colors are used to highlight --code with --language
+CODE_HIGHLIGHT_STYLE = "default"
+# max number of highlighted --code messages kept in memory
+CODE_CACHE_SIZE = 32
+# max size of highlighted code plus message, larger code is not highlighted
+# since the size of an event is limited to 64 KiB
+CODE_HIGHLIGHT_MAX_SIZE = 48 * 1024
+# bytes read from stdin at once
+STDIN_CHUNK_SIZE = 64 * 1024
+# file inside the store directory that records files sent by --watch
+WATCH_INDEX_FILE = "watch_index.json"
+# seconds a new file must be unchanged before --watch considers it complete
+WATCH_SETTLE_TIME = 2.0
+# seconds between checks of pending files, and between directory scans
+# if inotify is not available
+WATCH_POLL_INTERVAL = 0.5
+WATCH_SCAN_INTERVAL = 5.0
+# max number of files that --watch sends in parallel, how many of them
+# are uploaded in parallel is decided by upload_limiter
+WATCH_CONCURRENCY = 16
+# seconds until --watch retries a file that could not be sent, doubled
+# with every failure up to the max, a file that changes is retried sooner
+WATCH_RETRY_BACKOFF = 60.0
+WATCH_RETRY_BACKOFF_MAX = 3600.0
+# inotify constants, see /usr/include/linux/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+# default number of messages the --webhook queue can hold before
+# further requests are rejected with 503
+WEBHOOK_QUEUE_SIZE_DEFAULT = 1000
+# max size in bytes of one --webhook request body
+WEBHOOK_MAX_BODY_SIZE = 1024 * 1024
+# priorities of jobs, see SendQueue
+PRIORITIES = ("high", "bulk")
+# max number of high priority jobs that are sent in parallel, how many
+# events are sent in parallel is decided by send_limiter
+PRIORITY_HIGH_CONCURRENCY = 16
+# max number of bulk jobs that are sent in parallel, 1 keeps their order
+PRIORITY_BULK_CONCURRENCY = 1
+# how often an event is sent again after a timeout or M_LIMIT_EXCEEDED
+SEND_RETRIES_DEFAULT = 3
+# seconds to wait before the first retry after a timeout, doubles each time
+SEND_RETRY_BACKOFF = 0.5
+# max seconds to wait before a retry after a timeout
+SEND_RETRY_BACKOFF_MAX = 30.0
+# parallel sends and uploads at the start with --concurrency adaptive
+CONCURRENCY_INITIAL = 4
+# max parallel sends and uploads with --concurrency adaptive, also the max
+# number of rooms a message is sent to in parallel
+CONCURRENCY_MAX = 64
+# factor by which the limit of parallel requests is cut on overload
+CONCURRENCY_DECREASE = 0.5
+# a send is taken as sign of overload if it takes longer than this factor
+# times the baseline latency plus CONCURRENCY_LATENCY_SLACK seconds
+CONCURRENCY_LATENCY_FACTOR = 3.0
+CONCURRENCY_LATENCY_SLACK = 0.05
+# how fast the baseline latency follows higher latencies, per response
+CONCURRENCY_BASELINE_DRIFT = 0.01
+# bytes per chunk handed to the HTTP connection when uploading a file
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# seconds since the last change before a file is memory mapped for upload,
+# a file that is still being written could shrink while it is mapped
+UPLOAD_MMAP_MIN_AGE = 2
+# formats of archives that directories and globs given with --file are
+# sent as, see --archive-format
+ARCHIVE_FORMATS = ("tar.gz", "tar")
+ARCHIVE_MIME_TYPES = {"tar.gz": "application/gzip",
+                      "tar": "application/x-tar"}
+# zlib compression level of tar.gz archives
+ARCHIVE_COMPRESSION_LEVEL = 6
+# max number of chunks of UPLOAD_CHUNK_SIZE bytes that are read ahead
+# while streaming an archive
+ARCHIVE_QUEUE_SIZE = 4
+# messages with more bytes than this are sent as gzip compressed file
+# with a short preview, see --attach-threshold
+MESSAGE_ATTACH_THRESHOLD_DEFAULT = 32 * 1024
+# number of lines from the head and from the tail of such a message that
+# are shown in its preview
+MESSAGE_PREVIEW_LINES = 10
+# max number of characters of a line in the preview
+MESSAGE_PREVIEW_LINE_LENGTH = 200
+# file name extension of such a message, by format of the message
+MESSAGE_FILE_EXTENSIONS = {"text": "txt", "code": "txt", "markdown": "md",
+                           "html": "html"}
+# file inside the store directory that keeps the state of --dedup
+DEDUP_FILE = "dedup.db"
+# max number of distinct messages remembered by --dedup, oldest are evicted
+DEDUP_MAX_ENTRIES = 10000
+# seconds after which a message that is being sent no longer suppresses
+# its duplicates, e.g. if the process sending it was killed
+DEDUP_PENDING_TIMEOUT = 300
+# file inside the store directory that keeps the event IDs of the
+# messages sent with --status-key
+STATUS_FILE = "status.db"
+# file inside the store directory that holds the jobs scheduled by --at, --in
+SCHEDULE_FILE = "schedule.db"
+# max seconds until --scheduler notices jobs scheduled by other processes
+SCHEDULE_POLL_INTERVAL = 1.0
+# max number of due jobs that --scheduler fetches at once
+SCHEDULE_FETCH_LIMIT = 100
+# units of durations for --in
+SCHEDULE_UNITS = {"s": 1, "m": 60, "h": 60 * 60, "d": 24 * 60 * 60,
+                  "w": 7 * 24 * 60 * 60}
+# seconds between two writes of the --metrics-textfile
+METRICS_TEXTFILE_INTERVAL = 15.0
+# upper bounds in seconds of the buckets of latency histograms
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0, 30.0)
+# max number of characters of a message or list written into a log record
+LOG_TRUNCATE_LENGTH = 200
 EMOJI = "emoji"  # verification type
+# DedupFilter, set up by main_send() if --dedup is used
+dedup_filter = None
+# StatusEvents, set up by main_send() if status messages can be sent
+status_events = None
+# compiled config file and templates by kind and path, see load_compiled()
+compiled_cache = {}
+# highlighted code by SHA-256 hash of the message and language, the
+# least recently used are evicted first, see code_to_html()
+code_cache = collections.OrderedDict()
+# executor for encryption and serialization of events, set up by
+# setup_crypto_executor() if --crypto-executor is "thread"
+crypto_executor = None
+# sync filter for --verify: no rooms, no presence, no account data, only
+# to-device events (the verification events) and device list changes
+VERIFY_SYNC_FILTER = {
+    "presence": {"types": []},
+    "account_data": {"types": []},
+    "room": {"rooms": []},
+}
+# file inside the store directory that caches resolved room aliases
+ROOM_ALIAS_CACHE_FILE = "room_alias_cache.json"
+# seconds a resolved room alias stays valid in the cache, 1 day
+ROOM_ALIAS_CACHE_TTL = 24 * 60 * 60
+# max number of room alias lookups sent to the server in parallel
+ROOM_ALIAS_RESOLVE_CONCURRENCY = 10
+# file inside the store directory that processes sharing the store lock
+STORE_LOCK_FILE = "store.lock"
+# attributes of the olm machine that only live in memory, they are kept
+# when the olm machine is reloaded from the store
+STORE_RELOAD_KEEP = ("outbound_group_sessions", "key_verifications",
+                     "outgoing_to_device_messages", "users_for_key_query")
+# responses whose processing changes the encryption state, they are
+# processed with the store held exclusively, see lock_store()
+STORE_LOCK_RESPONSES = (SyncResponse, JoinedMembersResponse,
+                        KeysQueryResponse, KeysClaimResponse,
+                        KeysUploadResponse, ShareGroupSessionResponse)
+# StoreLock of the store of the client, set up by
+# login_using_credentials_file()
+store_lock = None
+# held while querying device keys before sending to an encrypted room
+key_query_lock = asyncio.Lock()
+# requests of the members of rooms in flight by room_id, see
+# share_room_key()
+member_requests = {}
+
+
+class DedupFilter(object):
+    """Suppress identical messages sent within a time window.
+
+    A message is identified by a hash of room, format and body. The
+    filter maps the first 8 bytes of the SHA-256 hash to the time the
+    message was last sent and the number of suppressed duplicates. It
+    holds at most DEDUP_MAX_ENTRIES entries, the least recently sent
+    ones are evicted first. check() reserves a message that is to be
+    sent in the same transaction, so identical messages sent at the
+    same time are suppressed while the first one is in flight. Once it
+    was sent it is recorded, see record(), if the send failed the
+    reservation is released, see release(), so it is not suppressed
+    when it is sent again. The entries are kept in a SQLite table in
+    the store directory, so that it works across invocations of the
+    program and several processes sharing the store do not lose each
+    other's entries.
+    """
+
+    def __init__(self, store_dir, window, mode):
+        """Open the table in the store directory, create it if needed.
+
+        Arguments:
+        ---------
+        store_dir : str
+            location of persistent storage store directory
+        window : float
+            seconds during which identical messages are suppressed
+        mode : str
+            "drop" to drop duplicates, or "collapse" to drop duplicates
+            and add a "repeated N times" suffix to the next message
+            sent after the window
+
+        """
+        self.window = window
+        self.mode = mode
+        # suppressed duplicates reported by check() per reserved key
+        self.reported = {}
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+            self.file = os.path.join(store_dir, DEDUP_FILE)
+        else:
+            self.file = ":memory:"
+        self.db = sqlite3.connect(self.file, timeout=30)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT "
+                            "PRIMARY KEY, sent REAL NOT NULL, suppressed "
+                            "INTEGER NOT NULL)")
+            try:
+                # time a message was reserved to be sent, 0 if it is not
+                self.db.execute("ALTER TABLE entries ADD COLUMN pending "
+                                "REAL NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError:  # the column exists
+                pass
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_sent "
+                            "ON entries (sent)")
+
+    @staticmethod
+    def key(room_id, msg_format, body) -> str:
+        """Return the key of a message in a room."""
+        return hashlib.sha256(
+            f"{room_id}\0{msg_format}\0{body}".encode()).hexdigest()[:16]
+
+    def check(self, room_id, msg_format, body) -> (bool, int):
+        """Check if a message should be sent, reserve it if so.
+
+        A duplicate, also of a message that is being sent right now, is
+        counted as suppressed. A message that should be sent is
+        reserved, it must be recorded with record() once it was sent,
+        or released with release() if the send failed.
+
+        Arguments:
+        ---------
+        room_id : str
+        msg_format : str
+        body : str
+
+        Returns a tuple: True if the message should be sent, False if it is
+        a duplicate, and the number of duplicates that were suppressed since
+        this message was sent last time.
+
+        """
+        key = self.key(room_id, msg_format, body)
+        now = time.time()
+        # the UPDATE takes the write lock, so the check and the
+        # reservation are one step for all processes sharing the store
+        with self.db:
+            cursor = self.db.execute(
+                "UPDATE entries SET suppressed = suppressed + 1 "
+                "WHERE key = ? AND (sent > ? OR pending > ?)",
+                (key, now - self.window, now - DEDUP_PENDING_TIMEOUT))
+            if cursor.rowcount:
+                return (False, 0)
+            self.db.execute("INSERT INTO entries (key, sent, suppressed, "
+                            "pending) VALUES (?, 0, 0, ?) ON CONFLICT (key) "
+                            "DO UPDATE SET pending = excluded.pending",
+                            (key, now))
+            suppressed = self.db.execute("SELECT suppressed FROM entries "
+                                         "WHERE key = ?", (key,)).fetchone()[0]
+        self.reported[key] = suppressed
+        return (True, suppressed)
+
+    def record(self, room_id, msg_format, body) -> None:
+        """Record that a reserved message was sent successfully.
+
+        The duplicates reported by check() are taken off the count,
+        those suppressed while the message was being sent are kept.
+
+        Arguments:
+        ---------
+        room_id : str
+        msg_format : str
+        body : str
+
+        """
+        key = self.key(room_id, msg_format, body)
+        with self.db:
+            self.db.execute("INSERT INTO entries (key, sent, suppressed, "
+                            "pending) VALUES (?, ?, 0, 0) ON CONFLICT (key) "
+                            "DO UPDATE SET sent = excluded.sent, pending = 0, "
+                            "suppressed = max(suppressed - ?, 0)",
+                            (key, time.time(), self.reported.pop(key, 0)))
+            self.db.execute("DELETE FROM entries WHERE sent < (SELECT sent "
+                            "FROM entries ORDER BY sent DESC LIMIT 1 "
+                            "OFFSET ?)", (DEDUP_MAX_ENTRIES - 1,))
+
+    def release(self, room_id, msg_format, body) -> None:
+        """Release the reservation of a message whose send failed.
+
+        Arguments:
+        ---------
+        room_id : str
+        msg_format : str
+        body : str
+
+        """
+        key = self.key(room_id, msg_format, body)
+        self.reported.pop(key, None)
+        with self.db:
+            self.db.execute("UPDATE entries SET pending = 0 WHERE key = ?",
+                            (key,))
+
+    def close(self) -> None:
+        """Close the table."""
+        self.db.close()
+
+
+class StatusEvents(object):
+    """Event IDs of the messages sent with --status-key.
+
+    For every status key and room the ID of the first message sent is
+    kept, later messages with the same key are sent as edits of it.
+    Edits must refer to the original event, not to an earlier edit.
+    The IDs are kept in a SQLite table in the store directory, so that
+    several processes sharing the store can send status messages.
+    """
+
+    def __init__(self, store_dir):
+        """Open the table in the store directory, create it if needed."""
+        os.makedirs(store_dir, exist_ok=True)
+        self.file = os.path.join(store_dir, STATUS_FILE)
+        self.db = sqlite3.connect(self.file, timeout=30)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS events (key TEXT "
+                            "NOT NULL, room_id TEXT NOT NULL, event_id TEXT "
+                            "NOT NULL, PRIMARY KEY (key, room_id))")
+
+    def get(self, key, room_id) -> str:
+        """Return the event ID of status key in room, or None."""
+        row = self.db.execute("SELECT event_id FROM events WHERE key = ? "
+                              "AND room_id = ?", (key, room_id)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key, room_id, event_id) -> None:
+        """Remember the event ID of status key in room."""
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO events (key, room_id, "
+                            "event_id) VALUES (?, ?, ?)",
+                            (key, room_id, event_id))
+
+
+class Schedule(object):
+    """Jobs to be sent at a given time, kept in the store directory.
+
+    The jobs are kept in a SQLite table with an index on the due time,
+    a B-tree, so adding a job and finding the next due job take
+    O(log n) even with tens of thousands of pending jobs. SQLite locks
+    the file, so the program run with --at or --in can add jobs while
+    the resident program run with --scheduler sends them.
+    """
+
+    def __init__(self, store_dir):
+        """Open the schedule in the store directory, create it if needed."""
+        os.makedirs(store_dir, exist_ok=True)
+        self.file = os.path.join(store_dir, SCHEDULE_FILE)
+        self.db = sqlite3.connect(self.file, timeout=30)
+        with self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            # with WAL this is safe against corruption, only the last
+            # transactions may be lost if the machine crashes
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER "
+                            "PRIMARY KEY AUTOINCREMENT, due REAL NOT NULL, "
+                            "job TEXT NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS jobs_due "
+                            "ON jobs (due, id)")
+
+    def add(self, due, jobs) -> None:
+        """Add jobs to be sent at due, seconds since the epoch."""
+        with self.db:
+            self.db.executemany("INSERT INTO jobs (due, job) VALUES (?, ?)",
+                                [(due, json.dumps(job)) for job in jobs])
+
+    def due(self, now, limit) -> list:
+        """Return up to limit jobs due at now, as (id, due, job)."""
+        return [(job_id, due, json.loads(job)) for job_id, due, job in
+                self.db.execute("SELECT id, due, job FROM jobs WHERE due <= ? "
+                                "ORDER BY due, id LIMIT ?", (now, limit))]
+
+    def next_due(self, now) -> float:
+        """Return the due time of the next job due after now, or None."""
+        return self.db.execute("SELECT MIN(due) FROM jobs WHERE due > ?",
+                               (now,)).fetchone()[0]
+
+    def remove(self, job_id) -> None:
+        """Remove a job, e.g. after it was sent."""
+        with self.db:
+            self.db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def count(self) -> int:
+        """Return number of pending jobs."""
+        return self.db.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+    def close(self) -> None:
+        """Close the schedule."""
+        self.db.close()
+
+
+class LogTruncated(object):
+    """Lazily formatted and truncated value for log messages.
+
+    Pass it as argument of a %-style log message, e.g.
+    logger.debug("Message: %s", LogTruncated(message)). It is only
+    converted to a string if the log record is actually emitted, e.g.
+    if debugging is turned on, and then at most LOG_TRUNCATE_LENGTH
+    characters of it are used. So even multi-MB messages cost nothing
+    to log when debugging is off, and little when it is on.
+    """
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        """Store value, nothing is formatted yet."""
+        self.value = value
+
+    def __str__(self):
+        """Return value as truncated string."""
+        value = self.value
+        if isinstance(value, (list, tuple)):
+            items = []
+            length = 0
+            for item in value:
+                if length > LOG_TRUNCATE_LENGTH:
+                    items.append(f"... ({len(value)} items)")
+                    break
+                text = repr(str(LogTruncated(item)))
+                items.append(text)
+                length += len(text)
+            return "[" + ", ".join(items) + "]"
+        text = value if isinstance(value, str) else str(value)
+        if len(text) > LOG_TRUNCATE_LENGTH:
+            return (text[:LOG_TRUNCATE_LENGTH] +
+                    f"... ({len(text)} characters)")
+        return text
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Format log records as one JSON object per line, see --log-format."""
+
+    def format(self, record):
+        """Return log record as JSON string."""
+        entry = {"ts": record.created,
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "msg": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def process_age() -> float:
+    """Return seconds since the start of this process, or None.
+
+    Only works on Linux, where the start time is found in /proc.
+
+    """
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # the fields after the process name, field 22 is start time
+            fields = f.read().rsplit(")", 1)[1].split()
+        start = int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - start
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+class Timings(object):
+    """Collect the time spent in the phases of the program.
+
+    Phases are measured with a monotonic clock. A phase can be entered
+    many times, e.g. once per room_send, the time is summed up.
+    Measuring is cheap, so it is always done. The result is only
+    printed with --timings and written as JSON with --timings-json.
+    """
+
+    def __init__(self):
+        """Create empty timings."""
+        self.start = time.perf_counter()
+        # phase name -> [count, total seconds, max seconds]
+        self.phases = collections.OrderedDict()
+        # additional values to report, e.g. settings chosen at runtime
+        self.values = collections.OrderedDict()
+        age = process_age()
+        if age is not None:
+            # time from process start until the end of the imports
+            self.start = time.perf_counter() - age
+            self.add("startup (interpreter, imports)",
+                     IMPORTS_DONE - self.start)
+
+    def add(self, name, seconds) -> None:
+        """Add the duration of one execution of a phase."""
+        phase = self.phases.get(name)
+        if phase is None:
+            self.phases[name] = [1, seconds, seconds]
+        else:
+            phase[0] += 1
+            phase[1] += seconds
+            if seconds > phase[2]:
+                phase[2] = seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Measure the code inside a with-statement as phase name."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def merge(self, other, prefix) -> None:
+        """Add the phases of timings exported by to_dict(), e.g. of a shard.
+
+        The phases and values are added under their name prefixed with
+        prefix.
+
+        """
+        for name, phase in other["phases"].items():
+            name = prefix + name
+            mine = self.phases.get(name)
+            if mine is None:
+                self.phases[name] = [phase["count"], phase["total"],
+                                     phase["max"]]
+            else:
+                mine[0] += phase["count"]
+                mine[1] += phase["total"]
+                mine[2] = max(mine[2], phase["max"])
+        for name, value in other["values"].items():
+            self.values[prefix + name] = value
+
+    def to_dict(self) -> dict:
+        """Return timings as dictionary, e.g. to export as JSON."""
+        return {
+            "total": time.perf_counter() - self.start,
+            "phases": {name: {"count": count, "total": total, "max": mx}
+                       for name, (count, total, mx) in self.phases.items()},
+            "values": dict(self.values),
+        }
+
+    def report(self) -> str:
+        """Return timings as human readable table."""
+        total = time.perf_counter() - self.start
+        lines = [f"{'phase':<32} {'count':>6} {'total ms':>10} "
+                 f"{'mean ms':>9} {'max ms':>9} {'%':>6}"]
+        for name, (count, seconds, mx) in self.phases.items():
+            lines.append(f"{name:<32} {count:>6} {seconds * 1000:>10.1f} "
+                         f"{seconds / count * 1000:>9.1f} {mx * 1000:>9.1f} "
+                         f"{seconds / total * 100 if total else 0:>6.1f}")
+        lines.append(f"{'total (wall clock)':<32} {'':>6} "
+                     f"{total * 1000:>10.1f}")
+        for name, value in self.values.items():
+            lines.append(f"{name}: {value}")
+        return "\n".join(lines)
+
+
+# Timings of this run of the program
+timings = Timings()
+
+
+class Counter(object):
+    """Prometheus counter, a number that only goes up."""
+
+    __slots__ = ("name", "help", "value")
+
+    def __init__(self, name, help):
+        """Create counter with value 0."""
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1) -> None:
+        """Increment counter."""
+        self.value += amount
+
+    def exposition(self) -> str:
+        """Return counter in Prometheus text format."""
+        return (f"# HELP {self.name} {self.help}\n"
+                f"# TYPE {self.name} counter\n"
+                f"{self.name} {self.value}\n")
+
+
+class Gauge(object):
+    """Prometheus gauge whose value is only computed when it is exported.
+
+    So updating the underlying value (e.g. the length of a queue)
+    costs nothing extra.
+    """
+
+    __slots__ = ("name", "help", "function")
+
+    def __init__(self, name, help):
+        """Create gauge without a function, its value is 0."""
+        self.name = name
+        self.help = help
+        self.function = None
+
+    def exposition(self) -> str:
+        """Return gauge in Prometheus text format."""
+        value = self.function() if self.function else 0
+        return (f"# HELP {self.name} {self.help}\n"
+                f"# TYPE {self.name} gauge\n"
+                f"{self.name} {value}\n")
+
+
+class Histogram(object):
+    """Prometheus histogram with fixed buckets.
+
+    Observing a value increments the count of one bucket. The
+    cumulative counts are only computed when the histogram is exported.
+    """
+
+    __slots__ = ("name", "help", "buckets", "counts", "sum")
+
+    def __init__(self, name, help, buckets=METRICS_LATENCY_BUCKETS):
+        """Create empty histogram."""
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last bucket is +Inf
+        self.sum = 0.0
+
+    def observe(self, value) -> None:
+        """Add one observed value."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def exposition(self) -> str:
+        """Return histogram in Prometheus text format."""
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{{le=\"{bound}\"}} {cumulative}")
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+class Metrics(object):
+    """All metrics of the program, exported with --metrics.
+
+    Updating a metric is a plain attribute increment without locks,
+    which is safe because everything runs in one event loop thread.
+    """
+
+    def __init__(self, prefix=PROG_WITHOUT_EXT.replace("-", "_")):
+        """Create all metrics."""
+        self.events_sent = Counter(
+            f"{prefix}_events_sent_total", "Events sent to rooms.")
+        self.send_errors = Counter(
+            f"{prefix}_send_errors_total", "Events that could not be sent.")
+        self.rate_limited = Counter(
+            f"{prefix}_rate_limited_total",
+            "Requests answered with 429 M_LIMIT_EXCEEDED by the server.")
+        self.rate_limit_delay = Counter(
+            f"{prefix}_rate_limit_delay_seconds_total",
+            "Seconds spent waiting because of rate limiting.")
+        self.send_latency = Histogram(
+            f"{prefix}_send_latency_seconds",
+            "Latency of sending one event to one room, including "
+            "encryption.")
+        self.upload_bytes = Counter(
+            f"{prefix}_upload_bytes_total", "Bytes uploaded to the server.")
+        self.upload_latency = Histogram(
+            f"{prefix}_upload_latency_seconds", "Latency of one upload.")
+        self.encrypt_latency = Histogram(
+            f"{prefix}_encrypt_seconds",
+            "Time spent encrypting one event with Megolm.")
+        self.share_group_session_latency = Histogram(
+            f"{prefix}_share_group_session_seconds",
+            "Time spent sharing a Megolm session with the devices of a "
+            "room, including Olm encryption of to-device messages.")
+        self.syncs = Counter(
+            f"{prefix}_syncs_total", "Sync responses received.")
+        self.queue_depth = Gauge(
+            f"{prefix}_queue_depth", "Messages waiting to be sent.")
+        self.send_concurrency = Gauge(
+            f"{prefix}_send_concurrency",
+            "Number of events that may be sent in parallel.")
+        self.upload_concurrency = Gauge(
+            f"{prefix}_upload_concurrency",
+            "Number of files that may be uploaded in parallel.")
+
+    def exposition(self) -> str:
+        """Return all metrics in Prometheus text format."""
+        return "".join(m.exposition() for m in vars(self).values())
+
+    def state(self) -> dict:
+        """Return values of counters and histograms, e.g. of a shard."""
+        state = {}
+        for name, m in vars(self).items():
+            if isinstance(m, Counter):
+                state[name] = m.value
+            elif isinstance(m, Histogram):
+                state[name] = (list(m.counts), m.sum)
+        return state
+
+    def merge(self, state) -> None:
+        """Add values returned by state() of another process."""
+        for name, value in state.items():
+            m = getattr(self, name)
+            if isinstance(m, Counter):
+                m.inc(value)
+            else:
+                counts, total = value
+                m.counts = [a + b for a, b in zip(m.counts, counts)]
+                m.sum += total
+
+    def instrument_client(self, client) -> None:
+        """Measure encryption and syncs of the client.
+
+        Encryption is done inside client.room_send(), so the client
+        methods doing it are wrapped to measure their time. With
+        --crypto-executor events are encrypted in the executor, the
+        time is then observed in the event loop, as the metrics are
+        not thread-safe. Must be called from the event loop.
+
+        Arguments:
+        ---------
+        client : Client
+
+        """
+        encrypt = client.encrypt
+        share_group_session = client.share_group_session
+        loop = asyncio.get_running_loop()
+        loop_thread = threading.current_thread()
+
+        def timed_encrypt(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return encrypt(*args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                if threading.current_thread() is loop_thread:
+                    self.encrypt_latency.observe(duration)
+                else:
+                    loop.call_soon_threadsafe(self.encrypt_latency.observe,
+                                              duration)
+
+        async def timed_share_group_session(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await share_group_session(*args, **kwargs)
+            finally:
+                self.share_group_session_latency.observe(
+                    time.perf_counter() - start)
+
+        async def count_sync(response):
+            self.syncs.inc()
+
+        client.encrypt = timed_encrypt
+        client.share_group_session = timed_share_group_session
+        client.add_response_callback(count_sync, SyncResponse)
+
+    def write_textfile(self, textfile) -> None:
+        """Write all metrics to a file for the node exporter."""
+        tmp_file = f"{textfile}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_file, "w") as f:
+                f.write(self.exposition())
+            os.replace(tmp_file, textfile)
+        except OSError:
+            logger.info(f"Metrics could not be written to \"{textfile}\".")
+
+    async def serve(self) -> None:
+        """Export metrics via --metrics and --metrics-textfile, runs forever.
+
+        Serves the metrics via HTTP on /metrics if --metrics is given,
+        and writes them every METRICS_TEXTFILE_INTERVAL seconds to the
+        file given with --metrics-textfile.
+
+        """
+        runner = None
+        if pargs.metrics:
+            async def handle(request):
+                return web.Response(
+                    text=self.exposition(),
+                    content_type="text/plain", charset="utf-8",
+                    headers={"X-Content-Type-Options": "nosniff"})
+
+            host, _, port = pargs.metrics.rpartition(":")
+            host = host.strip("[]") or "127.0.0.1"
+            app = web.Application()
+            app.router.add_get("/metrics", handle)
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            await web.TCPSite(runner, host, int(port)).start()
+            logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        try:
+            while True:
+                if pargs.metrics_textfile:
+                    self.write_textfile(pargs.metrics_textfile)
+                await asyncio.sleep(METRICS_TEXTFILE_INTERVAL)
+        finally:
+            if runner:
+                await runner.cleanup()
+
+
+# Metrics of this run of the program
+metrics = Metrics()
+
+
+class SendQueue(object):
+    """Queue of jobs to send, with a high priority lane and a bulk lane.
+
+    Each lane has its own workers, so high priority jobs never wait for
+    a free slot behind bulk jobs. Bulk jobs that are still queued are
+    held back while high priority jobs are queued or being sent, so a
+    critical message is not slowed down by a burst of digests.
+    High priority jobs are sent in parallel, so their order is not kept.
+    Bulk jobs are sent one after the other in the order they were put.
+    """
+
+    def __init__(self, send_job, maxsize=0):
+        """Create empty queue.
+
+        Arguments:
+        ---------
+        send_job : coroutine function
+            called with the job, returns True if the job was sent
+        maxsize : int
+            max number of queued jobs in both lanes, 0 means unlimited
+
+        """
+        self.send_job = send_job
+        self.maxsize = maxsize
+        self.lanes = {priority: asyncio.Queue() for priority in PRIORITIES}
+        # high priority jobs queued or being sent
+        self.high_pending = 0
+        self.high_idle = asyncio.Event()
+        self.high_idle.set()
+        self.failed = 0  # number of jobs that could not be sent
+
+    def qsize(self) -> int:
+        """Return number of queued jobs in both lanes."""
+        return sum(lane.qsize() for lane in self.lanes.values())
+
+    def free(self) -> int:
+        """Return number of jobs that can still be put."""
+        if not self.maxsize:
+            return sys.maxsize
+        return self.maxsize - self.qsize()
+
+    def put(self, job) -> None:
+        """Put job into the lane of its "priority", default is --priority."""
+        priority = job.get("priority") or pargs.priority
+        if priority == "high":
+            self.high_pending += 1
+            self.high_idle.clear()
+        self.lanes[priority].put_nowait((time.perf_counter(), job))
+
+    async def worker(self, priority) -> None:
+        """Send the jobs of one lane, runs forever."""
+        lane = self.lanes[priority]
+        while True:
+            queued, job = await lane.get()
+            try:
+                if priority != "high":
+                    await self.high_idle.wait()
+                timings.add(f"queue wait ({priority})",
+                            time.perf_counter() - queued)
+                if not await self.send_job(job):
+                    self.failed += 1
+            except Exception:
+                self.failed += 1
+                logger.info("Job could not be sent. "
+                            "Sorry. Here is the traceback.")
+                logger.info(traceback.format_exc())
+            finally:
+                lane.task_done()
+                if priority == "high":
+                    self.high_pending -= 1
+                    if not self.high_pending:
+                        self.high_idle.set()
+
+    async def run(self) -> None:
+        """Send jobs as they are put, runs forever."""
+        await asyncio.gather(
+            *[self.worker("high") for _ in range(PRIORITY_HIGH_CONCURRENCY)],
+            *[self.worker("bulk") for _ in range(PRIORITY_BULK_CONCURRENCY)])
+
+    async def join(self) -> None:
+        """Send all jobs that were put, returns when all are done."""
+        task = asyncio.ensure_future(self.run())
+        try:
+            for lane in self.lanes.values():
+                await lane.join()
+        finally:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+
+
+class ConcurrencyLimiter(object):
+    """Limit the number of requests in flight, adapting the limit (AIMD).
+
+    With a fixed limit this is a plain semaphore. Without, the limit
+    starts at CONCURRENCY_INITIAL. Every successful response that came
+    back while the limit was used up raises the limit by 1/limit, i.e.
+    by about one per round trip (additive increase). A response with
+    M_LIMIT_EXCEEDED, a timeout, a connection error, or, if latency is
+    used, a response much slower than the baseline latency cuts the
+    limit by CONCURRENCY_DECREASE (multiplicative decrease). Responses
+    to requests that were started before the last cut do not cut
+    again, so one burst of errors only counts once.
+
+    The baseline latency is the fastest response seen, slowly
+    following slower responses, so a changed network is learned.
+    The limit is reported in timings.values as "<name> concurrency".
+    """
+
+    def __init__(self, name, limit=None, use_latency=True):
+        """Create limiter without requests in flight.
+
+        Arguments:
+        ---------
+        name : str
+            e.g. "send", used in the timings report
+        limit : int
+            fixed limit, None adapts the limit
+        use_latency : bool
+            whether slow responses are taken as sign of overload, not
+            useful for uploads whose duration depends on the file size
+
+        """
+        self.name = name
+        self.adaptive = limit is None
+        self.limit = float(CONCURRENCY_INITIAL if limit is None else limit)
+        self.use_latency = use_latency
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.baseline = None  # seconds
+        self.last_decrease = 0.0
+        self.min_limit = self.max_limit = self.limit
+        self.decreases = 0
+
+    def allowed(self) -> int:
+        """Return number of requests that may be in flight now."""
+        return max(1, int(self.limit))
+
+    async def acquire(self) -> float:
+        """Wait for a free slot, returns the start time of the request."""
+        while self.in_flight >= self.allowed():
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    self.wake()  # pass the wake up on
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+        self.in_flight += 1
+        return time.perf_counter()
+
+    def release(self, start, congested) -> None:
+        """Free the slot of a request and adapt the limit.
+
+        Arguments:
+        ---------
+        start : float
+            as returned by acquire()
+        congested : bool
+            True if the server was overloaded (M_LIMIT_EXCEEDED, timeout,
+            connection error), False if the request succeeded or failed
+            for other reasons, None if the request did not finish, e.g.
+            because it was cancelled
+
+        """
+        now = time.perf_counter()
+        used_up = self.in_flight >= self.allowed()
+        self.in_flight -= 1
+        if self.adaptive and congested is not None:
+            latency = now - start
+            if not congested and self.use_latency:
+                if self.baseline is None or latency < self.baseline:
+                    self.baseline = latency
+                else:
+                    self.baseline += ((latency - self.baseline) *
+                                      CONCURRENCY_BASELINE_DRIFT)
+                congested = latency > (
+                    self.baseline * CONCURRENCY_LATENCY_FACTOR +
+                    CONCURRENCY_LATENCY_SLACK)
+            if congested:
+                if start >= self.last_decrease:
+                    self.limit = max(1.0, self.limit * CONCURRENCY_DECREASE)
+                    self.last_decrease = now
+                    self.decreases += 1
+            elif used_up:
+                self.limit = min(float(CONCURRENCY_MAX),
+                                 self.limit + 1 / self.limit)
+            self.min_limit = min(self.min_limit, self.limit)
+            self.max_limit = max(self.max_limit, self.limit)
+        self.report()
+        self.wake()
+
+    def wake(self) -> None:
+        """Wake up as many waiting requests as there are free slots."""
+        free = self.allowed() - self.in_flight
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def report(self) -> None:
+        """Put the current limit into the timings report."""
+        if self.adaptive:
+            timings.values[f"{self.name} concurrency"] = (
+                f"{self.allowed()} (adaptive, min {int(self.min_limit)}, "
+                f"max {int(self.max_limit)}, {self.decreases} decreases)")
+        else:
+            timings.values[f"{self.name} concurrency"] = (
+                f"{self.allowed()} (fixed)")
+
+
+# Limits of parallel sends and uploads, replaced by setup_concurrency()
+send_limiter = ConcurrencyLimiter("send")
+upload_limiter = ConcurrencyLimiter("upload", use_latency=False)
+
+
+class StoreLock(object):
+    """Coordinate the processes that use the same store directory.
+
+    The encryption state in the store (Olm account, one-time keys, Olm
+    sessions, device keys, sync token) is loaded into memory by each
+    process and written back as it changes. Without coordination two
+    processes of the same device upload one-time keys twice, overwrite
+    each other's account, or fork an Olm session.
+
+    So all steps that change the encryption state run inside
+    exclusive(): uploading keys, processing the responses listed in
+    STORE_LOCK_RESPONSES, encrypting the Megolm session for the devices
+    of an encrypted room and encrypting an event. Waiting for the
+    server is never done inside exclusive(). exclusive() takes an flock
+    on STORE_LOCK_FILE and an asyncio lock for the tasks of this
+    process. While another process holds the flock, it is waited for
+    in a thread, not by polling. The file holds a
+    generation number that every holder increments. If it changed
+    since this process last held the lock, another process changed the
+    store, and the olm machine of the client is reloaded from the store
+    first. Everything else, e.g. uploads and sending to unencrypted
+    rooms, runs in parallel without the lock.
+
+    Without fcntl (Windows) only the tasks of this process are
+    coordinated.
+    """
+
+    def __init__(self, store_dir):
+        """Open the lock file, create it if needed.
+
+        Must be created before the client loads the store, so that a
+        change made by another process in between is noticed.
+
+        Arguments:
+        ---------
+        store_dir : str
+            location of persistent storage store directory
+
+        """
+        os.makedirs(store_dir, exist_ok=True)
+        self.fd = os.open(os.path.join(store_dir, STORE_LOCK_FILE),
+                          os.O_RDWR | os.O_CREAT, 0o600)
+        self.lock = asyncio.Lock()
+        self.waiting = None  # thread waiting for the flock, see flock()
+        self.owner = None  # task holding the lock, it may enter again
+        self.client = None  # client whose olm machine is reloaded
+        self.generation = self.read_generation()
+
+    def read_generation(self) -> int:
+        """Return the generation number in the lock file."""
+        try:
+            return int(os.pread(self.fd, 32, 0) or 0)
+        except ValueError:
+            return 0
+
+    async def flock(self) -> None:
+        """Take the flock, wait while another process holds it.
+
+        The wait is a blocking flock() in a thread. If the waiting task
+        is cancelled, the thread still gets the flock eventually. It
+        is then handed to the next task that enters exclusive(), or
+        given back right away if there is none.
+
+        """
+        if not fcntl:
+            return
+        if self.waiting is None:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return
+            except BlockingIOError:
+                pass
+            self.waiting = asyncio.get_running_loop().run_in_executor(
+                None, fcntl.flock, self.fd, fcntl.LOCK_EX)
+            self.waiting.add_done_callback(self.unclaimed)
+        waiting = self.waiting
+        await asyncio.shield(waiting)
+        if self.waiting is waiting:
+            self.waiting = None
+
+    def unclaimed(self, waiting) -> None:
+        """Give back a flock that no task is waiting for anymore."""
+        if self.waiting is waiting and self.owner is None:
+            self.waiting = None
+            if not waiting.exception():
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    @contextlib.asynccontextmanager
+    async def exclusive(self):
+        """Hold the store exclusively inside an async with-statement."""
+        task = asyncio.current_task()
+        if self.owner is task:  # e.g. a sync response inside keys_upload
+            yield
+            return
+        async with self.lock:
+            self.owner = task
+            try:
+                with timings.phase("store lock wait"):
+                    await self.flock()
+                generation = self.read_generation()
+                try:
+                    if generation != self.generation and self.client:
+                        with timings.phase("store reload"):
+                            reload_olm(self.client)
+                    yield
+                finally:
+                    self.generation = generation + 1
+                    os.ftruncate(self.fd, 0)
+                    os.pwrite(self.fd, str(self.generation).encode(), 0)
+                    if fcntl:
+                        fcntl.flock(self.fd, fcntl.LOCK_UN)
+            finally:
+                self.owner = None
+
+
+def reload_olm(client) -> None:
+    """Reload the olm machine of the client from its store.
+
+    Called when another process changed the store. The Megolm sessions
+    this process uses for sending and running verifications only live
+    in memory, they are kept, see STORE_RELOAD_KEEP.
+
+    Arguments:
+    ---------
+    client : Client
+
+    """
+    logger.debug("The store was changed by another process. "
+                 "Reloading the encryption state.")
+    olm = client.olm
+    client.olm = Olm(client.user_id, client.device_id, client.store)
+    for name in STORE_RELOAD_KEEP:
+        setattr(client.olm, name, getattr(olm, name))
+    client.encrypted_rooms = client.store.load_encrypted_rooms()
+    client.loaded_sync_token = client.store.load_sync_token()
+
+
+def lock_store(client) -> None:
+    """Use store_lock for the client, see StoreLock.
+
+    Responses that change the encryption state, see
+    STORE_LOCK_RESPONSES, are processed with the store held
+    exclusively, also the sync responses of sync_forever().
+
+    Arguments:
+    ---------
+    client : Client
+
+    """
+    store_lock.client = client
+    receive_response = client.receive_response
+
+    async def locked_receive_response(response):
+        if isinstance(response, STORE_LOCK_RESPONSES):
+            async with store_lock.exclusive():
+                await receive_response(response)
+        else:
+            await receive_response(response)
+
+    client.receive_response = locked_receive_response
 
 
 class Callbacks(object):
@@ -388,6 +2034,16 @@ class Callbacks(object):
                     print("Other device does not support emoji verification "
                           f"{event.short_authentication_string}.")
                     return
+                if event.transaction_id not in client.key_verifications:
+                    # the device of the other party is not known yet,
+                    # e.g. because the sync in verify mode skips all
+                    # rooms and their members, fetch its keys and retry
+                    resp = await client.keys_query()
+                    client.olm.handle_key_verification(event)
+                    if event.transaction_id not in client.key_verifications:
+                        print("Device of other party is unknown, "
+                              f"keys query returned {resp}.")
+                        return
                 resp = await client.accept_key_verification(
                     event.transaction_id)
                 if isinstance(resp, ToDeviceError):
@@ -586,12 +2242,12 @@ def determine_credentials_file() -> str:
         logger.debug("Credentials file does not exist locally. "
                      "File name has no path.")
         credentials_file = CREDENTIALS_DIR_LASTRESORT + "/" + pargs.credentials
-        logger.debug(f"Trying path \"{credentials_file}\" as last resort. "
-                     "Suggesting to look for it there.")
+        logger.debug("Trying path \"%s\" as last resort. "
+                     "Suggesting to look for it there.", credentials_file)
         if os.path.isfile(credentials_file):
             logger.debug("We found the file. It exists in the last resort "
-                         f"directory {credentials_file} "
-                         "Suggesting to use this one.")
+                         "directory %s "
+                         "Suggesting to use this one.", credentials_file)
         else:
             logger.debug("File does not exists either in the last resort "
                          "directory or the local directory. "
@@ -602,11 +2258,11 @@ def determine_credentials_file() -> str:
         if os.path.isfile(pargs.credentials):
             logger.debug("Credentials file existed. "
                          "So this is the one we suggest to use. "
-                         f"file: {credentials_file}")
+                         "file: %s", credentials_file)
         else:
             logger.debug("Credentials file was specified with full path. "
                          "So we suggest that one. "
-                         f"file: {credentials_file}")
+                         "file: %s", credentials_file)
     # The returned file (with or without path)  might or might not exist.
     # But if it does not exist, it is either a full path, or local.
     # We do not want to return the last resort path if it does not exist,
@@ -654,7 +2310,7 @@ def determine_store_dir() -> str:
              "for a more consistent experience.")
     if os.path.isdir(pargs.store):
         logger.debug("Found an existing store in directory "
-                     f"\"{pargs_store_norm}\". It will be used.")
+                     "\"%s\". It will be used.", pargs_store_norm)
         return pargs_store_norm
     if (pargs.store != STORE_DIR_DEFAULT and
             pargs.store != os.path.basename(pargs.store)):
@@ -668,19 +2324,20 @@ def determine_store_dir() -> str:
             os.path.isdir(STORE_DIR_LASTRESORT)):
         logger.debug("Store was not found in default local directory. "
                      "But found an existing store directory in "
-                     f"\"{STORE_DIR_LASTRESORT}\" directory. "
-                     "It will be used.")
+                     "\"%s\" directory. "
+                     "It will be used.", STORE_DIR_LASTRESORT)
         return STORE_DIR_LASTRESORT
 
     if pargs.store == os.path.basename(pargs.store):
-        logger.debug(f"Store directory \"{pargs_store_norm}\" is just a name "
+        logger.debug("Store directory \"%s\" is just a name "
                      "without a path. Already looked locally, but not found "
-                     "locally. So now looking for it in last-resort path.")
+                     "locally. So now looking for it in last-resort path.",
+                     pargs_store_norm)
         last_resort = os.path.normpath(
             STORE_PATH_LASTRESORT + "/" + pargs.store)
         if os.path.isdir(last_resort):
             logger.debug("Found an existing store directory in "
-                         f"\"{last_resort}\" directory. It will be used.")
+                         "\"%s\" directory. It will be used.", last_resort)
             return last_resort
     text1 = ("Could not find existing store directory anywhere. "
              "A new one will be created. ")
@@ -689,229 +2346,1911 @@ def determine_store_dir() -> str:
     return pargs_store_norm  # create in the specified, local dir without path
 
 
-def determine_rooms(room_id) -> list:
+def bootstrap_cache_file() -> str:
+    """Return the location of the bootstrap cache, or None.
+
+    The cache is only used if there is a private runtime directory,
+    $XDG_RUNTIME_DIR, which is normally a tmpfs only accessible by the
+    user and cleared at logout.
+
+    """
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        return None
+    return os.path.join(runtime_dir, PROG_WITHOUT_EXT, BOOTSTRAP_CACHE_FILE)
+
+
+def bootstrap_cache_key() -> str:
+    """Return the key of this run in the bootstrap cache.
+
+    The resolved paths depend on the current directory and on the
+    --credentials and --store arguments.
+
+    """
+    return json.dumps([os.getcwd(), pargs.credentials, pargs.store])
+
+
+def read_bootstrap_cache(cache_file) -> dict:
+    """Read the bootstrap cache, return {} if it does not exist."""
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+        if isinstance(cache, dict):
+            return cache
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        logger.debug("Bootstrap cache \"%s\" could not be read.", cache_file)
+    return {}
+
+
+def write_bootstrap_cache(cache_file, cache) -> None:
+    """Write the bootstrap cache, readable only by the user."""
+    try:
+        os.makedirs(os.path.dirname(cache_file), mode=0o700, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.debug("Bootstrap cache \"%s\" could not be "
+                     "written.", cache_file)
+
+
+def determine_credentials_and_store() -> (str, str, dict):
+    """Determine credentials file and store directory, read the credentials.
+
+    Finding the credentials file and the store directory probes several
+    locations, see determine_credentials_file() and
+    determine_store_dir(). The resolved paths are cached, see
+    bootstrap_cache_file(), so a warm run only reads the cache and the
+    credentials file it needs anyway. The cached paths are used as long
+    as the cached credentials file can be read. Note that a file or
+    directory created later in a location of higher precedence, e.g. a
+    local "./credentials.json", is then not noticed until the cache is
+    cleared at logout. Remove the cache, or give --credentials and
+    --store explicitly, to use it right away.
+
+    Returns the credentials file, the store directory and the
+    credentials dictionary, or None if the credentials file does not
+    exist.
+
+    """
+    cache_file = bootstrap_cache_file()
+    cache = read_bootstrap_cache(cache_file) if cache_file else {}
+    key = bootstrap_cache_key()
+    entry = cache.get(key)
+    if entry:
+        try:
+            credentials = read_credentials_from_disk(
+                entry["credentials_file"])
+            logger.debug("Using credentials file \"%s\" and store "
+                         "\"%s\" from bootstrap cache.",
+                         entry["credentials_file"], entry["store_dir"])
+            return (entry["credentials_file"], entry["store_dir"],
+                    credentials)
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    credentials_file = determine_credentials_file()
+    store_dir = determine_store_dir()
+    if not os.path.isfile(credentials_file):
+        return credentials_file, store_dir, None
+    credentials = read_credentials_from_disk(credentials_file)
+    if cache_file and store_dir and os.path.isdir(store_dir):
+        # entries of older versions also held the access token
+        cache = {k: v for k, v in cache.items()
+                 if k != key and isinstance(v, dict) and
+                 "credentials" not in v}
+        cache[key] = {"credentials_file": os.path.abspath(credentials_file),
+                      "store_dir": os.path.abspath(store_dir)}
+        # dictionaries keep insertion order, the oldest entries go first
+        for old in list(cache)[:-BOOTSTRAP_CACHE_MAX_ENTRIES]:
+            del cache[old]
+        write_bootstrap_cache(cache_file, cache)
+    return credentials_file, store_dir, credentials
+
+
+def read_room_alias_cache(store_dir) -> dict:
+    """Read the room alias cache from the store directory.
+
+    Arguments:
+    ---------
+    store_dir : str
+        location of persistent storage store directory
+
+    Returns a dictionary that maps room aliases to a dictionary with
+    the keys "room_id" and "ts" (time of resolution in seconds since epoch).
+    Returns an empty dictionary if there is no cache or if it is unreadable.
+
+    """
+    if not store_dir:
+        return {}
+    cache_file = os.path.join(store_dir, ROOM_ALIAS_CACHE_FILE)
+    try:
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError):
+        logger.debug("Room alias cache \"%s\" could not be read. "
+                     "It will be ignored and rebuilt.", cache_file)
+        return {}
+    if not isinstance(cache, dict):
+        return {}
+    return cache
+
+
+def write_room_alias_cache(store_dir, cache) -> None:
+    """Write the room alias cache to the store directory.
+
+    The file is first written to a temporary file and then renamed
+    so that concurrent readers never see a half-written cache.
+
+    Arguments:
+    ---------
+    store_dir : str
+        location of persistent storage store directory
+    cache : dict
+        room alias cache as returned by read_room_alias_cache()
+
+    """
+    if not store_dir:
+        return
+    cache_file = os.path.join(store_dir, ROOM_ALIAS_CACHE_FILE)
+    tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(store_dir, exist_ok=True)
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.debug("Room alias cache \"%s\" could not be "
+                     "written. Aliases will be resolved again next time.",
+                     cache_file)
+        logger.debug(traceback.format_exc())
+
+
+async def resolve_room_aliases(client, aliases, store_dir) -> dict:
+    """Resolve room aliases into room ids.
+
+    Aliases found in the cache and not older than ROOM_ALIAS_CACHE_TTL
+    are taken from the cache without contacting the server. All the
+    remaining aliases are resolved in one batch of concurrent requests
+    and the results are added to the cache.
+
+    Arguments:
+    ---------
+    client : Client
+    aliases : list
+        list of room aliases, e.g. ["#someroomalias:example.org"]
+    store_dir : str
+        location of persistent storage store directory
+
+    Returns a dictionary that maps each alias to its room id.
+    Aliases that could not be resolved are missing in the dictionary.
+
+    """
+    cache = read_room_alias_cache(store_dir)
+    now = time.time()
+    resolved = {}
+    misses = []
+    for alias in aliases:
+        entry = cache.get(alias)
+        if (isinstance(entry, dict) and entry.get("room_id") and
+                now - entry.get("ts", 0) < ROOM_ALIAS_CACHE_TTL):
+            resolved[alias] = entry["room_id"]
+        elif alias not in misses:
+            misses.append(alias)
+    logger.debug("Room aliases found in cache: %s, "
+                 "room aliases to be resolved by server: %s.",
+                 len(resolved), len(misses))
+    if not misses:
+        return resolved
+
+    semaphore = asyncio.Semaphore(ROOM_ALIAS_RESOLVE_CONCURRENCY)
+
+    async def resolve(alias):
+        async with semaphore:
+            return await client.room_resolve_alias(alias)
+
+    responses = await asyncio.gather(
+        *(resolve(alias) for alias in misses), return_exceptions=True)
+    for alias, resp in zip(misses, responses):
+        if isinstance(resp, RoomResolveAliasResponse):
+            logger.debug("Room alias \"%s\" was resolved to room id \"%s\".",
+                         alias, resp.room_id)
+            resolved[alias] = resp.room_id
+            cache[alias] = {"room_id": resp.room_id, "ts": now}
+        else:
+            logger.info(f"Room alias \"{alias}\" could not be resolved. "
+                        "Messages to this room are being dropped and "
+                        f"NOT sent. Response is: {resp}")
+    write_room_alias_cache(store_dir, cache)
+    return resolved
+
+
+def unescape_room(room) -> str:
+    """Remove the shell escape of a room given with --room, e.g. "\\!"."""
+    room = room.replace(r'\!', '!')  # remove possible escape
+    return room.replace(r'\#', '#')  # remove possible escape
+
+
+async def determine_rooms(client, room_id, store_dir) -> list:
     """Determine the room to send to.
 
     Arguments:
     ---------
+    client : Client
     room_id : room from credentials file
+    store_dir : str
+        location of persistent storage store directory,
+        used to cache resolved room aliases
 
     Look at room from credentials file and at rooms from command line
     and prepares a definite list of rooms.
 
-    Return list of rooms to send to. Returned list is never empty.
+    Rooms can be given as room id (e.g. "!SomeRoomIdString:example.org")
+    or as room alias (e.g. "#someroomalias:example.org"). Room aliases
+    are resolved into room ids, see resolve_room_aliases().
+
+    Return list of room ids to send to. Returned list is empty only
+    if none of the given room aliases could be resolved.
 
     """
     if not pargs.room:
         logger.debug("Room id was provided via credentials file. "
                      "No rooms given in commans line.  "
-                     f"Setting rooms to \"{room_id}\".")
-        return [room_id]  # list of 1
+                     "Setting rooms to \"%s\".", room_id)
+        rooms = [room_id]  # list of 1
     else:
-        rooms = []
-        for room in pargs.room:
-            room_id = room.replace(r'\!', '!')  # remove possible escape
-            rooms.append(room_id)
+        rooms = [unescape_room(room) for room in pargs.room]
         logger.debug("Room(s) were provided via command line. "
                      "Overwriting room id from credentials file "
-                     f"with rooms \"{rooms}\" "
-                     "from command line.")
+                     "with rooms \"%s\" "
+                     "from command line.", rooms)
+    aliases = [room for room in rooms if room.startswith("#")]
+    if not aliases:
         return rooms
+    resolved = await resolve_room_aliases(client, aliases, store_dir)
+    room_ids = []
+    for room in rooms:
+        if room.startswith("#"):
+            if room in resolved:
+                room_ids.append(resolved[room])
+        else:
+            room_ids.append(room)
+    return room_ids
 
 
-async def send_file(client, rooms, file):
-    """Process file.
+def parse_config_file(config_file) -> dict:
+    """Parse the config file and return its content as dictionary.
 
-    Upload file to server and then send link to rooms.
-    Works and tested for .pdf, .txt, .ogg, .wav.
-    All these file types are treated the same.
+    The format is derived from the file extension: ".yaml" or ".yml"
+    for YAML, ".toml" for TOML and ".json" for JSON.
 
     Arguments:
     ---------
-    client : Client
-    rooms : list
-        list of room_id-s
-    file : str
-        file name of file from --file argument
+    config_file : str
+        name/path of config file
 
-    This is a working example for a PDF file.
-    It can be viewed or downloaded from:
-    https://matrix.example.com/_matrix/media/r0/download/
-        example.com/SomeStrangeUriKey # noqa
-    {
-        "type": "m.room.message",
-        "sender": "@someuser:example.com",
-        "content": {
-            "body": "example.pdf",
-            "info": {
-                "size": 6301234,
-                "mimetype": "application/pdf"
-                },
-            "msgtype": "m.file",
-            "url": "mxc://example.com/SomeStrangeUriKey"
-        },
-        "origin_server_ts": 1595100000000,
-        "unsigned": {
-            "age": 1000,
-            "transaction_id": "SomeTxId01234567"
-        },
-        "event_id": "$SomeEventId01234567789Abcdef012345678",
-        "room_id": "!SomeRoomId:example.com"
-    }
+    """
+    ext = os.path.splitext(config_file)[1].lower()
+    if ext in (".yaml", ".yml"):
+        if yaml is None:
+            raise ValueError("Python package pyyaml must be installed "
+                             "to read YAML config files.")
+        with open(config_file, "r") as f:
+            try:
+                return yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ValueError(f"Config file \"{config_file}\" is not "
+                                 f"valid YAML. {e}")
+    if ext == ".toml":
+        if tomllib is None:
+            raise ValueError("Python package tomli must be installed "
+                             "to read TOML config files.")
+        with open(config_file, "rb") as f:
+            return tomllib.load(f)
+    if ext == ".json":
+        with open(config_file, "r") as f:
+            return json.load(f)
+    raise ValueError(f"Config file \"{config_file}\" has an unknown "
+                     "extension. Use .yaml, .yml, .toml or .json.")
+
+
+def compile_config_profile(name, profile) -> dict:
+    """Compile one profile of the config file.
+
+    The profile is validated and converted into a dictionary mapping
+    argument names (as used in pargs) to their values, so that it can
+    later be applied to the arguments without any further processing.
+
+    Arguments:
+    ---------
+    name : str
+        name of profile, used in error messages
+    profile : dict
+        profile as read from config file
 
     """
-    if not rooms:
-        logger.info("No rooms are given. This should not happen. "
-                    "This file is being droppend and NOT sent.")
-        return
-    if not os.path.isfile(file):
-        logger.debug(f"File {file} is not a file. Doesn't exist or "
-                     "is a directory."
-                     "This file is being droppend and NOT sent.")
-        return
+    if not isinstance(profile, dict):
+        raise ValueError(f"Profile \"{name}\" must be a mapping.")
+    unknown = set(profile) - set(CONFIG_PROFILE_KEYS)
+    if unknown:
+        raise ValueError(f"Profile \"{name}\" has unknown keys "
+                         f"{sorted(unknown)}. Allowed keys are "
+                         f"{list(CONFIG_PROFILE_KEYS)}.")
+    compiled = {}
+    for key in ("room", "message", "image", "audio", "file"):
+        if key in profile:
+            value = profile[key]
+            if isinstance(value, str):
+                value = [value]
+            if not (isinstance(value, list) and
+                    all(isinstance(v, str) for v in value)):
+                raise ValueError(f"Profile \"{name}\": \"{key}\" must be "
+                                 "a string or a list of strings.")
+            compiled[key] = value
+    for key in ("split", "template", "credentials", "store"):
+        if key in profile:
+            if not isinstance(profile[key], str):
+                raise ValueError(f"Profile \"{name}\": \"{key}\" must be "
+                                 "a string.")
+            compiled[key] = profile[key]
+    if "notice" in profile:
+        if not isinstance(profile["notice"], bool):
+            raise ValueError(f"Profile \"{name}\": \"notice\" must be "
+                             "true or false.")
+        compiled["notice"] = profile["notice"]
+    if "format" in profile:
+        fmt = str(profile["format"]).lower()
+        if fmt not in CONFIG_FORMATS:
+            raise ValueError(f"Profile \"{name}\": \"format\" must be one "
+                             f"of {list(CONFIG_FORMATS)}.")
+        for f in CONFIG_FORMATS[1:]:  # "text" is the absence of all flags
+            compiled[f] = (f == fmt)
+    return compiled
+
+
+def load_compiled(source_file, kind, compile_source, version=0):
+    """Load a source file, e.g. the config file, in compiled form.
+
+    Parsing YAML, TOML or markdown is comparatively slow. So the
+    compiled form is pickled into CACHE_DIR and kept in memory. Both
+    are keyed by path, size and modification time of the source file
+    and are used as long as the source file does not change. Hence, a
+    warm run only does one stat of the source file and one unpickling,
+    long running modes only the stat.
 
-    # # restrict to "txt", "pdf", "mp3", "ogg", "wav", ...
-    # if not re.match("^.pdf$|^.txt$|^.doc$|^.xls$|^.mobi$|^.mp3$",
-    #                os.path.splitext(file)[1].lower()):
-    #    logger.debug(f"File {file} is not a permitted file type. Should be "
-    #                 ".pdf, .txt, .doc, .xls, .mobi or .mp3 ... "
-    #                 f"[{os.path.splitext(file)[1].lower()}]"
-    #                 "This file is being droppend and NOT sent.")
-    #    return
+    Arguments:
+    ---------
+    source_file : str
+        name/path of source file
+    kind : str
+        e.g. "config", used in the name of the pickle and in messages
+    compile_source : function
+        called with the absolute path of the source file, returns the
+        compiled form, which must be picklable
+    version : int
+        version of the compiled form, compiled forms of other versions
+        are not used
 
-    # 'application/pdf' "plain/text" "audio/ogg"
-    mime_type = magic.from_file(file, mime=True)
-    # if ((not mime_type.startswith("application/")) and
-    #        (not mime_type.startswith("plain/")) and
-    #        (not mime_type.startswith("audio/"))):
-    #    logger.debug(f"File {file} does not have an accepted mime type. "
-    #                 "Should be something like application/pdf. "
-    #                 f"Found mime type {mime_type}. "
-    #                 "This file is being droppend and NOT sent.")
-    #    return
+    """
+    source_file = os.path.abspath(source_file)
+    st = os.stat(source_file)
+    key = (source_file, st.st_size, st.st_mtime_ns, version)
+    cached = compiled_cache.get((kind, source_file))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    cache_file = os.path.join(
+        CACHE_DIR, f"{kind}-" +
+        re.sub(r"[^A-Za-z0-9_.-]", "_", source_file.strip(os.sep)) +
+        ".pickle")
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, compiled = pickle.load(f)
+        if cached_key == key:
+            logger.debug("Using compiled %s from \"%s\".", kind, cache_file)
+            compiled_cache[(kind, source_file)] = (key, compiled)
+            return compiled
+    except FileNotFoundError:
+        pass
+    except Exception:
+        logger.debug("Compiled %s \"%s\" is unusable. "
+                     "The %s file will be parsed again.",
+                     kind, cache_file, kind)
 
-    # first do an upload of file
-    # see https://matrix-nio.readthedocs.io/en/latest/nio.html#nio.AsyncClient.upload # noqa
-    # then send URI of upload to room
+    logger.debug("Parsing %s file \"%s\".", kind, source_file)
+    compiled = compile_source(source_file)
+    compiled_cache[(kind, source_file)] = (key, compiled)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                          0o600), "wb") as f:
+            pickle.dump((key, compiled), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        logger.debug("Compiled %s could not be written to "
+                     "\"%s\". The %s file will be parsed "
+                     "again next time.", kind, cache_file, kind)
+    return compiled
+
+
+def compile_config_file(config_file) -> dict:
+    """Parse the config file and compile all its profiles.
 
-    file_stat = await aiofiles.os.stat(file)
-    async with aiofiles.open(file, "r+b") as f:
-        resp, maybe_keys = await client.upload(
-            f,
-            content_type=mime_type,  # application/pdf
-            filename=os.path.basename(file),
-            filesize=file_stat.st_size)
-    if (isinstance(resp, UploadResponse)):
-        logger.debug("File was uploaded successfully to server. "
-                     f"Response is: {resp}")
-    else:
-        logger.info(f"The program {PROG_WITH_EXT} failed to upload. "
-                    "Please retry. This could be temporary issue on "
-                    "your server. "
-                    "Sorry.")
-        logger.info(f"file=\"{file}\"; mime_type=\"{mime_type}\"; "
-                    f"filessize=\"{file_stat.st_size}\""
-                    f"Failed to upload: {resp}")
+    Arguments:
+    ---------
+    config_file : str
+        name/path of config file
 
-    content = {
-        "body": os.path.basename(file),  # descriptive title
-        "info": {
-            "size": file_stat.st_size,
-            "mimetype": mime_type,
-        },
-        "msgtype": "m.file",
-        "url": resp.content_uri,
+    """
+    config = parse_config_file(config_file)
+    if not isinstance(config, dict):
+        raise ValueError(f"Config file \"{config_file}\" must contain "
+                         "a mapping.")
+    profiles = config.get("profiles", {})
+    if not isinstance(profiles, dict):
+        raise ValueError("\"profiles\" in config file must be a mapping.")
+    return {
+        "profiles": {str(name): compile_config_profile(name, profile)
+                     for name, profile in profiles.items()},
+        "default_profile": config.get("default_profile"),
     }
 
-    try:
-        for room_id in rooms:
-            await client.room_send(
-                room_id,
-                message_type="m.room.message",
-                content=content
-            )
-            logger.debug(f"This file was sent: \"{file}\" "
-                         f"to room \"{room_id}\".")
-    except Exception:
-        logger.debug(f"File send of file {file} failed. "
-                     "Sorry. Here is the traceback.")
-        logger.debug(traceback.format_exc())
 
+def load_config_file(config_file) -> dict:
+    """Load the config file in compiled form, see load_compiled().
 
-async def send_image(client, rooms, image):
-    """Process image.
+    Arguments:
+    ---------
+    config_file : str
+        name/path of config file
+
+    Returns a dictionary with the keys "profiles" (dictionary mapping
+    profile names to compiled profiles) and "default_profile"
+    (name of profile or None).
+
+    """
+    return load_compiled(config_file, "config", compile_config_file)
+
+
+def apply_config_profile(parser) -> None:
+    """Apply the selected profile of the config file to pargs.
+
+    Arguments given on the command line take precedence over
+    the values of the profile.
 
     Arguments:
     ---------
-    client : Client
-    rooms : list
-        list of room_id-s
-    image : str
-        file name of image from --image argument
+    parser : ArgumentParser
+        parser of the command line, used to find default values
 
-    This is a working example for a JPG image.
-    It can be viewed or downloaded from:
-    https://matrix.example.com/_matrix/media/r0/download/
-        example.com/SomeStrangeUriKey # noqa
-    {
-        "type": "m.room.message",
-        "sender": "@someuser:example.com",
+    """
+    config_file = pargs.config or CONFIG_FILE_DEFAULT
+    config = load_config_file(config_file)
+    name = pargs.profile or config["default_profile"]
+    if not name:
+        logger.debug("Config file \"%s\" was read, but "
+                     "no profile was selected.", config_file)
+        return
+    if name not in config["profiles"]:
+        raise ValueError(f"Profile \"{name}\" not found in config file "
+                         f"\"{config_file}\". Available profiles are "
+                         f"{sorted(config['profiles'])}.")
+    profile = config["profiles"][name]
+    format_given = pargs.html or pargs.markdown or pargs.code
+    for key, value in profile.items():
+        if key in CONFIG_FORMATS:
+            if not format_given:
+                setattr(pargs, key, value)
+        elif key == "notice":
+            pargs.notice = pargs.notice or value
+        elif getattr(pargs, key) in (None, parser.get_default(key)):
+            setattr(pargs, key, value)
+    logger.debug("Profile \"%s\" from config file "
+                 "\"%s\" was applied: %s", name, config_file, profile)
+
+
+def compile_template(template_file) -> dict:
+    """Compile a template of --template.
+
+    A template is text with variables in the syntax of Python's
+    str.format(), e.g. "{host} is {status}" or
+    "{labels[severity]:>8}". The template is split into literal text
+    and fields once, so rendering is only a join. For markdown the
+    template is converted to HTML once, with a token standing in for
+    every variable, so that messages rendered from it need no markdown
+    conversion.
+
+    Arguments:
+    ---------
+    template_file : str
+        name/path of template file
+
+    A variable inside an HTML tag, e.g. "<{url}>", could inject markup
+    and is refused for "markdown" and "html". Only variables in text
+    and in quoted attribute values are escaped safely.
+
+    Returns a dictionary with the keys "fields" (list of tuples of
+    field name, conversion and format spec), "text" and "markdown"
+    (lists of tuples of literal text and index into fields or None),
+    and "errors" (dictionary mapping "markdown" and "html" to the
+    reason why the template cannot be used for the format, or None).
+
+    """
+    with open(template_file, "r") as f:
+        source = f.read()
+    fields = []
+    text = []
+    try:
+        for literal, field, spec, conversion in (
+                string.Formatter().parse(source)):
+            if field is None:
+                text.append((literal, None))
+                continue
+            if field == "" or field[0].isdigit():
+                raise ValueError("variables must be referred to by name, "
+                                 f"not by \"{{{field}}}\"")
+            if "{" in (spec or ""):
+                raise ValueError(f"nested fields in \"{{{field}:{spec}}}\" "
+                                 "are not supported")
+            text.append((literal, len(fields)))
+            fields.append((field, conversion, spec))
+    except ValueError as e:
+        raise ValueError(f"Template \"{template_file}\" is invalid, {e}.")
+    tokenized = "".join(
+        literal + (TEMPLATE_FIELD_TOKEN.format(index)
+                   if index is not None else "")
+        for literal, index in text)
+    converted = markdown(tokenized)
+    pieces = re.split(TEMPLATE_FIELD_TOKEN.format(r"(\d+)"), converted)
+    # pieces alternate between literal HTML and field index
+    markdown_parts = [(pieces[i], int(pieces[i + 1])
+                       if i + 1 < len(pieces) else None)
+                      for i in range(0, len(pieces), 2)]
+    errors = {}
+    for msg_format, markup in (("markdown", converted), ("html", tokenized)):
+        field = template_field_in_tag(markup)
+        errors[msg_format] = None if field is None else (
+            f"Template \"{template_file}\" has the variable "
+            f"\"{{{fields[field][0]}}}\" inside an HTML tag, it cannot be "
+            f"used for the format \"{msg_format}\".")
+    return {"fields": fields, "text": text, "markdown": markdown_parts,
+            "errors": errors}
+
+
+def template_field_in_tag(markup) -> int:
+    """Return the index of the first field inside an HTML tag, or None.
+
+    A field in a quoted attribute value, e.g. the URL of a markdown
+    link, is not inside the tag, its value is escaped like text.
+
+    Arguments:
+    ---------
+    markup : str
+        HTML with a token for every field, see TEMPLATE_FIELD_TOKEN
+
+    """
+    state = "text"
+    for match in re.finditer("[<>\"']|" +
+                             TEMPLATE_FIELD_TOKEN.format(r"(\d+)"), markup):
+        char = match.group(0)
+        if match.group(1) is not None:
+            if state == "tag":
+                return int(match.group(1))
+        elif state == "text":
+            if char == "<":
+                state = "tag"
+        elif state == "tag":
+            if char == ">":
+                state = "text"
+            elif char in "\"'":
+                state = char  # inside a quoted attribute value
+        elif char == state:
+            state = "tag"
+    return None
+
+
+def template_file(name) -> str:
+    """Return the file of template name given with --template.
+
+    The name is a path, or the name of a file in TEMPLATE_DIR.
+
+    """
+    if os.path.isfile(name) or os.sep in name:
+        return name
+    return os.path.join(TEMPLATE_DIR, name)
+
+
+def payload_template_file(name) -> str:
+    """Return the file of template name given in a --webhook payload.
+
+    Payloads may only name a file in TEMPLATE_DIR, anything that looks
+    like a path is refused. Otherwise anyone who can reach the webhook
+    could send any readable file to a room.
+
+    Raises ValueError if name is not a plain file name.
+
+    """
+    if not re.fullmatch(r"[A-Za-z0-9_][A-Za-z0-9_.-]*", name):
+        raise ValueError("\"template\" must be the name of a file in "
+                         f"\"{TEMPLATE_DIR}\", not a path.")
+    return os.path.join(TEMPLATE_DIR, name)
+
+
+def render_template(name, variables, msg_format) -> (str, str):
+    """Render a message from a template of --template.
+
+    Arguments:
+    ---------
+    name : str
+        name of template, see template_file()
+    variables : str
+        JSON object with the values of the variables
+    msg_format : str
+        one of "code", "markdown", "html" or "text"
+
+    Returns the message and, for "markdown" and "html", the formatted
+    message, i.e. the HTML, else None. Values of variables are not
+    interpreted as markdown or HTML, they are escaped in the HTML.
+    Raises OSError if the template cannot be read and ValueError if
+    the template or variables are invalid.
+
+    """
+    compiled = load_compiled(template_file(name), "template",
+                             compile_template, TEMPLATE_COMPILER_VERSION)
+    if compiled["errors"].get(msg_format):
+        raise ValueError(compiled["errors"][msg_format])
+    variables = json.loads(variables)
+    if not isinstance(variables, dict):
+        raise ValueError("Template variables must be a JSON object.")
+    formatter = string.Formatter()
+    values = []
+    for field, conversion, spec in compiled["fields"]:
+        try:
+            value = formatter.get_field(field, (), variables)[0]
+        except (KeyError, IndexError, AttributeError, TypeError):
+            raise ValueError(f"Template variable \"{field}\" is missing.")
+        values.append(format(formatter.convert_field(value, conversion),
+                             spec or ""))
+    message = "".join(literal + (values[index] if index is not None else "")
+                      for literal, index in compiled["text"])
+    if msg_format == "markdown":
+        parts = compiled["markdown"]
+    elif msg_format == "html":
+        parts = compiled["text"]
+    else:
+        return message, None
+    escaped = [html.escape(value) for value in values]
+    return message, "".join(
+        literal + (escaped[index] if index is not None else "")
+        for literal, index in parts)
+
+
+@functools.lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
+def markdown_to_html(message) -> str:
+    """Convert markdown to HTML, repeated messages only once."""
+    return markdown(message)
+
+
+@functools.lru_cache(maxsize=None)
+def code_lexer(language):
+    """Return the pygments lexer of language, or None.
+
+    The lexer is looked up once per process and language.
+
+    """
+    if pygments is None:
+        return None
+    try:
+        # keep newlines as they are, the HTML must match the message
+        return pygments.lexers.get_lexer_by_name(
+            language, stripnl=False, ensurenl=False)
+    except pygments.util.ClassNotFound:
+        logger.debug("Pygments has no lexer for language \"%s\". "
+                     "The code is not highlighted.", language)
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def code_token_color(token_type) -> str:
+    """Return the color of a pygments token type, e.g. "#008000", or None.
+
+    The colors are taken from CODE_HIGHLIGHT_STYLE, once per process
+    and token type.
+
+    """
+    style = pygments.styles.get_style_by_name(CODE_HIGHLIGHT_STYLE)
+    color = style.style_for_token(token_type)["color"]
+    return f"#{color}" if color else None
+
+
+def highlight_code(message, lexer) -> str:
+    """Highlight code with pygments, return the HTML or None if too large.
+
+    Adjacent tokens of the same color share one <font> element.
+
+    """
+    pieces = []
+    run_color = None
+    run = []
+    for token_type, value in lexer.get_tokens(message):
+        color = code_token_color(token_type)
+        if color != run_color and not value.isspace():
+            if run:
+                pieces.append((run_color, "".join(run)))
+            run_color = color
+            run = []
+        run.append(value)
+    if run:
+        pieces.append((run_color, "".join(run)))
+    code = "".join(
+        f'<font color="{color}">{html.escape(text, quote=False)}</font>'
+        if color else html.escape(text, quote=False)
+        for color, text in pieces)
+    if len(code) + len(message) > CODE_HIGHLIGHT_MAX_SIZE:
+        logger.debug("Highlighted code is too large, the code is not "
+                     "highlighted.")
+        return None
+    return code
+
+
+def code_to_html(message, language) -> str:
+    """Convert a message into HTML for the format "code".
+
+    The message is escaped and wrapped in <pre><code>. With a language
+    the <code> element gets the class "language-xxx", so that clients
+    can highlight the code themselves. If pygments is installed and
+    knows the language, the code is also highlighted with <font color>,
+    the only way of coloring text that Matrix clients accept, see
+    highlight_code(). Messages larger than CODE_HIGHLIGHT_MAX_SIZE are
+    not lexed at all, code that would get larger than that is not
+    highlighted. The highlighting of the last CODE_CACHE_SIZE messages
+    is kept in code_cache, keyed by a hash of message and language, so
+    repeated messages are lexed only once.
+
+    Arguments:
+    ---------
+    message : str
+        message to send, without mime formatting
+    language : str
+        name of the language, e.g. "python", or None
+
+    """
+    lexer = code_lexer(language) if language else None
+    code = None
+    if lexer is not None and len(message) <= CODE_HIGHLIGHT_MAX_SIZE:
+        key = (hashlib.sha256(message.encode(
+            "utf-8", "surrogateescape")).digest(), language)
+        if key in code_cache:
+            code_cache.move_to_end(key)
+            code = code_cache[key]
+        else:
+            code = highlight_code(message, lexer)
+            code_cache[key] = code  # None if too large, also remembered
+            if len(code_cache) > CODE_CACHE_SIZE:
+                code_cache.popitem(last=False)
+    elif lexer is not None:
+        logger.debug("Code is too large, the code is not highlighted.")
+    if code is None:
+        code = html.escape(message, quote=False)
+    if not language:
+        return f"<pre><code>{code}</code></pre>"
+    return (f'<pre><code class="language-{html.escape(language)}">'
+            f"{code}</code></pre>")
+
+
+def mmap_chunks(mm):
+    """Yield the content of a memory map as memoryviews, without copies."""
+    view = memoryview(mm)
+    try:
+        for offset in range(0, len(view), UPLOAD_CHUNK_SIZE):
+            yield view[offset:offset + UPLOAD_CHUNK_SIZE]
+    finally:
+        view.release()
+
+
+async def upload_data(client, data_provider, mime_type, filename, size):
+    """Upload data to the content repository of the server.
+
+    All uploads go through here, so that they are measured for
+    --timings and --metrics in one place. The number of uploads in
+    flight is limited by upload_limiter.
+
+    Arguments:
+    ---------
+    client : Client
+    data_provider : object
+        passed on to client.upload(), e.g. a file object or a callable
+        returning an iterable of chunks
+    mime_type : str
+        e.g. "application/pdf"
+    filename : str
+        name of the file, without directory
+    size : int
+        exact number of bytes that will be uploaded
+
+    Returns UploadResponse or UploadError.
+
+    """
+    start = await upload_limiter.acquire()
+    congested = None
+    try:
+        with timings.phase("upload"):
+            resp, maybe_keys = await client.upload(
+                data_provider,
+                content_type=mime_type,
+                filename=filename,
+                filesize=size)
+        congested = (getattr(resp, "status_code", None) ==
+                     "M_LIMIT_EXCEEDED")
+    except (asyncio.TimeoutError, ClientConnectionError):
+        congested = True
+        raise
+    finally:
+        upload_limiter.release(start, congested)
+    metrics.upload_latency.observe(time.perf_counter() - start)
+    if isinstance(resp, UploadResponse):
+        metrics.upload_bytes.inc(size)
+    return resp
+
+
+async def upload_file(client, file, mime_type, file_stat):
+    """Upload a local file to the content repository of the server.
+
+    Regular files are memory mapped and handed to the HTTP connection
+    in large chunks straight from the page cache, without reading them
+    through a thread and copying every chunk. Reading a mapped file
+    that was truncated in the meantime kills the process with SIGBUS,
+    so only files that are unchanged since file_stat and that have not
+    been modified for UPLOAD_MMAP_MIN_AGE seconds are mapped, and none
+    with --watch, --webhook or --scheduler, where files may be written
+    while they are sent. All other files, e.g. empty files, pipes or
+    files on file systems without mmap support, are read in chunks
+    with aiofiles. Files are opened read-only, so no write permission
+    is needed.
+
+    Arguments:
+    ---------
+    client : Client
+    file : str
+        file name of file to upload
+    mime_type : str
+        e.g. "application/pdf"
+    file_stat : os.stat_result
+        stat of the file, its size is the size of the upload
+
+    Returns UploadResponse or UploadError.
+
+    """
+    filesize = file_stat.st_size
+    mm = None
+    if not (pargs.watch or pargs.webhook or pargs.scheduler):
+        with open(file, "rb") as f:
+            try:
+                st = os.fstat(f.fileno())
+                if (stat.S_ISREG(st.st_mode) and filesize and
+                        st.st_size == filesize and
+                        st.st_mtime_ns == file_stat.st_mtime_ns and
+                        time.time() - st.st_mtime > UPLOAD_MMAP_MIN_AGE):
+                    mm = mmap.mmap(f.fileno(), filesize,
+                                   access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                logger.debug("File %s cannot be memory mapped.", file)
+    if mm is not None:
+        if hasattr(mm, "madvise"):  # Python 3.8+, not on Windows
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+
+        def data_provider(got_429, got_timeouts):
+            # called again for a retry, which starts from the beginning
+            return mmap_chunks(mm)
+
+        try:
+            return await upload_data(client, data_provider, mime_type,
+                                     os.path.basename(file), len(mm))
+        finally:
+            try:
+                mm.close()
+            except BufferError:  # a chunk is still referenced
+                pass  # the map is closed when it is garbage collected
+    async with aiofiles.open(file, "rb") as f:
+        return await upload_data(client, f, mime_type,
+                                 os.path.basename(file), filesize)
+
+
+def is_archive_path(path) -> bool:
+    """Return True if --file path is a directory or a glob pattern."""
+    if os.path.isdir(path):
+        return True
+    return not os.path.exists(path) and glob.has_magic(path)
+
+
+def archive_members(path) -> (str, list):
+    """Collect the files to put into the archive of a directory or glob.
+
+    A directory is walked recursively, its name is the top directory
+    in the archive. A glob pattern may use "**" for any number of
+    directories, matched directories are walked recursively as well.
+    Names in the archive are relative to the directory that the
+    pattern starts with. Symbolic links are stored as links.
+
+    Arguments:
+    ---------
+    path : str
+        directory or glob pattern given with --file
+
+    Returns the name of the archive without extension and a sorted
+    list of (path of file, name in archive).
+
+    """
+    if os.path.isdir(path):
+        base = os.path.dirname(os.path.abspath(path))
+        tops = [path]
+        name = os.path.basename(os.path.abspath(path))
+    else:
+        # leading directories without wildcards
+        parts = []
+        for part in path.split(os.sep):
+            if glob.has_magic(part):
+                break
+            parts.append(part)
+        base = os.path.abspath(os.sep.join(parts) or os.curdir)
+        tops = glob.glob(path, recursive=True)
+        name = os.path.basename(base) or "files"
+    members = {}
+    for top in tops:
+        top = os.path.abspath(top)
+        members[top] = os.path.relpath(top, base)
+        if os.path.isdir(top) and not os.path.islink(top):
+            for root, dirs, files in os.walk(top):
+                for entry in dirs + files:
+                    file = os.path.join(root, entry)
+                    members[file] = os.path.relpath(file, base)
+    return name, sorted(members.items(), key=lambda m: m[1])
+
+
+def archive_entries(members) -> list:
+    """Create the tar headers of the members of an archive.
+
+    Files that cannot be read or that are neither regular files,
+    directories nor symbolic links are left out. The size of every
+    file is fixed here, so the size of a tar archive is known before it
+    is created, see tar_size().
+
+    Arguments:
+    ---------
+    members : list
+        list of (path of file, name in archive), see archive_members()
+
+    Returns list of (path of file, TarInfo).
+
+    """
+    # only used to create TarInfo objects, nothing is written to it
+    tar = tarfile.open(fileobj=open(os.devnull, "wb"), mode="w",
+                       format=tarfile.PAX_FORMAT)
+    entries = []
+    for file, arcname in members:
+        try:
+            tarinfo = tar.gettarinfo(file, arcname)
+        except OSError as e:
+            logger.info(f"File {file} cannot be put into the archive "
+                        f"and is left out. {e}")
+            continue
+        if tarinfo is None or not (tarinfo.isreg() or tarinfo.isdir() or
+                                   tarinfo.issym() or tarinfo.islnk()):
+            logger.debug("File %s is not a regular file, directory "
+                         "or link and is left out of the archive.", file)
+            continue
+        entries.append((file, tarinfo))
+    tar.fileobj.close()
+    return entries
+
+
+def tar_header(tarinfo) -> bytes:
+    """Return the header blocks of a tar member, as tarfile writes them."""
+    return tarinfo.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING,
+                         "surrogateescape")
+
+
+def tar_size(entries) -> int:
+    """Return the size of the tar archive of the entries in bytes.
+
+    Every member is its header blocks and its data padded to full
+    blocks. The archive ends with two empty blocks and is padded to a
+    full record, like tarfile does.
+
+    Arguments:
+    ---------
+    entries : list
+        list of (path of file, TarInfo), see archive_entries()
+
+    """
+    size = 2 * tarfile.BLOCKSIZE
+    for file, tarinfo in entries:
+        size += len(tar_header(tarinfo))
+        if tarinfo.isreg():
+            size += -(-tarinfo.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+    return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def tar_data(entries):
+    """Yield the tar archive of the entries in pieces.
+
+    Every file must still have the size in its header, so that the
+    archive has the size computed by tar_size(). Raises OSError if a
+    file cannot be read or its size changed since archive_entries().
+
+    Arguments:
+    ---------
+    entries : list
+        list of (path of file, TarInfo), see archive_entries()
+
+    """
+    offset = 0
+    for file, tarinfo in entries:
+        header = tar_header(tarinfo)
+        offset += len(header)
+        yield header
+        if not tarinfo.isreg() or not tarinfo.size:
+            continue
+        left = tarinfo.size
+        with open(file, "rb") as f:
+            while left:
+                chunk = f.read(min(left, UPLOAD_CHUNK_SIZE))
+                if not chunk:
+                    break
+                left -= len(chunk)
+                yield chunk
+            if left or f.read(1):
+                raise OSError(f"File {file} changed its size while it "
+                              "was archived.")
+        padding = -tarinfo.size % tarfile.BLOCKSIZE
+        offset += tarinfo.size + padding
+        if padding:
+            yield bytes(padding)
+    end = 2 * tarfile.BLOCKSIZE
+    yield bytes(end + -(offset + end) % tarfile.RECORDSIZE)
+
+
+def gzip_pieces(pieces):
+    """Yield the pieces compressed as one gzip stream."""
+    # wbits 31 writes a gzip header with mtime 0, so the same pieces
+    # always give the same bytes
+    compressor = zlib.compressobj(ARCHIVE_COMPRESSION_LEVEL, zlib.DEFLATED,
+                                  31)
+    for piece in pieces:
+        yield compressor.compress(piece)
+    yield compressor.flush()
+
+
+def archive_data(entries, archive_format):
+    """Yield the archive of the entries in chunks of UPLOAD_CHUNK_SIZE.
+
+    Arguments:
+    ---------
+    entries : list
+        list of (path of file, TarInfo), see archive_entries()
+    archive_format : str
+        one of ARCHIVE_FORMATS
+
+    """
+    pieces = tar_data(entries)
+    if archive_format == "tar.gz":
+        pieces = gzip_pieces(pieces)
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) >= UPLOAD_CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+def archive_size(entries, archive_format) -> int:
+    """Return the size of the archive of the entries in bytes.
+
+    The content repository needs the size before the upload starts.
+    For "tar" it is computed from the headers. For "tar.gz" the
+    archive is compressed once only to count its bytes, which reads
+    all files twice, but needs neither memory nor a temporary file.
+    If a file changes in between, the second archive has a different
+    size and the upload fails, see archive_chunks().
+
+    """
+    if archive_format == "tar":
+        return tar_size(entries)
+    return sum(len(chunk) for chunk in archive_data(entries, archive_format))
+
+
+def write_archive(entries, archive_format):
+    """Write the archive of the entries to a temporary file.
+
+    Used with --archive-temp-file for compressed archives, whose size
+    is only known once they are created. The files are then read and
+    compressed once, at the cost of disk space for the whole archive.
+    The file is deleted when it is closed.
+
+    Arguments:
+    ---------
+    entries : list
+        list of (path of file, TarInfo), see archive_entries()
+    archive_format : str
+        one of ARCHIVE_FORMATS
+
+    Returns the temporary file, positioned at its end.
+
+    """
+    f = tempfile.TemporaryFile(prefix=f"{PROG_WITHOUT_EXT}-")
+    try:
+        for chunk in archive_data(entries, archive_format):
+            f.write(chunk)
+    except BaseException:
+        f.close()
+        raise
+    return f
+
+
+async def file_chunks(f):
+    """Yield the content of an open file in chunks, read in a thread."""
+    loop = asyncio.get_running_loop()
+    f.seek(0)
+    while True:
+        chunk = await loop.run_in_executor(None, f.read, UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def archive_chunks(entries, archive_format, size):
+    """Yield the archive of the entries, created in a producer thread.
+
+    The thread reads the files and compresses while the chunks before
+    are being uploaded. At most ARCHIVE_QUEUE_SIZE chunks are read
+    ahead, so the memory needed does not depend on the size of the
+    files. Raises OSError if the archive does not have the given size,
+    e.g. because a file changed while it was archived.
+
+    Arguments:
+    ---------
+    entries : list
+        list of (path of file, TarInfo), see archive_entries()
+    archive_format : str
+        one of ARCHIVE_FORMATS
+    size : int
+        size of the archive computed by archive_size()
+
+    """
+    chunks = queue.Queue(maxsize=ARCHIVE_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        data = archive_data(entries, archive_format)
+        try:
+            for chunk in data:
+                if not put(chunk):
+                    break
+            else:
+                put(None)  # end of archive
+                return
+        except Exception as e:
+            put(e)
+            return
+        finally:
+            data.close()
+        try:  # stopped, wake up the consumer if it still waits
+            chunks.put_nowait(None)
+        except queue.Full:
+            pass
+
+    producer = threading.Thread(target=produce, name="archive",
+                                daemon=True)
+    producer.start()
+    loop = asyncio.get_running_loop()
+    sent = 0
+    try:
+        while True:
+            chunk = await loop.run_in_executor(None, chunks.get)
+            if chunk is None:
+                break
+            if isinstance(chunk, Exception):
+                raise chunk
+            sent += len(chunk)
+            if sent > size:
+                break
+            yield chunk
+        if sent != size:
+            raise OSError(f"Archive has {sent} bytes instead of {size}. "
+                          "Were files changed while they were archived?")
+    finally:
+        stop.set()
+
+
+def setup_crypto_executor() -> None:
+    """Create the executor for encryption if --crypto-executor asks for it.
+
+    A single thread is used, so that the olm operations moved into the
+    executor never run concurrently with each other.
+
+    """
+    global crypto_executor
+    if pargs.crypto_executor == "thread":
+        crypto_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="crypto")
+
+
+def setup_concurrency() -> None:
+    """Create the limiters of parallel sends and uploads (--concurrency)."""
+    global send_limiter, upload_limiter
+    limit = None
+    if pargs.concurrency != "adaptive":
+        limit = int(pargs.concurrency)
+    send_limiter = ConcurrencyLimiter("send", limit)
+    upload_limiter = ConcurrencyLimiter("upload", limit, use_latency=False)
+    metrics.send_concurrency.function = send_limiter.allowed
+    metrics.upload_concurrency.function = upload_limiter.allowed
+
+
+async def share_group_session(client, room_id,
+                              ignore_unverified_devices=False):
+    """Share the Megolm session of a room, holding the store briefly.
+
+    Does the same as client.share_group_session(), but the store is
+    held exclusively, see StoreLock, only while the room key is
+    encrypted for every device of the room, which changes the Olm
+    sessions in the store. Claiming one-time keys and sending the
+    to-device messages run without it; their responses take the lock
+    themselves, see lock_store(). If crypto_executor is set, the Olm
+    encryption of the room key and the serialization of the to-device
+    messages are done in the executor.
+
+    Arguments:
+    ---------
+    client : Client
+    room_id : str
+    ignore_unverified_devices : bool
+        passed on to the olm machine
+
+    """
+    start = time.perf_counter()
+    client.sharing_session[room_id] = asyncio.Event()
+    try:
+        missing_sessions = client.get_missing_sessions(room_id)
+        if missing_sessions:
+            await client.keys_claim(missing_sessions)
+        users = list(client.rooms[room_id].users.keys())
+
+        def encrypt_room_key():
+            requests = []
+            for sharing_with, to_device_dict in \
+                    client.olm.share_group_session_parallel(
+                        room_id, users,
+                        ignore_unverified_devices=ignore_unverified_devices):
+                requests.append((sharing_with, Api.to_device(
+                    client.access_token, "m.room.encrypted",
+                    to_device_dict, uuid.uuid4())))
+            return requests
+
+        async with store_lock.exclusive():
+            if crypto_executor:
+                requests = await asyncio.get_running_loop().run_in_executor(
+                    crypto_executor, encrypt_room_key)
+            else:
+                requests = encrypt_room_key()
+        await asyncio.gather(
+            *[client._send(ShareGroupSessionResponse, method, path, data,
+                           response_data=(room_id, sharing_with))
+              for sharing_with, (method, path, data) in requests],
+            return_exceptions=True)
+        # like client.share_group_session(), also needed if there was
+        # no other device to share the session with
+        client.olm.outbound_group_sessions[room_id].shared = True
+    finally:
+        client.sharing_session.pop(room_id).set()
+        metrics.share_group_session_latency.observe(
+            time.perf_counter() - start)
+
+
+async def share_room_key(client, room_id, ignore_unverified_devices):
+    """Share the Megolm session of an encrypted room if needed.
+
+    The members of the room and their devices are fetched first if they
+    are not known yet. Rooms are worked on in parallel, so the members
+    of a room are requested only once at a time, see member_requests,
+    and the device keys are queried one after the other, so that every
+    query includes all users that are not known yet. The store is only
+    held exclusively while the responses are processed and while the
+    room key is encrypted, not while waiting for the server, see
+    share_group_session().
+
+    Arguments:
+    ---------
+    client : Client
+    room_id : str
+    ignore_unverified_devices : bool
+        passed on to the olm machine
+
+    """
+    if not client.rooms[room_id].members_synced:
+        request = member_requests.get(room_id)
+        if request is None:
+            request = asyncio.ensure_future(client.joined_members(room_id))
+            member_requests[room_id] = request
+            request.add_done_callback(
+                lambda _: member_requests.pop(room_id, None))
+        # another job waiting for it must not cancel it
+        await asyncio.shield(request)
+        # rooms are sent to in parallel, query the keys only once
+        async with key_query_lock:
+            if client.should_query_keys:
+                await client.keys_query()
+    if client.olm.should_share_group_session(room_id):
+        sharing = client.sharing_session.get(room_id)
+        if sharing:
+            await sharing.wait()
+        else:
+            await share_group_session(
+                client, room_id, ignore_unverified_devices)
+
+
+async def prewarm_rooms(client, rooms) -> None:
+    """Share the Megolm sessions of the encrypted rooms ahead of time.
+
+    Runs while the messages are still being read from stdin, so that
+    the first message does not wait for the room keys. Messages are
+    sent ignoring unverified devices, see send_message(), so are the
+    room keys.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+
+    """
+    async def prewarm(room_id):
+        room = client.rooms.get(room_id)
+        if client.olm and room is not None and room.encrypted:
+            await share_room_key(client, room_id, True)
+        return True
+
+    with timings.phase("prewarm"):
+        await send_to_rooms(rooms, prewarm, "Sharing the room key failed.")
+
+
+async def room_send_with_txn_id(client, room_id, message_type, content,
+                                tx_id, ignore_unverified_devices=False,
+                                timeout=None):
+    """Send an event with a given transaction ID and request timeout.
+
+    Does the same as client.room_send(). If crypto_executor is set, the
+    Megolm encryption of the event, the sharing of the Megolm session
+    and the serialization of the event to JSON are done in the
+    executor, so that the event loop stays free for other uploads and
+    sends. The timeout only applies to the PUT of the event itself,
+    not to sharing the Megolm session. The number of PUTs in flight is
+    limited by send_limiter. Encryption holds the store exclusively,
+    see StoreLock, sharing the Megolm session only briefly, see
+    share_room_key(). An event for an encrypted room is never sent in
+    plaintext, without encryption support an error is returned.
+
+    Arguments:
+    ---------
+    client : Client
+    room_id : str
+    message_type : str
+    content : dict
+    tx_id : str
+        transaction ID of the PUT /send/{eventType}/{txnId} request
+    ignore_unverified_devices : bool
+        passed on to the olm machine
+    timeout : float
+        seconds, None for the request_timeout of the client
+
+    Returns RoomSendResponse or RoomSendError.
+
+    """
+    room = client.rooms.get(room_id)
+    if room is None:
+        # let room_send() report the unknown room
+        return await client.room_send(
+            room_id, message_type=message_type, content=content,
+            tx_id=tx_id,
+            ignore_unverified_devices=ignore_unverified_devices)
+    if room.encrypted and not client.olm:
+        # never fall back to sending plaintext
+        logger.error("Room \"%s\" is encrypted, but encryption is not "
+                     "available, e.g. libolm is not installed. The event "
+                     "is NOT sent.", room_id)
+        return RoomSendError("Encryption is not available for encrypted "
+                             "room.", room_id=room_id)
+
+    def encrypt_event():
+        # relations must stay visible to the server, e.g. for edits
+        relates_to = content.get("m.relates_to")
+        event_type, event_content = client.encrypt(
+            room_id, message_type,
+            {k: v for k, v in content.items() if k != "m.relates_to"})
+        if relates_to is not None:
+            event_content["m.relates_to"] = relates_to
+        return Api.room_send(client.access_token, room_id, event_type,
+                             event_content, tx_id)
+
+    if client.olm and room.encrypted:
+        while True:
+            await share_room_key(client, room_id, ignore_unverified_devices)
+            # this changes the encryption state
+            async with store_lock.exclusive():
+                # a sync in between may have discarded the session
+                if client.olm.should_share_group_session(room_id):
+                    continue
+                if crypto_executor:
+                    loop = asyncio.get_running_loop()
+                    method, path, data = await loop.run_in_executor(
+                        crypto_executor, encrypt_event)
+                else:
+                    method, path, data = encrypt_event()
+                break
+    else:
+        method, path, data = Api.room_send(
+            client.access_token, room_id, message_type, content, tx_id)
+    start = await send_limiter.acquire()
+    congested = None
+    try:
+        resp = await client._send(RoomSendResponse, method, path, data,
+                                  (room_id,), timeout=timeout)
+        congested = (getattr(resp, "status_code", None) ==
+                     "M_LIMIT_EXCEEDED")
+    except (asyncio.TimeoutError, ClientConnectionError):
+        congested = True
+        raise
+    finally:
+        send_limiter.release(start, congested)
+    return resp
+
+
+def job_transaction_id(job_id, room_id) -> str:
+    """Derive the transaction ID of the event of a job in a room.
+
+    The same job sent to the same room always gets the same
+    transaction ID, so the homeserver can drop the event if it was
+    already sent before, e.g. when the response of an earlier try was
+    lost. Transaction IDs are only unique per access token, i.e. per
+    device.
+
+    Arguments:
+    ---------
+    job_id : str
+        ID of the logical send job, see --job-id
+    room_id : str
+
+    """
+    return hashlib.sha256(
+        f"{job_id}\0{room_id}".encode()).hexdigest()[:32]
+
+
+async def send_room_event(client, room_id, content,
+                          ignore_unverified_devices=False, job_id=None):
+    """Send one m.room.message event to one room.
+
+    All events are sent through here, so that they are measured
+    for --timings and --metrics in one place.
+
+    The event is sent again on a timeout, a connection error or
+    M_LIMIT_EXCEEDED, up to --send-retries times. Every try uses the
+    same transaction ID, so the homeserver sends the event only once,
+    even if the event arrived but the response got lost.
+
+    Arguments:
+    ---------
+    client : Client
+    room_id : str
+    content : dict
+        content of m.room.message event
+    ignore_unverified_devices : bool
+        passed on to room_send()
+    job_id : str
+        ID of the logical send job, the transaction ID is derived from
+        it, see job_transaction_id(). If None a random transaction ID
+        is used.
+
+    Returns RoomSendResponse or RoomSendError. Raises the last
+    exception if the last try timed out or could not connect.
+
+    """
+    if job_id is None:
+        tx_id = str(uuid.uuid4())
+    else:
+        tx_id = job_transaction_id(job_id, room_id)
+    start = time.perf_counter()
+    attempt = 0
+    while True:
+        try:
+            with timings.phase("room_send"):
+                resp = await room_send_with_txn_id(
+                    client, room_id, "m.room.message", content, tx_id,
+                    ignore_unverified_devices=ignore_unverified_devices,
+                    timeout=pargs.send_timeout)
+        except (asyncio.TimeoutError, ClientConnectionError) as e:
+            if attempt >= pargs.send_retries:
+                metrics.send_errors.inc()
+                raise
+            delay = min(SEND_RETRY_BACKOFF * 2 ** attempt,
+                        SEND_RETRY_BACKOFF_MAX)
+            logger.debug("Sending to room \"%s\" failed with %r. Try %s of "
+                         "%s in %.1f seconds, transaction ID %s.", room_id,
+                         e, attempt + 2, pargs.send_retries + 1, delay, tx_id)
+        else:
+            if getattr(resp, "status_code", None) != "M_LIMIT_EXCEEDED":
+                break
+            metrics.rate_limited.inc()
+            if attempt >= pargs.send_retries:
+                break
+            delay = (resp.retry_after_ms or 0) / 1000 or SEND_RETRY_BACKOFF
+            metrics.rate_limit_delay.inc(delay)
+            logger.debug("Sending to room \"%s\" is rate limited. "
+                         "Try %s of %s in %.1f seconds.", room_id,
+                         attempt + 2, pargs.send_retries + 1, delay)
+        attempt += 1
+        with timings.phase("send retry wait"):
+            await asyncio.sleep(delay)
+    metrics.send_latency.observe(time.perf_counter() - start)
+    if isinstance(resp, RoomSendResponse):
+        metrics.events_sent.inc()
+    else:
+        metrics.send_errors.inc()
+    return resp
+
+
+async def send_to_rooms(rooms, send_to_room, failure) -> bool:
+    """Send to all rooms in parallel.
+
+    Up to CONCURRENCY_MAX rooms are worked on at the same time, how
+    many events are actually in flight is decided by send_limiter.
+    The rooms do not wait for each other, so a slow room does not hold
+    back the others.
+
+    Arguments:
+    ---------
+    rooms : list
+        list of room_id-s
+    send_to_room : coroutine function
+        called with a room_id, returns True if it was sent to the room
+    failure : str
+        logged with the traceback if send_to_room raises an exception
+
+    Returns True if it was sent to all rooms, False otherwise.
+
+    """
+    pending = iter(rooms)
+    sent = True
+
+    async def worker():
+        nonlocal sent
+        for room_id in pending:
+            try:
+                if not await send_to_room(room_id):
+                    sent = False
+            except Exception:
+                logger.debug("%s Sorry. Here is the traceback.", failure)
+                logger.debug(traceback.format_exc())
+                sent = False
+
+    workers = min(len(rooms), CONCURRENCY_MAX)
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    return sent
+
+
+async def send_file(client, rooms, file, job_id=None):
+    """Process file.
+
+    Upload file to server and then send link to rooms.
+    Works and tested for .pdf, .txt, .ogg, .wav.
+    All these file types are treated the same.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+    file : str
+        file name of file from --file argument, a directory or glob
+        pattern is sent as archive, see send_archive()
+    job_id : str
+        ID of the send job, see send_room_event()
+
+    Returns True if the file was sent to all rooms, False otherwise.
+
+    This is a working example for a PDF file.
+    It can be viewed or downloaded from:
+    https://matrix.example.com/_matrix/media/r0/download/
+        example.com/SomeStrangeUriKey # noqa
+    {
+        "type": "m.room.message",
+        "sender": "@someuser:example.com",
         "content": {
-            "body": "someimage.jpg",
+            "body": "example.pdf",
             "info": {
-                "size": 5420,
-                "mimetype": "image/jpeg",
-                "thumbnail_info": {
-                    "w": 100,
-                    "h": 100,
-                    "mimetype": "image/jpeg",
-                    "size": 2106
+                "size": 6301234,
+                "mimetype": "application/pdf"
                 },
-                "w": 100,
-                "h": 100,
-                "thumbnail_url": "mxc://example.com/SomeStrangeThumbnailUriKey"
-            },
-            "msgtype": "m.image",
+            "msgtype": "m.file",
             "url": "mxc://example.com/SomeStrangeUriKey"
         },
-        "origin_server_ts": 12345678901234576,
+        "origin_server_ts": 1595100000000,
         "unsigned": {
-            "age": 268
+            "age": 1000,
+            "transaction_id": "SomeTxId01234567"
         },
-        "event_id": "$skdhGJKhgyr548654YTr765Yiy58TYR",
-        "room_id": "!JKHgyHGfytHGFjhgfY:example.com"
+        "event_id": "$SomeEventId01234567789Abcdef012345678",
+        "room_id": "!SomeRoomId:example.com"
     }
 
     """
     if not rooms:
         logger.info("No rooms are given. This should not happen. "
-                    "This image is being droppend and NOT sent.")
-        return
-    if not os.path.isfile(image):
-        logger.debug(f"Image file {image} is not a file. Doesn't exist or "
+                    "This file is being droppend and NOT sent.")
+        return False
+    if is_archive_path(file):
+        return await send_archive(client, rooms, file, job_id)
+    if not os.path.isfile(file):
+        logger.debug("File %s is not a file. Doesn't exist or "
                      "is a directory."
-                     "This image is being droppend and NOT sent.")
-        return
+                     "This file is being droppend and NOT sent.", file)
+        return False
 
-    # "bmp", "gif", "jpg", "jpeg", "png", "pbm", "pgm", "ppm", "xbm", "xpm",
+    # # restrict to "txt", "pdf", "mp3", "ogg", "wav", ...
+    # if not re.match("^.pdf$|^.txt$|^.doc$|^.xls$|^.mobi$|^.mp3$",
+    #                os.path.splitext(file)[1].lower()):
+    #    logger.debug(f"File {file} is not a permitted file type. Should be "
+    #                 ".pdf, .txt, .doc, .xls, .mobi or .mp3 ... "
+    #                 f"[{os.path.splitext(file)[1].lower()}]"
+    #                 "This file is being droppend and NOT sent.")
+    #    return
+
+    # 'application/pdf' "plain/text" "audio/ogg"
+    mime_type = magic.from_file(file, mime=True)
+    # if ((not mime_type.startswith("application/")) and
+    #        (not mime_type.startswith("plain/")) and
+    #        (not mime_type.startswith("audio/"))):
+    #    logger.debug(f"File {file} does not have an accepted mime type. "
+    #                 "Should be something like application/pdf. "
+    #                 f"Found mime type {mime_type}. "
+    #                 "This file is being droppend and NOT sent.")
+    #    return
+
+    # first do an upload of file
+    # see https://matrix-nio.readthedocs.io/en/latest/nio.html#nio.AsyncClient.upload # noqa
+    # then send URI of upload to room
+
+    file_stat = await aiofiles.os.stat(file)
+    resp = await upload_file(client, file, mime_type, file_stat)
+    if (isinstance(resp, UploadResponse)):
+        logger.debug("File was uploaded successfully to server. "
+                     "Response is: %s", resp)
+    else:
+        logger.info(f"The program {PROG_WITH_EXT} failed to upload. "
+                    "Please retry. This could be temporary issue on "
+                    "your server. "
+                    "Sorry.")
+        logger.info(f"file=\"{file}\"; mime_type=\"{mime_type}\"; "
+                    f"filessize=\"{file_stat.st_size}\""
+                    f"Failed to upload: {resp}")
+        return False
+
+    content = {
+        "body": os.path.basename(file),  # descriptive title
+        "info": {
+            "size": file_stat.st_size,
+            "mimetype": mime_type,
+        },
+        "msgtype": "m.file",
+        "url": resp.content_uri,
+    }
+
+    async def send_to_room(room_id):
+        resp = await send_room_event(client, room_id, content,
+                                     job_id=job_id)
+        if not isinstance(resp, RoomSendResponse):
+            logger.info(f"File {file} could not be sent to "
+                        f"room \"{room_id}\". Response is: {resp}")
+            return False
+        logger.debug("This file was sent: \"%s\" to room \"%s\".",
+                     file, room_id)
+        return True
+
+    return await send_to_rooms(rooms, send_to_room,
+                               f"File send of file {file} failed.")
+
+
+async def send_archive(client, rooms, path, job_id=None):
+    """Send a directory or the files matching a glob pattern as archive.
+
+    The archive is created while it is uploaded, see archive_chunks(),
+    without a temporary file, its size is computed beforehand, see
+    archive_size(). With --archive-temp-file a compressed archive is
+    written to a temporary file instead, see write_archive(). The
+    format is set by --archive-format. If a file changes while it is
+    archived, the archive is not sent.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+    path : str
+        directory or glob pattern from --file argument
+    job_id : str
+        ID of the send job, see send_room_event()
+
+    Returns True if the archive was sent to all rooms, False otherwise.
+
+    """
+    archive_format = pargs.archive_format
+    mime_type = ARCHIVE_MIME_TYPES[archive_format]
+
+    def prepare():
+        name, members = archive_members(path)
+        entries = archive_entries(members)
+        if archive_format == "tar" or not pargs.archive_temp_file:
+            return name, entries, None, archive_size(entries,
+                                                     archive_format)
+        f = write_archive(entries, archive_format)
+        return name, entries, f, f.tell()
+
+    archive_file = None
+    try:
+        with timings.phase("archive"):
+            loop = asyncio.get_running_loop()
+            name, entries, archive_file, size = await loop.run_in_executor(
+                None, prepare)
+        if not entries:
+            logger.info(f"No files found for \"{path}\". "
+                        "This archive is being droppend and NOT sent.")
+            return False
+        filename = f"{name}.{archive_format}"
+        logger.debug("Archive %s of %s files has "
+                     "%s bytes.", filename, len(entries), size)
+
+        def data_provider(got_429, got_timeouts):
+            if archive_file:
+                return file_chunks(archive_file)
+            return archive_chunks(entries, archive_format, size)
+
+        resp = await upload_data(client, data_provider, mime_type, filename,
+                                 size)
+    except OSError as e:
+        logger.info(f"Archive of \"{path}\" could not be created. {e}")
+        return False
+    finally:
+        if archive_file:
+            archive_file.close()
+    if not isinstance(resp, UploadResponse):
+        logger.info(f"The program {PROG_WITH_EXT} failed to upload. "
+                    "Please retry. This could be temporary issue on "
+                    "your server. "
+                    "Sorry.")
+        logger.info(f"archive=\"{path}\"; filessize=\"{size}\" "
+                    f"Failed to upload: {resp}")
+        return False
+
+    content = {
+        "body": filename,  # descriptive title
+        "info": {
+            "size": size,
+            "mimetype": mime_type,
+        },
+        "msgtype": "m.file",
+        "url": resp.content_uri,
+    }
+
+    async def send_to_room(room_id):
+        resp = await send_room_event(client, room_id, content,
+                                     job_id=job_id)
+        if not isinstance(resp, RoomSendResponse):
+            logger.info(f"Archive {filename} could not be sent to "
+                        f"room \"{room_id}\". Response is: {resp}")
+            return False
+        logger.debug("This archive was sent: \"%s\" to room \"%s\".",
+                     filename, room_id)
+        return True
+
+    return await send_to_rooms(rooms, send_to_room,
+                               f"Archive send of {path} failed.")
+
+
+async def send_image(client, rooms, image, job_id=None):
+    """Process image.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+    image : str
+        file name of image from --image argument
+    job_id : str
+        ID of the send job, see send_room_event()
+
+    Returns True if the image was sent to all rooms, False otherwise.
+
+    This is a working example for a JPG image.
+    It can be viewed or downloaded from:
+    https://matrix.example.com/_matrix/media/r0/download/
+        example.com/SomeStrangeUriKey # noqa
+    {
+        "type": "m.room.message",
+        "sender": "@someuser:example.com",
+        "content": {
+            "body": "someimage.jpg",
+            "info": {
+                "size": 5420,
+                "mimetype": "image/jpeg",
+                "thumbnail_info": {
+                    "w": 100,
+                    "h": 100,
+                    "mimetype": "image/jpeg",
+                    "size": 2106
+                },
+                "w": 100,
+                "h": 100,
+                "thumbnail_url": "mxc://example.com/SomeStrangeThumbnailUriKey"
+            },
+            "msgtype": "m.image",
+            "url": "mxc://example.com/SomeStrangeUriKey"
+        },
+        "origin_server_ts": 12345678901234576,
+        "unsigned": {
+            "age": 268
+        },
+        "event_id": "$skdhGJKhgyr548654YTr765Yiy58TYR",
+        "room_id": "!JKHgyHGfytHGFjhgfY:example.com"
+    }
+
+    """
+    if not rooms:
+        logger.info("No rooms are given. This should not happen. "
+                    "This image is being droppend and NOT sent.")
+        return False
+    if not os.path.isfile(image):
+        logger.debug("Image file %s is not a file. Doesn't exist or "
+                     "is a directory."
+                     "This image is being droppend and NOT sent.", image)
+        return False
+
+    # "bmp", "gif", "jpg", "jpeg", "png", "pbm", "pgm", "ppm", "xbm", "xpm",
     # "tiff", "webp", "svg",
 
     if not re.match("^.jpg$|^.jpeg$|^.gif$|^.png$|^.svg$",
                     os.path.splitext(image)[1].lower()):
-        logger.debug(f"Image file {image} is not an image file. Should be "
+        logger.debug("Image file %s is not an image file. Should be "
                      ".jpg, .jpeg, .gif, or .png. "
-                     f"[{os.path.splitext(image)[1].lower()}]"
-                     "This image is being droppend and NOT sent.")
-        return
+                     "[%s]"
+                     "This image is being droppend and NOT sent.",
+                     image, os.path.splitext(image)[1].lower())
+        return False
 
     # 'application/pdf' "image/jpeg"
     mime_type = magic.from_file(image, mime=True)
     if not mime_type.startswith("image/"):
-        logger.debug(f"Image file {image} does not have an image mime type. "
+        logger.debug("Image file %s does not have an image mime type. "
                      "Should be something like image/jpeg. "
-                     f"Found mime type {mime_type}. "
-                     "This image is being droppend and NOT sent.")
-        return
+                     "Found mime type %s. "
+                     "This image is being droppend and NOT sent.",
+                     image, mime_type)
+        return False
 
     im = Image.open(image)
     (width, height) = im.size  # im.size returns (width,height) tuple
@@ -921,15 +4260,10 @@ async def send_image(client, rooms, image):
     # then send URI of upload to room
 
     file_stat = await aiofiles.os.stat(image)
-    async with aiofiles.open(image, "r+b") as f:
-        resp, maybe_keys = await client.upload(
-            f,
-            content_type=mime_type,  # image/jpeg
-            filename=os.path.basename(image),
-            filesize=file_stat.st_size)
+    resp = await upload_file(client, image, mime_type, file_stat)
     if (isinstance(resp, UploadResponse)):
         logger.debug("Image was uploaded successfully to server. "
-                     f"Response is: {resp}")
+                     "Response is: %s", resp)
     else:
         logger.info(f"The program {PROG_WITH_EXT} failed to upload. "
                     "Please retry. This could be temporary issue on "
@@ -938,262 +4272,1683 @@ async def send_image(client, rooms, image):
         logger.info(f"file=\"{image}\"; mime_type=\"{mime_type}\"; "
                     f"filessize=\"{file_stat.st_size}\""
                     f"Failed to upload: {resp}")
+        return False
+
+    # TODO compute thumbnail, upload thumbnail to Server
+    # TODO add thumbnail info to `content`
+
+    content = {
+        "body": os.path.basename(image),  # descriptive title
+        "info": {
+            "size": file_stat.st_size,
+            "mimetype": mime_type,
+            "thumbnail_info": None,  # TODO
+            "w": width,  # width in pixel
+            "h": height,  # height in pixel
+            "thumbnail_url": None,  # TODO
+            # "thumbnail_file": None,
+        },
+        "msgtype": "m.image",
+        "url": resp.content_uri,
+        # "file": {
+        #    # image/jpeg
+        #    "mimetype": mime_type,
+        #    # e.g. "mxc://example.com/someStrangeUriKey",
+        #    "url": resp.content_uri,
+        #    "v": "v2"
+    }
+
+    async def send_to_room(room_id):
+        resp = await send_room_event(client, room_id, content,
+                                     job_id=job_id)
+        if not isinstance(resp, RoomSendResponse):
+            logger.info(f"Image file {image} could not be sent to "
+                        f"room \"{room_id}\". Response is: {resp}")
+            return False
+        logger.debug("This image file was sent: \"%s\" to room \"%s\".",
+                     image, room_id)
+        return True
+
+    return await send_to_rooms(rooms, send_to_room,
+                               f"Image send of file {image} failed.")
+
+
+def message_format() -> str:
+    """Return the message format selected on the command line.
+
+    Returns one of "code", "markdown", "html" or "text". If several
+    formats are specified "code" takes priority over "markdown" which
+    takes priority over "html".
+
+    """
+    if pargs.code:
+        return "code"
+    if pargs.markdown:
+        return "markdown"
+    if pargs.html:
+        return "html"
+    return "text"
+
+
+def build_message_content(message, msg_format, notice,
+                          formatted_body=None) -> dict:
+    """Build the content of a m.room.message event for a text message.
+
+    Arguments:
+    ---------
+    message : str
+        message to send, without mime formatting
+    msg_format : str
+        one of "code", "markdown", "html" or "text"
+    notice : bool
+        send as m.notice instead of m.text
+    formatted_body : str
+        HTML of a "markdown" or "html" message if it is already known,
+        e.g. rendered from a template, see render_template()
+
+    """
+    if notice:
+        content = {"msgtype": "m.notice"}
+    else:
+        content = {"msgtype": "m.text"}
+
+    if msg_format == "code":
+        logger.debug("Sending message in format \"code\".")
+        formatted_message = code_to_html(message, pargs.language)
+        content["format"] = "org.matrix.custom.html"  # add to dict
+        content["formatted_body"] = formatted_message
+    elif msg_format == "markdown":
+        logger.debug("Converting message from MarkDown into HTML. "
+                     "Sending message in format \"markdown\".")
+        # e.g. converts from "-abc" to "<ul><li>abc</li></ul>"
+        if formatted_body is None:
+            formatted_body = markdown_to_html(message)
+        formatted_message = formatted_body
+        content["format"] = "org.matrix.custom.html"  # add to dict
+        content["formatted_body"] = formatted_message
+    elif msg_format == "html":
+        logger.debug("Sending message in format \"html\".")
+        formatted_message = message  # the same for the time being
+        if formatted_body is not None:
+            formatted_message = formatted_body
+        content["format"] = "org.matrix.custom.html"  # add to dict
+        content["formatted_body"] = formatted_message
+    else:
+        logger.debug("Sending message in format \"text\".")
+    content["body"] = message
+    return content
+
+
+def status_edit_content(content, event_id) -> dict:
+    """Return the content of an edit of event_id to the given content.
+
+    Arguments:
+    ---------
+    content : dict
+        new content of the m.room.message event, see
+        build_message_content()
+    event_id : str
+        ID of the original event
+
+    """
+    edit = {"msgtype": content["msgtype"], "body": "* " + content["body"]}
+    if "formatted_body" in content:
+        edit["format"] = content["format"]
+        edit["formatted_body"] = "* " + content["formatted_body"]
+    edit["m.new_content"] = content
+    edit["m.relates_to"] = {"rel_type": "m.replace", "event_id": event_id}
+    return edit
+
+
+def dedup_content(room_id, msg_format, message, content):
+    """Apply --dedup to the content of a message for one room.
+
+    Arguments:
+    ---------
+    room_id : str
+    msg_format : str
+        one of "code", "markdown", "html" or "text"
+    message : str
+        message that is checked for duplicates
+    content : dict
+        content of the m.room.message event of the message
+
+    Returns the content to send, which has the suffix "(repeated N
+    times)" with --dedup-mode collapse, or None if the message is a
+    duplicate and must not be sent. Otherwise the message is reserved
+    and must be recorded or released after the send, see
+    send_deduplicated().
+
+    """
+    if not dedup_filter:
+        return content
+    send, suppressed = dedup_filter.check(room_id, msg_format, message)
+    if not send:
+        logger.debug("Message is a duplicate and is being "
+                     "dropped for room \"%s\".", room_id)
+        return None
+    if suppressed and dedup_filter.mode == "collapse":
+        suffix = f" (repeated {suppressed} times)"
+        content = dict(content)
+        content["body"] += suffix
+        if "formatted_body" in content:
+            content["formatted_body"] += suffix
+    return content
+
+
+async def send_deduplicated(room_id, msg_format, message, content, send):
+    """Send a message to a room, unless --dedup finds it is a duplicate.
+
+    Arguments:
+    ---------
+    room_id : str
+    msg_format : str
+        one of "code", "markdown", "html" or "text"
+    message : str
+        message that is checked for duplicates
+    content : dict
+        content of the m.room.message event of the message
+    send : coroutine function
+        called with the content to send, see dedup_content(), returns
+        True if it was sent
+
+    Returns True if the message was sent or is a duplicate, False
+    otherwise.
+
+    """
+    room_content = dedup_content(room_id, msg_format, message, content)
+    if room_content is None:
+        return True
+    sent = False
+    try:
+        sent = await send(room_content)
+    finally:
+        if dedup_filter and sent:
+            dedup_filter.record(room_id, msg_format, message)
+        elif dedup_filter:
+            dedup_filter.release(room_id, msg_format, message)
+    return sent
+
+
+def message_preview(message, filename) -> str:
+    """Return the preview of a message that is sent as file.
+
+    The preview has the first and the last MESSAGE_PREVIEW_LINES lines
+    of the message, each cut to MESSAGE_PREVIEW_LINE_LENGTH characters,
+    and a line in between that refers to the file.
+
+    Arguments:
+    ---------
+    message : str
+        the complete message
+    filename : str
+        name of the file the message is sent as
+
+    """
+    lines = message.split("\n")
+    head = lines[:MESSAGE_PREVIEW_LINES]
+    tail = lines[MESSAGE_PREVIEW_LINES:][-MESSAGE_PREVIEW_LINES:]
+    omitted = len(lines) - len(head) - len(tail)
+    size = len(message.encode())
+    marker = (f"[... {omitted} lines omitted, {len(lines)} lines and "
+              f"{size} bytes in total, see attached file {filename} ...]")
+    cut = MESSAGE_PREVIEW_LINE_LENGTH
+    return "\n".join([line if len(line) <= cut else line[:cut] + " ..."
+                      for line in head + [marker] + tail])
+
+
+async def send_message_as_file(client, rooms, message, msg_format, notice,
+                               job_id=None):
+    """Send a message that is too large for an event as file.
+
+    The message is compressed with gzip and uploaded once. Each room
+    gets a preview of the message, see message_preview(), followed by
+    the file. Log output, the typical large message, compresses to a
+    fraction of its size, and the rooms get 2 small events instead of
+    1 huge one. Messages with more bytes than --attach-threshold are
+    sent this way.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+    message : str
+        message to send, without mime formatting
+    msg_format : str
+        one of "code", "markdown", "html" or "text", decides the name of
+        the file, the preview is sent as "code" or "text"
+    notice : bool
+        send the preview as notice
+    job_id : str
+        ID of the send job, see send_room_event(). The preview and the
+        file are sent with the job IDs "<job_id>/preview" and
+        "<job_id>/file".
+
+    Returns True if the message was sent to all rooms, False otherwise.
+
+    """
+    data = message.encode()
+    filename = f"message.{MESSAGE_FILE_EXTENSIONS[msg_format]}.gz"
+    mime_type = "application/gzip"
+    with timings.phase("compress"):
+        loop = asyncio.get_running_loop()
+        compressed = await loop.run_in_executor(
+            None, lambda: b"".join(gzip_pieces((data,))))
+    logger.debug("Message of %s bytes is sent as file "
+                 "%s of %s bytes.", len(data), filename, len(compressed))
+
+    def data_provider(got_429, got_timeouts):
+        return (compressed,)
+
+    resp = await upload_data(client, data_provider, mime_type, filename,
+                             len(compressed))
+    if not isinstance(resp, UploadResponse):
+        logger.info(f"The program {PROG_WITH_EXT} failed to upload. "
+                    "Please retry. This could be temporary issue on "
+                    "your server. "
+                    "Sorry.")
+        logger.info(f"message of {len(data)} bytes; filessize="
+                    f"\"{len(compressed)}\" Failed to upload: {resp}")
+        return False
+
+    preview_format = "code" if msg_format == "code" else "text"
+    preview = build_message_content(message_preview(message, filename),
+                                    preview_format, notice)
+    content = {
+        "body": filename,  # descriptive title
+        "info": {
+            "size": len(compressed),
+            "mimetype": mime_type,
+        },
+        "msgtype": "m.file",
+        "url": resp.content_uri,
+    }
+
+    async def send_to_room(room_id):
+        return await send_deduplicated(
+            room_id, msg_format, message, preview,
+            functools.partial(send_preview_and_file, room_id))
+
+    async def send_preview_and_file(room_id, room_preview):
+        for room_content, part in ((room_preview, "preview"),
+                                   (content, "file")):
+            resp = await send_room_event(
+                client, room_id, room_content,
+                ignore_unverified_devices=True,
+                job_id=None if job_id is None else f"{job_id}/{part}")
+            if not isinstance(resp, RoomSendResponse):
+                logger.info("Message could not be sent to room \"%s\" as "
+                            "file. Response is: %s", room_id, resp)
+                return False
+        logger.debug("This message was sent as file: \"%s\" to room "
+                     "\"%s\".", LogTruncated(message), room_id)
+        return True
+
+    return await send_to_rooms(rooms, send_to_room, "Message send failed.")
+
+
+async def send_message(client, rooms, message, msg_format=None,
+                       notice=None, job_id=None, status_key=None,
+                       template=None):
+    """Process message.
+
+    Format messages according to instructions from command line arguments.
+    Then send all messages to all rooms.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+    message : str
+        message to send as read from -m, pipe or keyboard
+        message is without mime formatting
+    msg_format : str
+        one of "code", "markdown", "html" or "text",
+        if None the format from the command line is used
+    notice : bool
+        send as notice, if None --notice from the command line is used
+    job_id : str
+        ID of the send job, see send_room_event()
+    status_key : str
+        send as edit of the last message with the same key, see
+        --status-key, if None --status-key from the command line is
+        used
+    template : str
+        name of template, the message is then the JSON object of the
+        variables of the template, see --template, if None --template
+        from the command line is used
+
+    Returns True if the message was sent to all rooms, False otherwise.
+    An empty message is not sent, that is not a failure.
+
+    """
+    if not rooms:
+        logger.info("No rooms are given. This should not happen. "
+                    "This text message is being droppend and NOT sent.")
+        return False
+    # remove leading AND trailing newlines to beautify
+    message = message.strip("\n")
+
+    if message == "" or message.strip() == "":
+        logger.debug(
+            "The message is empty. "
+            "This message is being droppend and NOT sent.")
+        return True
+
+    if msg_format is None:
+        msg_format = message_format()
+    if notice is None:
+        notice = pargs.notice
+    if status_key is None:
+        status_key = pargs.status_key
+    if template is None:
+        template = pargs.template
+    formatted_body = None
+    if template:
+        try:
+            with timings.phase("render template"):
+                message, formatted_body = render_template(
+                    template, message, msg_format)
+        except (OSError, ValueError) as e:  # includes JSONDecodeError
+            logger.info(f"Message could not be rendered with template "
+                        f"\"{template}\". {e} "
+                        "This message is being droppend and NOT sent.")
+            return False
+        message = message.strip("\n")
+    threshold = pargs.attach_threshold
+    # a character has at most 4 bytes, most messages are not encoded here
+    if threshold and len(message) * 4 > threshold and (
+            len(message.encode()) > threshold):
+        return await send_message_as_file(client, rooms, message,
+                                          msg_format, notice, job_id)
+    content = build_message_content(message, msg_format, notice,
+                                    formatted_body)
+
+    async def send_to_room(room_id):
+        return await send_deduplicated(
+            room_id, msg_format, message, content,
+            functools.partial(send_content, room_id))
+
+    async def send_content(room_id, room_content):
+        original = None
+        room_job_id = job_id
+        if status_key:
+            if status_events is None:
+                # every mode whose jobs can have a status key must
+                # create status_events, see main_send()
+                logger.error("Status key \"%s\" cannot be used, the "
+                             "status events are not loaded.", status_key)
+                return False
+            original = status_events.get(status_key, room_id)
+        if original:
+            resp = await send_room_event(
+                client, room_id, status_edit_content(room_content, original),
+                ignore_unverified_devices=True, job_id=room_job_id)
+            if (isinstance(resp, RoomSendError) and
+                    resp.status_code != "M_LIMIT_EXCEEDED"):
+                # e.g. the original event was redacted, start a new one
+                logger.debug("Status message \"%s\" could not be edited "
+                             "in room \"%s\", sending a new one. Response "
+                             "is: %s", status_key, room_id, resp)
+                original = None
+                if room_job_id is not None:
+                    room_job_id = f"{room_job_id}/new"
+        if not original:
+            resp = await send_room_event(client, room_id, room_content,
+                                         ignore_unverified_devices=True,
+                                         job_id=room_job_id)
+            if status_key and isinstance(resp, RoomSendResponse):
+                status_events.set(status_key, room_id, resp.event_id)
+        if not isinstance(resp, RoomSendResponse):
+            logger.info("Message could not be sent to room \"%s\". "
+                        "Response is: %s", room_id, resp)
+            return False
+        logger.debug("This message was sent: \"%s\" to room \"%s\".",
+                     LogTruncated(message), room_id)
+        return True
+
+    return await send_to_rooms(rooms, send_to_room, "Message send failed.")
+
+
+class StdinReader(object):
+    """Read stdin in the background while the event loop does other work.
+
+    Pipes and sockets are connected to the event loop with a
+    StreamReader, everything else, e.g. a regular file given with
+    "< file", is read in the default executor. So login, key upload and
+    sync run while the input is still arriving. The text is split into
+    messages at the separator as it arrives, so that the first message
+    can be sent while the following ones are still being read.
+    """
+
+    def __init__(self, separator=None):
+        """Start reading stdin.
+
+        Arguments:
+        ---------
+        separator : str
+            string between two messages, e.g. "\\n" for one message
+            per line, if None all of stdin is one message
+
+        """
+        self.separator = separator
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.read())
+
+    async def chunks(self):
+        """Yield the bytes of stdin as they arrive, until EOF."""
+        loop = asyncio.get_running_loop()
+        fd = sys.stdin.fileno()
+        # the transport closes its file, stdin itself stays open
+        file = os.fdopen(os.dup(fd), "rb", buffering=0)
+        mode = os.fstat(fd).st_mode
+        if not (stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)):
+            # regular files and devices cannot be polled by the event loop
+            with file:
+                while True:
+                    data = await loop.run_in_executor(None, file.read,
+                                                      STDIN_CHUNK_SIZE)
+                    if not data:
+                        return
+                    yield data
+        reader = asyncio.StreamReader(limit=STDIN_CHUNK_SIZE)
+        transport, _ = await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), file)
+        try:
+            while True:
+                data = await reader.read(STDIN_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+        finally:
+            transport.close()
+            # the pipe is shared with the dup, e.g. with the shell
+            os.set_blocking(fd, True)
+
+    async def read(self) -> None:
+        """Decode stdin, split it into messages and queue them."""
+        decoder = codecs.getincrementaldecoder(sys.stdin.encoding or "utf-8")(
+            errors=sys.stdin.errors or "strict")
+        separator = self.separator
+        pieces = []  # all of stdin if there is no separator
+        buffer = ""  # incomplete message if there is a separator
+        try:
+            async for data in self.chunks():
+                text = decoder.decode(data)
+                if not separator:
+                    pieces.append(text)
+                    continue
+                # the separator may start in the previous chunk
+                start = max(0, len(buffer) - len(separator) + 1)
+                buffer += text
+                index = buffer.find(separator, start)
+                position = 0
+                while index >= 0:
+                    self.queue.put_nowait(buffer[position:index])
+                    position = index + len(separator)
+                    index = buffer.find(separator, position)
+                buffer = buffer[position:]
+            pieces.append(buffer + decoder.decode(b"", final=True))
+            self.queue.put_nowait("".join(pieces))
+            logger.debug("Using data from stdin pipe as message.")
+        finally:
+            self.queue.put_nowait(None)  # end of messages
+
+    async def messages(self):
+        """Yield the messages from stdin as soon as they are complete."""
+        while True:
+            message = await self.queue.get()
+            if message is None:
+                await self.task  # raises the error of reading, if any
+                return
+            yield message
+
+    async def read_all(self) -> list:
+        """Return all messages from stdin, once stdin is read completely."""
+        with timings.phase("read input"):
+            return [message async for message in self.messages()]
+
+
+def open_stdin_reader():
+    """Start reading stdin if input is piped into the program.
+
+    Returns a StdinReader, or None if stdin is a terminal. Then no
+    input is piped into the program and the message is read from the
+    keyboard, see get_messages_from_keyboard(). With --batch stdin
+    holds one job per line, also if it is a terminal. With --split
+    stdin is split into messages while it is read.
+
+    """
+    if pargs.batch:
+        return StdinReader("\n")
+    if sys.stdin is None or sys.stdin.isatty():
+        logger.debug("stdin is a terminal, no pipe was used.")
+        return None
+    logger.debug("Pipe was definitely used, but pipe might be empty. "
+                 "Reading from pipe in the background.")
+    return StdinReader(split_string())
+
+
+def get_messages_from_keyboard() -> list:
+    """Read input from keyboard but only if no other messages are available.
+
+    If there is a message provided via --message argument, no message
+    will be read from keyboard.
+    If there is a message provided via stdin input pipe, no message
+    will be read from keyboard.
+    In short, we only read from keyboard as last resort, if no messages are
+    specified or provided anywhere.
+
+    Return [] if no input available on keyboard.
+    Return ["some-msg"] if input is availble on keyboard.
+    Might also return [""] of course if "" keyboard entry was empty.
+    Currently there is at most 1 msg in the returned list.
+    """
+    messages = []
+    if pargs.message:
+        logger.debug("Don't read from keyboard because there are "
+                     "messages provided in arguments with -m.")
+        return messages  # return empty list because mesgs in -m
+    stdin_ready = select.select([sys.stdin, ], [], [], 0.0)[0]
+    if not stdin_ready:
+        logger.debug("stdin is not ready. "
+                     "A pipe could be used, but pipe could be empty, "
+                     "stdin could also be a keyboard.")
+    else:
+        logger.debug("stdin is ready. Something "
+                     "is definitely piped into program from stdin."
+                     "Reading message from stdin pipe.")
+    if ((not stdin_ready) and (sys.stdin.isatty())):
+        # because sys.stdin.isatty() is true
+        logger.debug("No pipe was used, so read input from keyboard. "
+                     "Reading message from keyboard")
+        try:
+            message = input("Enter message to send: ")
+            logger.debug("Using data from stdin keyboard as message.")
+            messages.append(message)
+        except EOFError:  # EOF when reading a line
+            logger.debug("Reading from stdin resulted in EOF. "
+                         "Reading from keyboard failed. "
+                         "No message will be generated.")
+    return messages
+
+
+async def send_messages_and_files(client, rooms, messages,
+                                  stdin_reader=None):
+    """Send text messages and files.
+
+    First images, audio, etc, then text messaged, then the messages
+    from stdin, each as soon as it has been read completely.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list of room_ids
+    messages : list of messages to send
+    stdin_reader : StdinReader
+        reader of the messages piped into the program, or None
+
+    Returns True if everything was sent to all rooms, False otherwise.
+
+    """
+    sent = True
+    index = 0
+    if pargs.image:
+        for image in pargs.image:
+            sent = await send_image(client, rooms, image,
+                                    job_id=cli_job_id(index)) and sent
+            index += 1
+
+    if pargs.audio:
+        for audio in pargs.audio:
+            # audio file can be sent like other files
+            sent = await send_file(client, rooms, audio,
+                                   job_id=cli_job_id(index)) and sent
+            index += 1
+
+    if pargs.file:
+        for file in pargs.file:
+            sent = await send_file(client, rooms, file,
+                                   job_id=cli_job_id(index)) and sent
+            index += 1
+
+    for message in messages:
+        sent = await send_message(client, rooms, message,
+                                  job_id=cli_job_id(index)) and sent
+        index += 1
+
+    if stdin_reader:
+        async for message in stdin_reader.messages():
+            sent = await send_message(client, rooms, message,
+                                      job_id=cli_job_id(index)) and sent
+            index += 1
+    return sent
+
+
+def cli_job_id(index):
+    """Return the ID of the index-th image, file or message of this run.
+
+    The images, audio files, files and messages of the command line,
+    the keyboard and the pipe are counted in this order, starting with
+    0. Returns None if --job-id is not used.
+
+    """
+    if pargs.job_id is None:
+        return None
+    return f"{pargs.job_id}/{index}"
+
+
+async def send_job(client, rooms, job, store_dir) -> bool:
+    """Send one job of a SendQueue.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s, used if the job has no rooms
+    job : dict
+        with the key "image", "file" or "message", and the keys
+        "rooms", "format", "notice", "status_key", "template" and "id",
+        see webhook_payload_to_jobs()
+    store_dir : str
+        location of persistent storage store directory
+
+    Returns True if the job was sent to all rooms, False otherwise.
+
+    """
+    job_rooms = job.get("rooms") or rooms
+    aliases = [r for r in job_rooms if r.startswith("#")]
+    if aliases:
+        resolved = await resolve_room_aliases(client, aliases, store_dir)
+        job_rooms = [resolved.get(r) if r.startswith("#") else r
+                     for r in job_rooms]
+        job_rooms = [r for r in job_rooms if r]
+    if job.get("image"):
+        return await send_image(client, job_rooms, job["image"],
+                                job_id=job.get("id"))
+    if job.get("file"):
+        return await send_file(client, job_rooms, job["file"],
+                               job_id=job.get("id"))
+    return await send_message(client, job_rooms, job["message"],
+                              msg_format=job.get("format"),
+                              notice=job.get("notice"),
+                              job_id=job.get("id"),
+                              status_key=job.get("status_key"),
+                              template=job.get("template"))
+
+
+async def send_jobs(client, rooms, jobs, store_dir) -> bool:
+    """Send jobs by their priority, see SendQueue.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s, used for jobs without rooms
+    jobs : list
+        list of jobs, see send_job()
+    store_dir : str
+        location of persistent storage store directory
+
+    Returns True if all jobs were sent, False otherwise.
+
+    """
+    async def send(job):
+        return await send_job(client, rooms, job, store_dir)
+
+    send_queue = SendQueue(send)
+    for job in jobs:
+        send_queue.put(job)
+    await send_queue.join()
+    return not send_queue.failed
+
+
+def get_jobs_from_batch(lines) -> list:
+    """Parse the jobs for --batch, one JSON object per line.
+
+    Each line is parsed like the payload of a --webhook request, see
+    webhook_payload_to_jobs(). Invalid lines are skipped.
+
+    Arguments:
+    ---------
+    lines : list
+        lines read from stdin, see StdinReader
+
+    """
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        if line.strip() == "":
+            continue
+        try:
+            jobs += webhook_payload_to_jobs(json.loads(line))
+        except ValueError as e:  # includes JSONDecodeError
+            logger.info(f"Line {number} of the --batch input is invalid "
+                        f"and is skipped. {e}")
+    logger.debug("Jobs from batch: %s", LogTruncated(jobs))
+    return jobs
+
+
+def split_string() -> str:
+    """Return the string given with --split, de-escaped, or None."""
+    if not pargs.split:
+        return None
+    # pargs.split can have escape characters, it has to be de-escaped
+    decoded_string = bytes(pargs.split, "utf-8").decode("unicode_escape")
+    logger.debug("String used for splitting is: \"%s\"", decoded_string)
+    return decoded_string
+
+
+def read_messages() -> list:
+    """Read the text messages of the command line and the keyboard.
+
+    The messages piped into the program are read by a StdinReader.
+    Messages are split if --split is given.
+
+    Returns the list of messages to send.
+
+    """
+    if pargs.batch:  # stdin holds the jobs of the batch
+        messages_from_keyboard = []
+    else:
+        with timings.phase("read input"):
+            messages_from_keyboard = get_messages_from_keyboard()
+    if not pargs.message:
+        messages_from_commandline = []
+    else:
+        messages_from_commandline = pargs.message
+
+    logger.debug("Messages from keyboard:     %s",
+                 LogTruncated(messages_from_keyboard))
+    logger.debug("Messages from command-line: %s",
+                 LogTruncated(messages_from_commandline))
+
+    messages_all = messages_from_commandline + \
+        messages_from_keyboard  # keyboard at end
+
+    # loop thru all msgs and split them
+    decoded_string = split_string()
+    if decoded_string:
+        messages_all_split = []
+        for m in messages_all:
+            messages_all_split += m.split(decoded_string)
+    else:  # not pargs.split
+        messages_all_split = messages_all
+    return messages_all_split
+
+
+async def read_all_messages(stdin_reader) -> list:
+    """Read all text messages, including all messages from stdin.
+
+    Arguments:
+    ---------
+    stdin_reader : StdinReader
+        reader of the messages piped into the program, or None
+
+    """
+    messages = read_messages()
+    if stdin_reader and not pargs.batch:
+        messages += await stdin_reader.read_all()
+    return messages
+
+
+async def process_arguments_and_input(client, rooms, store_dir,
+                                      stdin_reader=None):
+    """Process arguments and all input.
+
+    Process all input: text messages, etc.
+    Prepare a list of messages from all sources and then send them.
+    Messages piped into the program are sent as soon as they have been
+    read, while the room keys are shared in the background, see
+    prewarm_rooms().
+    With --batch the messages and files from the command line are sent
+    together with the jobs read from stdin, ordered by priority.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list of room_ids
+    store_dir : str
+        location of persistent storage store directory
+    stdin_reader : StdinReader
+        reader of the messages piped into the program, or None
+
+    """
+    messages = read_messages()
+    if not pargs.batch:
+        prewarm = None
+        if stdin_reader and not stdin_reader.task.done():
+            prewarm = asyncio.create_task(prewarm_rooms(client, rooms))
+        try:
+            await send_messages_and_files(client, rooms, messages,
+                                          stdin_reader)
+        finally:
+            if prewarm:
+                await prewarm
+        return
+    lines = await stdin_reader.read_all() if stdin_reader else []
+    await send_jobs(client, rooms, collect_jobs(messages, lines), store_dir)
+
+
+def collect_jobs(messages, lines=()) -> list:
+    """Return the images, files and messages to send as list of jobs.
+
+    With --batch the jobs read from stdin are added at the end.
+
+    Arguments:
+    ---------
+    messages : list
+        messages from command line, pipe and keyboard, see
+        read_all_messages()
+    lines : list
+        lines read from stdin with --batch
+
+    """
+    jobs = []
+    for image in pargs.image or []:
+        jobs.append({"image": image})
+    # audio files can be sent like other files
+    for file in (pargs.audio or []) + (pargs.file or []):
+        jobs.append({"file": file})
+    for message in messages:
+        jobs.append({"message": message, "status_key": pargs.status_key,
+                     "template": pargs.template})
+    for index, job in enumerate(jobs):
+        job["id"] = cli_job_id(index)
+    if pargs.batch:
+        jobs += get_jobs_from_batch(lines)
+    return jobs
+
+
+def parse_duration(duration) -> float:
+    """Parse a duration like "90s", "15m", "2h", "1d" or "1h30m".
+
+    A number without unit is taken as seconds.
+
+    Returns the duration in seconds. Raises ValueError if it is invalid.
+
+    """
+    parts = re.findall(r"(\d+(?:\.\d+)?)\s*([smhdw]?)", duration.lower())
+    if not parts or re.sub(r"[\d.\ssmhdw]", "", duration.lower()):
+        raise ValueError(f"Duration \"{duration}\" is invalid. Use e.g. "
+                         "\"90s\", \"15m\", \"2h\", \"1d\" or \"1h30m\".")
+    return sum(float(number) * SCHEDULE_UNITS[unit or "s"]
+               for number, unit in parts)
+
+
+def parse_time(when) -> float:
+    """Parse a point in time like "2026-12-24 18:00" or "18:00".
+
+    The formats of datetime.fromisoformat() are understood, without a
+    time zone the local time is used. A time of day without a date is
+    the next time this time of day comes, today or tomorrow.
+
+    Returns seconds since the epoch. Raises ValueError if it is invalid.
+
+    """
+    try:
+        m = re.fullmatch(r"(\d{1,2}):(\d{2})(?::(\d{2}))?", when.strip())
+        if m:
+            now = datetime.datetime.now()
+            at = datetime.datetime.combine(now.date(), datetime.time(
+                int(m.group(1)), int(m.group(2)), int(m.group(3) or 0)))
+            if at <= now:
+                at += datetime.timedelta(days=1)
+        else:
+            at = datetime.datetime.fromisoformat(when.strip())
+    except ValueError:
+        raise ValueError(f"Time \"{when}\" is invalid. Use e.g. "
+                         "\"2026-12-24 18:00\" or \"18:00\".")
+    return at.timestamp()
+
+
+async def schedule_jobs(store_dir) -> None:
+    """Add the messages and files of this run to the schedule (--at, --in).
+
+    Everything that depends on the command line, e.g. format, notice,
+    rooms and priority, is stored with the job, so the job is sent as
+    if it had been sent right away. Paths of files and templates are
+    made absolute, rooms are stored without their shell escapes.
+
+    Arguments:
+    ---------
+    store_dir : str
+        location of persistent storage store directory
+
+    """
+    if pargs.schedule_at:
+        due = parse_time(pargs.schedule_at)
+    else:
+        due = time.time() + parse_duration(pargs.schedule_in)
+    stdin_reader = open_stdin_reader()
+    messages = await read_all_messages(stdin_reader)
+    lines = await stdin_reader.read_all() if pargs.batch else []
+    jobs = collect_jobs(messages, lines)
+    for job in jobs:
+        for key in ("image", "file"):
+            if job.get(key):
+                job[key] = os.path.abspath(job[key])
+        if "message" in job:
+            job["format"] = job.get("format") or message_format()
+            if job.get("notice") is None:
+                job["notice"] = pargs.notice
+        if job.get("template"):
+            job["template"] = os.path.abspath(job["template"])
+        job["rooms"] = job.get("rooms") or [
+            unescape_room(room) for room in pargs.room or []]
+        job["priority"] = job.get("priority") or pargs.priority
+        # stored with the job, so a job that is sent again after a
+        # restart of the scheduler is not sent twice, see send_room_event()
+        job["id"] = job.get("id") or str(uuid.uuid4())
+    jobs = [job for job in jobs
+            if "message" not in job or job["message"].strip() != ""]
+    if not jobs:
+        logger.info("There is nothing to schedule.")
+        return
+    schedule = Schedule(store_dir)
+    try:
+        schedule.add(due, jobs)
+    finally:
+        schedule.close()
+    logger.info(f"{len(jobs)} job(s) scheduled for "
+                f"{datetime.datetime.fromtimestamp(due):%Y-%m-%d %H:%M:%S}. "
+                "They are sent by the program running with --scheduler "
+                f"and store \"{store_dir}\".")
+
+
+def shard_rooms(rooms, count) -> list:
+    """Split the rooms into count shards.
+
+    A room is always put into the same shard (as long as the number of
+    shards does not change), so that the Megolm sessions and the --dedup
+    state of a room stay in the store of the same shard.
+
+    Arguments:
+    ---------
+    rooms : list of room_ids
+    count : int : number of shards
+
+    Returns a list of count lists of room_ids.
+
+    """
+    shards = [[] for _ in range(count)]
+    for room_id in rooms:
+        shards[zlib.crc32(room_id.encode("utf-8")) % count].append(room_id)
+    return shards
+
+
+def shard_store_dir(store_dir, credentials_file) -> str:
+    """Return the store directory of the shard using credentials_file.
+
+    It is a sub-directory of the store directory named after the
+    credentials file, e.g. "./store/shard1/" for "shard1.json", so it
+    is known before the credentials file is created. Credentials files
+    with the same name in different directories would share a store,
+    they are rejected when the arguments are checked.
+
+    """
+    return os.path.join(
+        store_dir, os.path.splitext(os.path.basename(credentials_file))[0])
+
+
+def init_shard_worker(args, log_level, log_format) -> None:
+    """Set up a shard worker process.
+
+    The worker process is started without running the __main__ code,
+    so the arguments and the logger are handed over from the parent.
+
+    """
+    global pargs, logger
+    pargs = args
+    logging.basicConfig()
+    logging.getLogger().setLevel(log_level)
+    if log_format == "json":
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(JsonLogFormatter())
+    if log_level > logging.DEBUG:
+        logging.getLogger("nio").setLevel(logging.WARNING)
+    logger = logging.getLogger(PROG_WITHOUT_EXT)
+
+
+async def send_shard(credentials_file, store_dir, rooms, messages) -> bool:
+    """Log in with the device of a shard and send to the rooms of the shard.
+
+    Arguments:
+    ---------
+    credentials_file : str : credentials file of the shard
+    store_dir : str : store directory of the shard
+    rooms : list of room_ids
+    messages : list of messages to send
 
-    # TODO compute thumbnail, upload thumbnail to Server
-    # TODO add thumbnail info to `content`
+    Returns True if everything was sent to all rooms, False otherwise.
 
-    content = {
-        "body": os.path.basename(image),  # descriptive title
-        "info": {
-            "size": file_stat.st_size,
-            "mimetype": mime_type,
-            "thumbnail_info": None,  # TODO
-            "w": width,  # width in pixel
-            "h": height,  # height in pixel
-            "thumbnail_url": None,  # TODO
-            # "thumbnail_file": None,
-        },
-        "msgtype": "m.image",
-        "url": resp.content_uri,
-        # "file": {
-        #    # image/jpeg
-        #    "mimetype": mime_type,
-        #    # e.g. "mxc://example.com/someStrangeUriKey",
-        #    "url": resp.content_uri,
-        #    "v": "v2"
-    }
+    """
+    global dedup_filter, status_events
+    os.makedirs(store_dir, exist_ok=True)
+    client, credentials = login_using_credentials_file(credentials_file,
+                                                       store_dir)
+    metrics.instrument_client(client)
+    if pargs.dedup:
+        dedup_filter = DedupFilter(store_dir, pargs.dedup, pargs.dedup_mode)
+    if pargs.status_key:
+        status_events = StatusEvents(store_dir)
+    setup_crypto_executor()
+    setup_concurrency()
+    try:
+        async with store_lock.exclusive():
+            if client.should_upload_keys:
+                with timings.phase("keys_upload"):
+                    await client.keys_upload()
+        with timings.phase("sync"):
+            await client.sync(timeout=30000, full_state=True)
+        sent = await send_messages_and_files(client, rooms, messages)
+        if dedup_filter:
+            dedup_filter.close()
+        return sent
+    finally:
+        with timings.phase("close"):
+            await client.close()
+
+
+def shard_worker(index, credentials_file, store_dir, rooms,
+                 messages) -> dict:
+    """Send to the rooms of one shard, runs in a worker process.
+
+    Returns a dictionary with the result, the timings and the metrics
+    of the shard for the parent process.
 
+    """
+    logger.debug("Shard %s sends to %s rooms as device of credentials "
+                 "file \"%s\" with store \"%s\".", index, len(rooms),
+                 credentials_file, store_dir)
     try:
-        for room_id in rooms:
-            await client.room_send(
-                room_id,
-                message_type="m.room.message",
-                content=content
-            )
-            logger.debug(f"This image file was sent: \"{image}\" "
-                         f"to room \"{room_id}\".")
+        sent = asyncio.run(
+            send_shard(credentials_file, store_dir, rooms, messages))
     except Exception:
-        logger.debug(f"Image send of file {image} failed. "
-                     "Sorry. Here is the traceback.")
-        logger.debug(traceback.format_exc())
+        logger.info(f"Shard {index} failed. Sorry. Here is the traceback.")
+        logger.info(traceback.format_exc())
+        sent = False
+    return {"shard": index, "rooms": len(rooms), "sent": sent,
+            "timings": timings.to_dict(), "metrics": metrics.state()}
 
 
-async def send_message(client, rooms, message):
-    """Process message.
+async def send_sharded(rooms, messages, store_dir) -> bool:
+    """Send messages and files to the rooms using one process per shard.
 
-    Format messages according to instructions from command line arguments.
-    Then send all messages to all rooms.
+    The rooms are split into one shard per credentials file given with
+    --shard-credentials. Each shard is sent by its own worker process
+    logged in as its own device with its own store, so that encryption
+    and serialization of the events run in parallel on all cores and
+    the processes do not contend for the same store.
 
     Arguments:
     ---------
-    client : Client
-    rooms : list
-        list of room_id-s
-    message : str
-        message to send as read from -m, pipe or keyboard
-        message is without mime formatting
+    rooms : list of room_ids
+    messages : list of messages to send
+    store_dir : str : store directory, the stores of the shards are
+        sub-directories of it
+
+    Returns True if everything was sent to all rooms, False otherwise.
 
     """
-    if not rooms:
-        logger.info("No rooms are given. This should not happen. "
-                    "This text message is being droppend and NOT sent.")
-        return
-    # remove leading AND trailing newlines to beautify
-    message = message.strip("\n")
+    jobs = []
+    for index, (credentials_file, shard) in enumerate(zip(
+            pargs.shard_credentials,
+            shard_rooms(rooms, len(pargs.shard_credentials)))):
+        if shard:
+            shard_store = shard_store_dir(store_dir, credentials_file)
+            logger.info(f"Shard {index} uses credentials file "
+                        f"\"{credentials_file}\" and store "
+                        f"\"{shard_store}\".")
+            jobs.append((index, credentials_file, shard_store, shard,
+                         messages))
+    timings.values["shards"] = len(jobs)
+    if not jobs:
+        logger.info("No rooms are given. Nothing is sent.")
+        return False
+    # spawn instead of fork: the parent has a running event loop and
+    # open connections that must not be inherited by the workers
+    context = multiprocessing.get_context("spawn")
+    root_logger = logging.getLogger()
+    # one process per shard, a process is never reused for a second shard
+    with context.Pool(len(jobs), initializer=init_shard_worker,
+                      initargs=(pargs, root_logger.getEffectiveLevel(),
+                                pargs.log_format),
+                      maxtasksperchild=1) as pool:
+        with timings.phase("shards"):
+            results = await asyncio.get_running_loop().run_in_executor(
+                None, pool.starmap, shard_worker, jobs)
+    sent = True
+    for result in results:
+        timings.merge(result["timings"], f"shard {result['shard']}: ")
+        metrics.merge(result["metrics"])
+        if result["sent"]:
+            logger.debug("Shard %s sent to %s rooms.", result["shard"],
+                         result["rooms"])
+        else:
+            logger.info(f"Shard {result['shard']} could not send "
+                        f"everything to its {result['rooms']} rooms.")
+            sent = False
+    return sent
 
-    if message == "" or message.strip() == "":
-        logger.debug(
-            "The message is empty. "
-            "This message is being droppend and NOT sent.")
-        return
 
-    if pargs.notice:
-        content = {"msgtype": "m.notice"}
-    else:
-        content = {"msgtype": "m.text"}
+def read_watch_index(store_dir, directory) -> dict:
+    """Read the index of files already sent from a watched directory.
 
-    if pargs.code:
-        logger.debug("Sending message in format \"code\".")
-        formatted_message = "<pre><code>" + message + "</code></pre>"
-        content["format"] = "org.matrix.custom.html"  # add to dict
-        content["formatted_body"] = formatted_message
-    elif pargs.markdown:
-        logger.debug("Converting message from MarkDown into HTML. "
-                     "Sending message in format \"markdown\".")
-        # e.g. converts from "-abc" to "<ul><li>abc</li></ul>"
-        formatted_message = markdown(message)
-        content["format"] = "org.matrix.custom.html"  # add to dict
-        content["formatted_body"] = formatted_message
-    elif pargs.html:
-        logger.debug("Sending message in format \"html\".")
-        formatted_message = message  # the same for the time being
-        content["format"] = "org.matrix.custom.html"  # add to dict
-        content["formatted_body"] = formatted_message
-    else:
-        logger.debug("Sending message in format \"text\".")
-    content["body"] = message
+    Arguments:
+    ---------
+    store_dir : str
+        location of persistent storage store directory
+    directory : str
+        absolute path of watched directory
 
+    Returns a dictionary that maps file names to [size, mtime_ns].
+
+    """
     try:
-        for room_id in rooms:
-            await client.room_send(
-                room_id,
-                message_type="m.room.message",
-                content=content,
-                ignore_unverified_devices=True,
-            )
-            logger.debug(f"This message was sent: \"{message}\" "
-                         f"to room \"{room_id}\".")
-    except Exception:
-        logger.debug("Image send failed. Sorry. Here is the traceback.")
-        logger.debug(traceback.format_exc())
+        with open(os.path.join(store_dir, WATCH_INDEX_FILE), "r") as f:
+            return json.load(f).get(directory, {})
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError, AttributeError):
+        logger.info("Watch index could not be read. All files in "
+                    f"\"{directory}\" will be considered new.")
+        return {}
 
 
-def get_messages_from_pipe() -> list:
-    """Read input from pipe if available.
+def write_watch_index(store_dir, directory, index) -> None:
+    """Write the index of files already sent from a watched directory.
+
+    Arguments:
+    ---------
+    store_dir : str
+        location of persistent storage store directory
+    directory : str
+        absolute path of watched directory
+    index : dict
+        index as returned by read_watch_index()
 
-    Return [] if no input available on pipe stdin.
-    Return ["some-msg"] if input is availble.
-    Might also return [""] of course if "" was in pipe.
-    Currently there is at most 1 msg in the returned list.
     """
-    messages = []
-    stdin_ready = select.select([sys.stdin, ], [], [], 0.0)[0]
-    if not stdin_ready:
-        logger.debug("stdin is not ready. "
-                     "A pipe could be used, but pipe could be empty, "
-                     "stdin could also be a keyboard.")
-    else:
-        logger.debug("stdin is ready. Something "
-                     "is definitely piped into program from stdin."
-                     "Reading message from stdin pipe.")
-    if ((not stdin_ready) and (not sys.stdin.isatty())) or stdin_ready:
-        if not sys.stdin.isatty():
-            logger.debug("Pipe was definitely used, but pipe might be empty. "
-                         "Trying to read from pipe in any case.")
-        message = ""
-        try:
-            for line in sys.stdin:
-                message += line
-            logger.debug("Using data from stdin pipe as message.")
-            messages.append(message)
-        except EOFError:  # EOF when reading a line
-            logger.debug("Reading from stdin resulted in EOF. This can happen "
-                         "when a pipe was used, but the pipe is empty. "
-                         "No message will be generated.")
-    return messages
+    index_file = os.path.join(store_dir, WATCH_INDEX_FILE)
+    try:
+        with open(index_file, "r") as f:
+            indexes = json.load(f)
+    except (OSError, ValueError):
+        indexes = {}
+    indexes[directory] = index
+    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, "w") as f:
+            json.dump(indexes, f)
+        os.replace(tmp_file, index_file)
+    except OSError:
+        logger.info(f"Watch index \"{index_file}\" could not be written. "
+                    "Files might be sent again after a restart.")
 
 
-def get_messages_from_keyboard() -> list:
-    """Read input from keyboard but only if no other messages are available.
+def watch_skip_name(name) -> bool:
+    """Return True if a file name should be ignored by --watch.
 
-    If there is a message provided via --message argument, no message
-    will be read from keyboard.
-    If there is a message provided via stdin input pipe, no message
-    will be read from keyboard.
-    In short, we only read from keyboard as last resort, if no messages are
-    specified or provided anywhere.
+    Hidden files and typical names of files that are still being
+    written (e.g. "report.pdf.part") are ignored.
 
-    Return [] if no input available on keyboard.
-    Return ["some-msg"] if input is availble on keyboard.
-    Might also return [""] of course if "" keyboard entry was empty.
-    Currently there is at most 1 msg in the returned list.
     """
-    messages = []
-    if pargs.message:
-        logger.debug("Don't read from keyboard because there are "
-                     "messages provided in arguments with -m.")
-        return messages  # return empty list because mesgs in -m
-    stdin_ready = select.select([sys.stdin, ], [], [], 0.0)[0]
-    if not stdin_ready:
-        logger.debug("stdin is not ready. "
-                     "A pipe could be used, but pipe could be empty, "
-                     "stdin could also be a keyboard.")
-    else:
-        logger.debug("stdin is ready. Something "
-                     "is definitely piped into program from stdin."
-                     "Reading message from stdin pipe.")
-    if ((not stdin_ready) and (sys.stdin.isatty())):
-        # because sys.stdin.isatty() is true
-        logger.debug("No pipe was used, so read input from keyboard. "
-                     "Reading message from keyboard")
-        try:
-            message = input("Enter message to send: ")
-            logger.debug("Using data from stdin keyboard as message.")
-            messages.append(message)
-        except EOFError:  # EOF when reading a line
-            logger.debug("Reading from stdin resulted in EOF. "
-                         "Reading from keyboard failed. "
-                         "No message will be generated.")
-    return messages
+    return (name.startswith(".") or name.endswith("~") or
+            name.endswith(".tmp") or name.endswith(".part"))
 
 
-async def send_messages_and_files(client, rooms, messages):
-    """Send text messages and files.
+def inotify_open(directory):
+    """Start watching a directory with inotify.
+
+    Arguments:
+    ---------
+    directory : str
+        path of directory to watch
+
+    Returns the inotify file descriptor, or None if inotify is not
+    available (e.g. not Linux) in which case the caller has to poll.
+
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory),
+                                    IN_CLOSE_WRITE | IN_MOVED_TO)
+        if wd < 0:
+            os.close(fd)
+            return None
+        return fd
+    except (AttributeError, OSError, TypeError):
+        return None
+
 
-    First images, audio, etc, then text messaged.
+def inotify_read(fd) -> (list, bool):
+    """Read all pending inotify events.
 
     Arguments:
     ---------
-    client : Client
-    rooms : list of room_ids
-    messages : list of messages to send
+    fd : int
+        inotify file descriptor as returned by inotify_open()
+
+    Returns a list of file names and a flag that is True if the kernel
+    event queue overflowed, i.e. if events were lost.
 
     """
-    if pargs.image:
-        for image in pargs.image:
-            await send_image(client, rooms, image)
+    names = []
+    overflow = False
+    while True:
+        try:
+            buf = os.read(fd, 64 * 1024)
+        except BlockingIOError:
+            break
+        pos = 0
+        while pos + 16 <= len(buf):
+            _, mask, _, length = struct.unpack_from("iIII", buf, pos)
+            name = buf[pos + 16:pos + 16 + length].rstrip(b"\0")
+            pos += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            elif name:
+                names.append(os.fsdecode(name))
+    return names, overflow
+
+
+async def watch_directory(client, rooms, directory, store_dir) -> None:
+    """Send files as they appear in a directory, runs forever.
+
+    New files are detected with inotify (events close-after-write and
+    moved-into-directory). If inotify is not available the directory
+    is scanned periodically. A new file is only sent once its size and
+    modification time have not changed for WATCH_SETTLE_TIME seconds,
+    so partially written files are not sent. Images are sent via
+    send_image(), all other files via send_file(). Up to
+    WATCH_CONCURRENCY files are sent in parallel.
+
+    Name, size and modification time of every sent file are recorded
+    in an index in the store directory. On restart, files found in the
+    index with unchanged size and modification time are skipped without
+    reading their content. Files that no longer exist are dropped from
+    the index when it is written. A file that could not be sent is
+    retried after WATCH_RETRY_BACKOFF seconds, doubled with every
+    failure, or as soon as it changes.
 
-    if pargs.audio:
-        for audio in pargs.audio:
-            # audio file can be sent like other files
-            await send_file(client, rooms, audio)
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s
+    directory : str
+        directory to watch, from --watch argument
+    store_dir : str
+        location of persistent storage store directory
 
-    if pargs.file:
-        for file in pargs.file:
-            await send_file(client, rooms, file)
+    """
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+        logger.error(f"Directory \"{directory}\" given with --watch does "
+                     "not exist or is not a directory.")
+        return
+    index = read_watch_index(store_dir, directory)
+    pending = {}  # file name -> ((size, mtime_ns), time of last change)
+    semaphore = asyncio.Semaphore(WATCH_CONCURRENCY)
+    in_flight = set()  # file names currently being sent
+    # file name -> ((size, mtime_ns), time of next try, failures)
+    failed = {}
+    loop = asyncio.get_event_loop()
+
+    def add_candidate(name):
+        if watch_skip_name(name) or name in in_flight:
+            return
+        if name not in pending:
+            pending[name] = (None, loop.time())
+
+    def scan():
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            logger.debug(traceback.format_exc())
+            return
+        for name in names:
+            add_candidate(name)
+
+    def on_inotify():
+        names, overflow = inotify_read(fd)
+        if overflow:
+            logger.debug("inotify queue overflowed. Rescanning directory.")
+            scan()
+        for name in names:
+            add_candidate(name)
+
+    async def send(name, size_mtime):
+        path = os.path.join(directory, name)
+        async with semaphore:
+            if re.match("^.jpg$|^.jpeg$|^.gif$|^.png$|^.svg$",
+                        os.path.splitext(name)[1].lower()):
+                sent = await send_image(client, rooms, path)
+            else:
+                sent = await send_file(client, rooms, path)
+        in_flight.discard(name)
+        if sent:
+            logger.debug("File \"%s\" from watched directory was sent.",
+                         path)
+            failed.pop(name, None)
+            index[name] = list(size_mtime)
+            save_index()
+            return
+        failures = 1
+        if name in failed and failed[name][0] == size_mtime:
+            failures += failed[name][2]
+        delay = min(WATCH_RETRY_BACKOFF * 2 ** (failures - 1),
+                    WATCH_RETRY_BACKOFF_MAX)
+        failed[name] = (size_mtime, loop.time() + delay, failures)
+        logger.info("File \"%s\" from watched directory could not be "
+                    "sent. It will be retried in %.0f seconds, or when it "
+                    "changes.", path, delay)
+
+    def save_index():
+        # forget files that were deleted meanwhile
+        try:
+            names = set(os.listdir(directory))
+        except OSError:
+            names = None
+        if names is not None:
+            for name in list(index):
+                if name not in names:
+                    del index[name]
+        write_watch_index(store_dir, directory, index)
+
+    fd = inotify_open(directory)
+    if fd is not None:
+        loop.add_reader(fd, on_inotify)
+        logger.debug("Watching directory \"%s\" with inotify.", directory)
+    else:
+        logger.debug("inotify is not available. Directory \"%s\" "
+                     "will be scanned every %s seconds.",
+                     directory, WATCH_SCAN_INTERVAL)
+    scan()  # files that arrived while we were not running
+    last_scan = loop.time()
+    tasks = set()
+    try:
+        while True:
+            await asyncio.sleep(WATCH_POLL_INTERVAL)
+            now = loop.time()
+            if fd is None and now - last_scan >= WATCH_SCAN_INTERVAL:
+                scan()
+                last_scan = now
+            for name, (_, retry, _) in list(failed.items()):
+                if now >= retry:
+                    add_candidate(name)
+            for name, (last, changed) in list(pending.items()):
+                try:
+                    st = os.stat(os.path.join(directory, name))
+                except FileNotFoundError:
+                    del pending[name]  # deleted or renamed meanwhile
+                    failed.pop(name, None)
+                    continue
+                if not stat.S_ISREG(st.st_mode):
+                    del pending[name]
+                    continue
+                size_mtime = (st.st_size, st.st_mtime_ns)
+                if index.get(name) == list(size_mtime):
+                    del pending[name]  # already sent
+                    continue
+                if (name in failed and failed[name][0] == size_mtime and
+                        now < failed[name][1]):
+                    del pending[name]  # retried later, see failed
+                    continue
+                if size_mtime != last:
+                    pending[name] = (size_mtime, now)  # still being written
+                    continue
+                if now - changed < WATCH_SETTLE_TIME:
+                    continue
+                del pending[name]
+                in_flight.add(name)
+                task = asyncio.ensure_future(send(name, size_mtime))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+    finally:
+        if fd is not None:
+            loop.remove_reader(fd)
+            os.close(fd)
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def webhook_payload_to_jobs(payload) -> list:
+    """Map the JSON payload of a --webhook request onto message jobs.
+
+    The following payloads are understood:
+    a) generic: {"message": "some text", "format": "markdown",
+       "notice": true, "room": ["!SomeRoomId:example.org"]}.
+       Instead of "message" the keys "body" or "text" can be used.
+       Instead of a message the keys "template" and "vars" can give
+       the name of a template in TEMPLATE_DIR and the JSON object of
+       its variables, see --template and payload_template_file().
+       "format" is one of "text", "html", "markdown" or "code".
+       "format", "notice" and "room" are optional, the values
+       from the command line are used if they are missing.
+    b) a list of generic payloads
+    c) Alertmanager: {"alerts": [{"status": ..., "labels": {...},
+       "annotations": {"summary": ..., "description": ...}}, ...]}
+    d) Grafana: {"title": ..., "message": ...}
 
-    for message in messages:
-        await send_message(client, rooms, message)
+    Arguments:
+    ---------
+    payload : object
+        decoded JSON of request body
 
+    Every generic payload can also have the key "priority", "high" or
+    "bulk", see SendQueue, and the key "id", a string that identifies
+    the job, see --job-id. A job with the same "id" is sent only once
+    to a room, also if it is sent again later. The key "status_key"
+    sends the message as edit of the last message with the same key,
+    see --status-key.
 
-async def process_arguments_and_input(client, rooms):
-    """Process arguments and all input.
+    Returns a list of dictionaries with the keys "message", "format",
+    "notice", "rooms", "priority", "status_key", "template" and "id".
+    Raises ValueError if the payload is invalid.
 
-    Process all input: text messages, etc.
-    Prepare a list of messages from all sources and then send them.
+    """
+    if isinstance(payload, list):
+        jobs = []
+        for p in payload:
+            jobs += webhook_payload_to_jobs(p)
+        return jobs
+    if not isinstance(payload, dict):
+        raise ValueError("Payload must be a JSON object or a list of them.")
+    if isinstance(payload.get("alerts"), list):  # Alertmanager
+        lines = []
+        for alert in payload["alerts"]:
+            if not isinstance(alert, dict):
+                continue
+            annotations = alert.get("annotations") or {}
+            labels = alert.get("labels") or {}
+            if not (isinstance(annotations, dict) and
+                    isinstance(labels, dict)):
+                raise ValueError("\"annotations\" and \"labels\" of an "
+                                 "alert must be JSON objects.")
+            summary = (annotations.get("summary") or
+                       labels.get("alertname") or "alert")
+            line = f"[{alert.get('status', 'firing')}] {summary}"
+            if annotations.get("description"):
+                line += f": {annotations['description']}"
+            lines.append(line)
+        message = "\n".join(lines)
+    elif "vars" in payload:
+        if not isinstance(payload["vars"], dict):
+            raise ValueError("\"vars\" must be a JSON object.")
+        # the message of a template is the JSON object of its variables
+        message = json.dumps(payload["vars"])
+    else:
+        message = (payload.get("message") or payload.get("body") or
+                   payload.get("text") or "")
+        if payload.get("title"):  # Grafana
+            message = f"{payload['title']}\n{message}"
+    if not isinstance(message, str) or message.strip() == "":
+        raise ValueError("Payload contains no message.")
+    msg_format = payload.get("format")
+    if msg_format is not None and msg_format not in CONFIG_FORMATS:
+        raise ValueError(f"\"format\" must be one of "
+                         f"{list(CONFIG_FORMATS)}.")
+    rooms = payload.get("room")
+    if isinstance(rooms, str):
+        rooms = [rooms]
+    if rooms is not None and not (
+            isinstance(rooms, list) and
+            all(isinstance(r, str) for r in rooms)):
+        raise ValueError("\"room\" must be a string or a list of strings.")
+    priority = payload.get("priority")
+    if priority is not None and priority not in PRIORITIES:
+        raise ValueError(f"\"priority\" must be one of {list(PRIORITIES)}.")
+    job_id = payload.get("id")
+    if job_id is not None and not isinstance(job_id, str):
+        raise ValueError("\"id\" must be a string.")
+    status_key = payload.get("status_key")
+    if status_key is not None and not isinstance(status_key, str):
+        raise ValueError("\"status_key\" must be a string.")
+    template = payload.get("template")
+    if template is not None:
+        if not isinstance(template, str):
+            raise ValueError("\"template\" must be a string.")
+        template = payload_template_file(template)
+    notice = payload.get("notice")
+    return [{"message": message,
+             "format": msg_format,
+             "notice": None if notice is None else bool(notice),
+             "rooms": rooms,
+             "priority": priority,
+             "status_key": status_key,
+             "template": template,
+             "id": job_id}]
+
+
+async def serve_webhook(client, rooms, listen, store_dir) -> None:
+    """Receive messages via HTTP and send them, runs forever.
+
+    A small HTTP server accepts POST requests with a JSON payload,
+    see webhook_payload_to_jobs(). The resulting messages are put into
+    a bounded SendQueue and answered with 202 right away. The workers
+    of the queue send the messages with the already synced client,
+    high priority messages first. If the queue is full the request is
+    rejected with 503 and a
+    Retry-After header, so an overload never grows memory without bound.
 
     Arguments:
     ---------
     client : Client
-    rooms : list of room_ids
+    rooms : list
+        list of room_id-s, used for messages without rooms
+    listen : str
+        "[HOST:]PORT" to listen on, from --webhook argument
+    store_dir : str
+        location of persistent storage store directory
 
     """
-    messages_from_pipe = get_messages_from_pipe()
-    messages_from_keyboard = get_messages_from_keyboard()
-    if not pargs.message:
-        messages_from_commandline = []
-    else:
-        messages_from_commandline = pargs.message
+    host, _, port = listen.rpartition(":")
+    host = host.strip("[]") or "127.0.0.1"
+
+    async def send(job):
+        return await send_job(client, rooms, job, store_dir)
+
+    send_queue = SendQueue(send, maxsize=pargs.webhook_queue_size)
+    metrics.queue_depth.function = send_queue.qsize
+
+    def authorized(request):
+        # constant-time comparison, so the token cannot be guessed
+        # byte by byte from response times
+        token = pargs.webhook_token.encode()
+        header = request.headers.get("Authorization", "").encode()
+        query = request.query.get("token", "").encode()
+        return (hmac.compare_digest(header, b"Bearer " + token) |
+                hmac.compare_digest(query, token))
+
+    async def handle(request):
+        if pargs.webhook_token and not authorized(request):
+            return web.json_response({"error": "unauthorized"}, status=401)
+        try:
+            jobs = webhook_payload_to_jobs(await request.json())
+        except ValueError as e:  # includes JSONDecodeError
+            return web.json_response({"error": str(e)}, status=400)
+        if send_queue.free() < len(jobs):
+            logger.info("Webhook queue is full. Request is rejected.")
+            return web.json_response(
+                {"error": "queue full"}, status=503,
+                headers={"Retry-After": "1"})
+        for job in jobs:
+            send_queue.put(job)
+        return web.json_response({"queued": len(jobs)}, status=202)
+
+    app = web.Application(client_max_size=WEBHOOK_MAX_BODY_SIZE)
+    app.router.add_post("/", handle)
+    app.router.add_post("/send", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, int(port))
+    await site.start()
+    logger.info(f"Listening for webhook requests on http://{host}:{port}/")
+    try:
+        await send_queue.run()
+    finally:
+        await runner.cleanup()
 
-    logger.debug(f"Messages from pipe:         {messages_from_pipe}")
-    logger.debug(f"Messages from keyboard:     {messages_from_keyboard}")
-    logger.debug(f"Messages from command-line: {messages_from_commandline}")
 
-    messages_all = messages_from_commandline + \
-        messages_from_pipe + messages_from_keyboard  # keyboard at end
+async def run_scheduler(client, rooms, store_dir) -> None:
+    """Send the jobs scheduled with --at and --in when due, runs forever.
 
-    # loop thru all msgs and split them
-    if pargs.split:
-        # pargs.split can have escape characters, it has to be de-escaped
-        decoded_string = bytes(pargs.split, "utf-8").decode("unicode_escape")
-        logger.debug(f"String used for splitting is: \"{decoded_string}\"")
-        messages_all_split = []
-        for m in messages_all:
-            messages_all_split += m.split(decoded_string)
-    else:  # not pargs.split
-        messages_all_split = messages_all
+    Due jobs are put into a SendQueue, so they are sent by their
+    priority. A job is removed from the schedule once it was sent, or
+    once sending failed. If the program stops before, the job is sent
+    again on the next start. Jobs that became due while no scheduler
+    was running are sent right away, late.
+
+    Arguments:
+    ---------
+    client : Client
+    rooms : list
+        list of room_id-s, used for jobs without rooms
+    store_dir : str
+        location of persistent storage store directory
 
-    await send_messages_and_files(client, rooms, messages_all_split)
+    """
+    schedule = Schedule(store_dir)
+    in_flight = set()
+
+    async def send(job):
+        job_id = job.pop("schedule_id")
+        try:
+            return await send_job(client, rooms, job, store_dir)
+        finally:
+            schedule.remove(job_id)
+            in_flight.discard(job_id)
+
+    send_queue = SendQueue(send)
+    sender = asyncio.ensure_future(send_queue.run())
+    logger.info(f"Scheduler started with {schedule.count()} pending job(s).")
+    try:
+        while True:
+            now = time.time()
+            for job_id, due, job in schedule.due(
+                    now, len(in_flight) + SCHEDULE_FETCH_LIMIT):
+                if job_id in in_flight:
+                    continue
+                if now - due > SCHEDULE_POLL_INTERVAL:
+                    logger.info(f"Job {job_id} is sent {now - due:.0f} "
+                                "seconds late.")
+                in_flight.add(job_id)
+                job["schedule_id"] = job_id
+                send_queue.put(job)
+            next_due = schedule.next_due(now)
+            delay = SCHEDULE_POLL_INTERVAL
+            if next_due is not None:
+                delay = min(max(next_due - time.time(), 0), delay)
+            await asyncio.sleep(delay)
+    finally:
+        sender.cancel()
+        await asyncio.gather(sender, return_exceptions=True)
+        schedule.close()
 
 
 async def create_credentials_file(credentials_file: str,
@@ -1274,13 +6029,17 @@ async def create_credentials_file(credentials_file: str,
 
 def login_using_credentials_file(
         credentials_file: str,
-        store_dir: str) -> (AsyncClient, dict):
+        store_dir: str,
+        credentials: dict = None) -> (AsyncClient, dict):
     """Log in by using available credentials file.
 
     Arguments:
     ---------
         credentials_file: str : location of credentials file
         store_dir: str : location of persistent storage store directory
+        credentials: dict : credentials if they were already read from
+            the credentials file, e.g. by
+            determine_credentials_and_store()
 
     Returns
     -------
@@ -1288,86 +6047,163 @@ def login_using_credentials_file(
         dict : the credentials dictionary from the credentials file
 
     """
-    credentials = read_credentials_from_disk(credentials_file)
-
-    # Configuration options for the AsyncClient
-    client_config = AsyncClientConfig(
-        max_limit_exceeded=0,
-        max_timeouts=0,
-        store_sync_tokens=True,
-        encryption_enabled=True,
-    )
-    # Initialize the matrix client based on credentials from file
-    client = AsyncClient(
-        credentials['homeserver'],
-        credentials['user_id'],
-        device_id=credentials['device_id'],
-        store_path=store_dir,
-        config=client_config,
-    )
-    client.restore_login(
-        user_id=credentials['user_id'],
-        device_id=credentials['device_id'],
-        access_token=credentials['access_token']
-    )
+    global store_lock
+    if credentials is None:
+        with timings.phase("read credentials"):
+            credentials = read_credentials_from_disk(credentials_file)
+
+    with timings.phase("open store"):
+        store_lock = StoreLock(store_dir)
+        # Configuration options for the AsyncClient
+        client_config = AsyncClientConfig(
+            max_limit_exceeded=0,
+            max_timeouts=0,
+            store_sync_tokens=True,
+            encryption_enabled=True,
+        )
+        # Initialize the matrix client based on credentials from file
+        client = AsyncClient(
+            credentials['homeserver'],
+            credentials['user_id'],
+            device_id=credentials['device_id'],
+            store_path=store_dir,
+            config=client_config,
+        )
+        # this loads the store
+        client.restore_login(
+            user_id=credentials['user_id'],
+            device_id=credentials['device_id'],
+            access_token=credentials['access_token']
+        )
+        lock_store(client)
     # room_id = credentials['room_id']
     logger.debug("Logged in using stored credentials from "
-                 f"credentials file \"{credentials_file}\".")
+                 "credentials file \"%s\".", credentials_file)
     return (client, credentials)
 
 
 async def main_verify() -> None:
     """Use credentials to log in and verify."""
-    credentials_file = determine_credentials_file()
-    store_dir = determine_store_dir()
-    if not os.path.isfile(credentials_file):
+    with timings.phase("find credentials and store"):
+        credentials_file, store_dir, credentials = \
+            determine_credentials_and_store()
+    if credentials is None:
         logger.debug("Credentials file must be created first before one "
                      "can verify.")
         sys.exit(1)
     logger.debug("Credentials file does exist.")
     client, credentials = login_using_credentials_file(credentials_file,
-                                                       store_dir)
+                                                       store_dir, credentials)
+    metrics.instrument_client(client)
     # Set up event callbacks
     callbacks = Callbacks(client)
     client.add_to_device_callback(
         callbacks.to_device_callback, (KeyVerificationEvent,))
     # Sync encryption keys with the server
     # Required for participating in encrypted rooms
-    if client.should_upload_keys:
-        await client.keys_upload()
+    async with store_lock.exclusive():
+        if client.should_upload_keys:
+            with timings.phase("keys_upload"):
+                await client.keys_upload()
     print("This program is ready and waiting for the other party to initiate "
           "an emoji verification with us by selecting \"Verify by Emoji\" "
           "in their Matrix client.")
     # the sync_loop will be terminated by user hitting Control-C to stop
-    await client.sync_forever(timeout=30000, full_state=True)
+    # only to-device events are needed, so all rooms are filtered out
+    # and the sync resumes from the sync token stored in the store
+    tasks = [client.sync_forever(timeout=30000,
+                                 sync_filter=VERIFY_SYNC_FILTER)]
+    if pargs.metrics or pargs.metrics_textfile:
+        tasks.append(metrics.serve())
+    await asyncio.gather(*tasks)
 
 
 async def main_send() -> None:
     """Create credentials, or use credentials to log in and send messages."""
-    credentials_file = determine_credentials_file()
-    store_dir = determine_store_dir()
-    if not os.path.isfile(credentials_file):
+    global dedup_filter, status_events
+    with timings.phase("find credentials and store"):
+        credentials_file, store_dir, credentials = \
+            determine_credentials_and_store()
+    if credentials is None:
         logger.debug("Credentials file does not exist.")
         await create_credentials_file(credentials_file, store_dir)
+    elif pargs.schedule_at or pargs.schedule_in:
+        # no need to log in, the jobs are sent by --scheduler
+        await schedule_jobs(store_dir)
     else:
         logger.debug("Credentials file does exist.")
-        client, credentials = login_using_credentials_file(credentials_file,
-                                                           store_dir)
+        stdin_reader = None
+        if not (pargs.watch or pargs.webhook or pargs.scheduler):
+            # read the input while logging in and syncing
+            stdin_reader = open_stdin_reader()
+        client, credentials = login_using_credentials_file(
+            credentials_file, store_dir, credentials)
+        metrics.instrument_client(client)
         # a few more steps to prepare for sending messages
-        rooms = determine_rooms(credentials['room_id'])
-        logger.debug(f"Rooms are: {rooms}")
+        with timings.phase("resolve rooms"):
+            rooms = await determine_rooms(client, credentials['room_id'],
+                                          store_dir)
+        logger.debug("Rooms are: %s", LogTruncated(rooms))
+        if pargs.shard_credentials:
+            # the devices of the shards do the sending, this device
+            # was only needed to resolve the rooms
+            messages = await read_all_messages(stdin_reader)
+            with timings.phase("close"):
+                await client.close()
+            await send_sharded(rooms, messages, store_dir)
+            return
+        if pargs.dedup:
+            dedup_filter = DedupFilter(store_dir, pargs.dedup,
+                                       pargs.dedup_mode)
+        if (pargs.status_key or pargs.batch or pargs.webhook or
+                pargs.scheduler):
+            # jobs of --batch, --webhook and --scheduler can have a
+            # status key
+            status_events = StatusEvents(store_dir)
+        setup_crypto_executor()
+        setup_concurrency()
         # Sync encryption keys with the server
         # Required for participating in encrypted rooms
-        if client.should_upload_keys:
-            await client.keys_upload()
+        # another process using the store may have uploaded them already
+        async with store_lock.exclusive():
+            if client.should_upload_keys:
+                with timings.phase("keys_upload"):
+                    await client.keys_upload()
         # must sync first to get room ids for encrypted rooms
         # since we only send a msg and then stop we can use sync() instead of
         # sync_forever() (await client.sync_forever(30000, full_state=True))
-        await client.sync(timeout=30000, full_state=True)
+        with timings.phase("sync"):
+            await client.sync(timeout=30000, full_state=True)
+        if pargs.watch or pargs.webhook or pargs.scheduler:
+            # long running modes, they run until the user hits Control-C
+            # keep syncing in the background so that room members and
+            # their devices stay up-to-date for encryption
+            tasks = [client.sync_forever(timeout=30000)]
+            if pargs.watch:
+                tasks.append(watch_directory(client, rooms, pargs.watch,
+                                             store_dir))
+            if pargs.webhook:
+                tasks.append(serve_webhook(client, rooms, pargs.webhook,
+                                           store_dir))
+            if pargs.scheduler:
+                tasks.append(run_scheduler(client, rooms, store_dir))
+            if pargs.metrics or pargs.metrics_textfile:
+                tasks.append(metrics.serve())
+            try:
+                await asyncio.gather(*tasks)
+            finally:
+                if dedup_filter:
+                    dedup_filter.close()
+                await client.close()
+            return
         # Now we can send messages as the user
-        await process_arguments_and_input(client, rooms)
+        await process_arguments_and_input(client, rooms, store_dir,
+                                          stdin_reader)
+        if dedup_filter:
+            dedup_filter.close()
         logger.debug("Messages were sent. We close the client and quit")
-        await client.close()
+        with timings.phase("close"):
+            await client.close()
 
 
 if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
@@ -1395,7 +6231,16 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
         "full documentation in the source code.")
     # Add the arguments to the parser
     ap.add_argument("-d", "--debug", required=False,
-                    action="store_true", help="Print debug information")
+                    action="store_true", help="Print debug information. "
+                    "Messages are truncated to "
+                    f"{LOG_TRUNCATE_LENGTH} characters in the debug output.")
+    ap.add_argument("--log-format", required=False, type=str,
+                    default="text", choices=["text", "json"],
+                    help="Format of log output on stderr. \"text\" is "
+                    "human readable. \"json\" writes one JSON object "
+                    "per line with the keys \"ts\", \"level\", "
+                    "\"logger\" and \"msg\", which is easy to process "
+                    "by log collectors. Default is \"text\".")
     # -c is already used for --code, -t as abbreviation for "trust"
     ap.add_argument("-t", "--credentials", required=False, type=str,
                     default=CREDENTIALS_FILE_DEFAULT,
@@ -1420,7 +6265,12 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                     "instead of the one from the credentials file. "
                     "The user must have access to the specified room "
                     "in order to send messages there. Messages cannot "
-                    "be sent to arbitrary rooms. When specifying the "
+                    "be sent to arbitrary rooms. Rooms can be specified "
+                    "by room id (e.g. \"!SomeRoomId:example.org\") or "
+                    "by room alias (e.g. \"#someroomalias:example.org\"). "
+                    "Resolved room aliases are cached in the store "
+                    "directory for a day, so that repeated runs do not "
+                    "have to ask the server again. When specifying the "
                     "room id some shells require the exclamation mark "
                     "to be escaped with a blackslash.")
     # allow multiple messages , e.g. -m "m1" "m2" or -m "m1" -m "m2"
@@ -1465,7 +6315,31 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                     help="Send this file (e.g. PDF, DOC, MP4). "
                     "This option can be used multiple time to send "
                     "multiple files. First files are send, "
-                    "then text messages are send.")
+                    "then text messages are send. A directory, or a "
+                    "glob pattern like 'logs/**/*.log' (quoted, so the "
+                    "shell does not expand it), is sent as one archive, "
+                    "see --archive-format. If a file changes while it "
+                    "is archived, the archive is not sent.")
+    ap.add_argument("--archive-format", required=False, type=str,
+                    default=ARCHIVE_FORMATS[0],
+                    choices=list(ARCHIVE_FORMATS),
+                    help="Format of the archive that a directory or glob "
+                    "pattern given with --file is sent as. \"tar.gz\" "
+                    "is compressed. Since the size of an upload must be "
+                    "known before it starts, the files are read twice "
+                    "for \"tar.gz\", once to compute the size of the "
+                    "compressed archive, see --archive-temp-file. "
+                    "\"tar\" is not compressed and reads the files "
+                    "once. Neither needs a temporary file. Default is "
+                    f"\"{ARCHIVE_FORMATS[0]}\".")
+    ap.add_argument("--archive-temp-file", required=False,
+                    action="store_true",
+                    help="Compress a \"tar.gz\" archive, see "
+                    "--archive-format, into a temporary file before it "
+                    "is uploaded, instead of compressing it twice. The "
+                    "files are then read once, but the whole compressed "
+                    "archive is written to disk, into $TMPDIR. Without "
+                    "this option no temporary file is used.")
     # -h already used for --help, -w for "web"
     ap.add_argument("-w", "--html", required=False,
                     action="store_true", help="Send message as format "
@@ -1487,6 +6361,17 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                     "useful for sending ASCII-art or tabbed output "
                     "like tables as a fixed-sized font will be used "
                     "for display.")
+    ap.add_argument("--language", required=False, type=str,
+                    metavar="LANGUAGE",
+                    help="Language of the code sent with --code, e.g. "
+                    "\"python\", \"json\" or \"bash\". The code is marked "
+                    "with the class \"language-LANGUAGE\" so that clients "
+                    "can highlight it. If the Python package pygments is "
+                    "installed, the code is also highlighted by this "
+                    "program, with colors that all clients show. Code "
+                    "larger than 48 KiB is not highlighted, so that it "
+                    "fits into one event. By default, the language of "
+                    "the code is not given.")
     # -s is already used for --store, -i for sPlit
     ap.add_argument("-p", "--split", required=False, type=str,
                     help="If set, split the message(s) into multiple messages "
@@ -1497,15 +6382,82 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                     "Then with --split set to \"\\n\\n\\n\" each article "
                     "will be printed in a separate message. "
                     "By default, i.e. if not set, no messages will be split.")
+    ap.add_argument("--template", required=False, type=str,
+                    metavar="NAME",
+                    help="Render the messages from this template. Each "
+                    "message, e.g. from --message or the pipe, is then a "
+                    "JSON object with the values of the variables of the "
+                    "template, e.g. {\"host\": \"db1\", \"load\": 3.5}. "
+                    "Use --split \"\\n\" to send one message per line of "
+                    "JSON. The template uses the syntax of Python's "
+                    "str.format(), e.g. \"**{host}** has load "
+                    "{load:.1f}\". NAME is the path of the template file "
+                    "or the name of a file in the template directory "
+                    f"\"~/.config/{PROG_WITHOUT_EXT}/templates\". With "
+                    "--batch and --webhook the "
+                    "jobs can give \"template\", the name of a file in "
+                    "the template directory, and \"vars\" instead of a "
+                    "message. Templates are compiled once, markdown "
+                    "templates are converted to HTML once, and kept in "
+                    f"compiled form in \"~/.cache/{PROG_WITHOUT_EXT}\" "
+                    "until the template "
+                    "file changes. Values of variables are inserted as "
+                    "text, i.e. markdown or HTML in values is escaped, not "
+                    "interpreted. Variables inside HTML tags are refused "
+                    "for markdown and HTML. By default, no template is "
+                    "used.")
+    ap.add_argument("--attach-threshold", required=False, type=int,
+                    metavar="BYTES",
+                    default=MESSAGE_ATTACH_THRESHOLD_DEFAULT,
+                    help="Messages larger than this many bytes, e.g. "
+                    "megabytes of log output piped into the program, are "
+                    "not sent as text event. They are compressed with "
+                    "gzip and sent as file. Before the file a short "
+                    "preview is sent with the first and the last "
+                    f"{MESSAGE_PREVIEW_LINES} lines of the message. "
+                    "0 sends every message as text event. Default is "
+                    f"{MESSAGE_ATTACH_THRESHOLD_DEFAULT}.")
     # -c is already used for --code, -k as it sounds like c
     ap.add_argument("-k", "--config", required=False, type=str,
                     help="Location of a config file. By default, no "
                     "config file is used. "
                     "If this option is provided, the provided file name "
-                    "will be used to read configuration from. ")
+                    "will be used to read configuration from. "
+                    "The config file can be written in YAML (.yaml, .yml), "
+                    "TOML (.toml) or JSON (.json). It defines named "
+                    "profiles under the key \"profiles\". Each profile "
+                    "can set \"room\", \"message\", \"image\", "
+                    "\"audio\", \"file\", \"format\" (one of "
+                    f"{', '.join(CONFIG_FORMATS)}), \"notice\", "
+                    "\"split\", \"template\", \"credentials\" and "
+                    "\"store\". "
+                    "The key \"default_profile\" names the profile "
+                    "to use if --profile is not given. The parsed "
+                    "config file is cached in compiled form in "
+                    f"\"~/.cache/{PROG_WITHOUT_EXT}\" until the config "
+                    "file changes.")
+    ap.add_argument("--profile", required=False, type=str,
+                    help="Name of the profile of the config file to use. "
+                    "The profile provides default values for rooms, "
+                    "format, notice, split string and attachments. "
+                    "Arguments given on the command line take precedence. "
+                    "If --config is not given the config file "
+                    f"\"~/.config/{PROG_WITHOUT_EXT}/config.yaml\" is "
+                    "used.")
     ap.add_argument("-n", "--notice", required=False,
                     action="store_true", help="Send message as notice. "
                     "If not specified, message will be sent as text.")
+    ap.add_argument("--status-key", required=False, type=str,
+                    metavar="KEY",
+                    help="Send the message as status message. The first "
+                    "message with this key is sent to a room as usual, "
+                    "every later message with the same key is sent as "
+                    "edit of it. E.g. progress or heartbeat reports then "
+                    "update one message instead of filling the room "
+                    "history and notifying everyone every time. The event "
+                    "IDs are kept per key and room in the store. Messages "
+                    "sent as file, see --attach-threshold, are not "
+                    "edits. By default, messages are not status messages.")
     ap.add_argument("-e", "--encrypted", required=False,
                     action="store_true", help="Send message end-to-end "
                     "encrypted. Encryption is always turned on and "
@@ -1527,7 +6479,237 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                     "the default one. Preferably, for multiple executions "
                     "of this program use the same store for the same device. "
                     "The store directory can be shared between multiple "
-                    "different devices and users.")
+                    "different devices and users. Several instances of "
+                    "this program can use the same store at the same "
+                    "time, e.g. cron jobs. They coordinate via the file "
+                    f"\"{STORE_LOCK_FILE}\" in the store, so that only "
+                    "the steps that change the encryption state, i.e. "
+                    "uploading keys, processing a sync, and sharing keys "
+                    "with and encrypting for an encrypted room, run one "
+                    "at a time.")
+    ap.add_argument("--priority", required=False, type=str,
+                    default="bulk", choices=list(PRIORITIES),
+                    help="Priority of the messages and files given on the "
+                    "command line, and of the jobs of --batch and "
+                    "--webhook that do not specify a \"priority\". "
+                    "High priority jobs are sent before queued bulk "
+                    "jobs and up to "
+                    f"{PRIORITY_HIGH_CONCURRENCY} of them in parallel, so "
+                    "a critical message is not delayed by a burst of "
+                    "bulk messages. Bulk jobs are sent one after the "
+                    "other in their original order. Default is "
+                    "\"bulk\".")
+    ap.add_argument("--batch", required=False,
+                    action="store_true", help="Read jobs from stdin, one "
+                    "JSON object per line, in the same format as the "
+                    "requests of --webhook, e.g. {\"message\": \"daily "
+                    "digest\", \"format\": \"markdown\", \"priority\": "
+                    "\"bulk\", \"room\": [\"#digest:example.org\"]}. "
+                    "The jobs are sent together with the messages and "
+                    "files given on the command line, in the order of "
+                    "their priority (see --priority). Invalid lines are "
+                    "skipped.")
+    ap.add_argument("--at", required=False, type=str, dest="schedule_at",
+                    metavar="TIME",
+                    help="Do not send now, but schedule the messages and "
+                    "files to be sent at this time, e.g. "
+                    "\"2026-12-24 18:00\" or \"18:00\" (the next 18:00, "
+                    "today or tomorrow). Without a time zone, e.g. "
+                    "\"+01:00\", local time is used. The jobs are kept in "
+                    "the store directory and sent by this program "
+                    "running with --scheduler and the same store. So "
+                    "reminders do not need one login and sync each.")
+    ap.add_argument("--in", required=False, type=str, dest="schedule_in",
+                    metavar="DURATION",
+                    help="Like --at, but schedule the messages and files "
+                    "to be sent after this duration, e.g. \"90s\", "
+                    "\"15m\", \"2h\", \"1d\" or \"1h30m\".")
+    ap.add_argument("--scheduler", required=False,
+                    action="store_true", help="Run as resident scheduler: "
+                    "send the jobs scheduled with --at and --in when they "
+                    "are due. Jobs that became due while the scheduler "
+                    "was not running are sent right away. Jobs scheduled "
+                    "while the scheduler runs are picked up within "
+                    f"{SCHEDULE_POLL_INTERVAL} seconds. The program runs "
+                    "until Control-C is hit. This option cannot be "
+                    "combined with messages, images, audio or files. It "
+                    "can be combined with --watch and --webhook.")
+    ap.add_argument("--dedup", required=False, type=float,
+                    metavar="SECONDS",
+                    help="Suppress identical messages. A message that was "
+                    "already sent to the same room in the same format "
+                    "within the last SECONDS seconds is not sent again. "
+                    "This is useful for flapping monitors that send the "
+                    "same alert many times. Sent messages are remembered "
+                    "in the store directory, so this works across "
+                    "multiple runs of the program. By default, no "
+                    "messages are suppressed.")
+    ap.add_argument("--dedup-mode", required=False, type=str,
+                    default="drop", choices=["drop", "collapse"],
+                    help="What to do with messages suppressed by --dedup. "
+                    "\"drop\" drops them silently. \"collapse\" drops "
+                    "them as well, but the next identical message sent "
+                    "after the time window gets the suffix \"(repeated N "
+                    "times)\". Default is \"drop\".")
+    ap.add_argument("--watch", required=False, type=str,
+                    metavar="DIR",
+                    help="Watch this directory and send every new file "
+                    "that appears in it, e.g. reports dropped into a spool "
+                    "directory. Images are sent as images, all other "
+                    "files as files. A file is sent once it has not "
+                    f"changed for {WATCH_SETTLE_TIME} seconds, so that "
+                    "partially written files are not sent. Hidden files "
+                    "and files ending in \".tmp\", \".part\" or \"~\" "
+                    "are ignored. Sent files are recorded in the store "
+                    "directory, so after a restart only new or modified "
+                    "files are sent. The program runs until Control-C "
+                    "is hit. This option cannot be combined with "
+                    "messages, images, audio or files.")
+    ap.add_argument("--webhook", required=False, type=str,
+                    metavar="[HOST:]PORT",
+                    help="Listen for HTTP POST requests on this port and "
+                    "send the messages they contain, e.g. from "
+                    "Alertmanager or Grafana. By default, only "
+                    "connections from localhost (127.0.0.1) are "
+                    "accepted. The request body is JSON, e.g. "
+                    "{\"message\": \"disk full\", \"format\": "
+                    "\"markdown\", \"notice\": true, \"room\": "
+                    "[\"#alerts:example.org\"]}. \"format\", \"notice\", "
+                    "\"room\" and \"priority\" (see --priority) are "
+                    "optional. Alertmanager and Grafana "
+                    "payloads are understood as well. Requests are "
+                    "answered with 202 once queued, and with 503 if the "
+                    "queue is full. The program runs until Control-C "
+                    "is hit. This option cannot be combined with "
+                    "messages, images, audio or files.")
+    ap.add_argument("--webhook-queue-size", required=False, type=int,
+                    default=WEBHOOK_QUEUE_SIZE_DEFAULT,
+                    help="Number of messages received via --webhook that "
+                    "can wait to be sent. Further requests are rejected "
+                    "with 503 until the queue drains. Default is "
+                    f"{WEBHOOK_QUEUE_SIZE_DEFAULT}.")
+    ap.add_argument("--webhook-token", required=False, type=str,
+                    help="If set, --webhook only accepts requests that "
+                    "carry this token, either as header \"Authorization: "
+                    "Bearer TOKEN\" or as query parameter \"?token=TOKEN\".")
+    ap.add_argument("--shard-credentials", required=False,
+                    action="extend", nargs="+", type=str, metavar="FILE",
+                    help="Send to many rooms in parallel with multiple "
+                    "processes. This is useful for broadcasting to "
+                    "thousands of rooms, as encryption then runs on "
+                    "all cores. For each given credentials file one "
+                    "worker process is started. The rooms are split "
+                    "between the workers, each worker logs in as the "
+                    "device of its credentials file and sends to its "
+                    "rooms. Each worker uses its own store, a "
+                    "sub-directory of the store directory named after "
+                    "the credentials file, e.g. \"./store/shard1/\" "
+                    "for \"shard1.json\". Create the credentials files "
+                    "beforehand, e.g. by running this program once with "
+                    "\"--credentials shard1.json --store ./store/shard1\". "
+                    "The names of the credentials files must differ. "
+                    "Use about as many credentials files as there are "
+                    "CPU cores. The credentials file given with "
+                    "--credentials is only used to resolve the rooms. "
+                    "This option cannot be combined with --verify, "
+                    "--watch or --webhook.")
+    ap.add_argument("--crypto-executor", required=False, type=str,
+                    default="none", choices=["none", "thread"],
+                    help="Where to encrypt and serialize events. \"none\" "
+                    "does it in the event loop, as matrix-nio does. "
+                    "\"thread\" does the Megolm encryption of events, "
+                    "the Olm encryption of room keys for the devices of "
+                    "a room and the serialization of events to JSON in "
+                    "a separate thread, so that other uploads and sends "
+                    "are not stalled. This helps when sending to many "
+                    "encrypted rooms with many devices, e.g. with "
+                    "--watch or --webhook. Default is \"none\".")
+    ap.add_argument("--job-id", required=False, type=str,
+                    metavar="ID",
+                    help="Identify this run as one logical send job. "
+                    "The transaction IDs of the events are derived from "
+                    "this ID and the room, instead of being random. If "
+                    "the same command is run again with the same job ID, "
+                    "e.g. by a retrying cron job or spooler after a "
+                    "timeout, the homeserver does not send the events a "
+                    "second time. Transaction IDs are only remembered "
+                    "per device and for a limited time by the homeserver. "
+                    "For --batch and --webhook the JSON object of a job "
+                    "can have the key \"id\" instead. Jobs scheduled "
+                    "with --at and --in always get an ID.")
+    ap.add_argument("--send-retries", required=False, type=int,
+                    default=SEND_RETRIES_DEFAULT, metavar="N",
+                    help="How often an event is sent again if sending "
+                    "timed out, the connection failed, or the homeserver "
+                    "replied with M_LIMIT_EXCEEDED. All tries use the "
+                    "same transaction ID, so an event that arrived but "
+                    "whose response got lost is not sent twice. After a "
+                    "timeout the wait before the next try starts at "
+                    f"{SEND_RETRY_BACKOFF} seconds and doubles, after "
+                    "M_LIMIT_EXCEEDED the wait is what the homeserver "
+                    f"asks for. Default is {SEND_RETRIES_DEFAULT}. 0 "
+                    "disables retries.")
+    ap.add_argument("--send-timeout", required=False, type=float,
+                    metavar="SECONDS",
+                    help="Timeout of a single try to send an event, "
+                    "see --send-retries. A short timeout together with "
+                    "retries lowers the latency when a request gets "
+                    "stuck. Default is the request timeout of "
+                    "matrix-nio, 60 seconds.")
+    ap.add_argument("--concurrency", required=False, type=str,
+                    default="adaptive", metavar="LIMIT",
+                    help="How many events are sent in parallel, and how "
+                    "many files are uploaded in parallel, e.g. when "
+                    "sending to many rooms, with --batch, --watch or "
+                    "--webhook. \"adaptive\" starts with "
+                    f"{CONCURRENCY_INITIAL}, raises the limit while the "
+                    "server answers quickly, and halves it when the "
+                    "server answers with M_LIMIT_EXCEEDED, times out, or "
+                    "answers much slower than before. A number sets a "
+                    "fixed limit, 1 sends one event after the other. "
+                    "The limit chosen is shown by --timings. Default is "
+                    "\"adaptive\".")
+    ap.add_argument("--timings", required=False,
+                    action="store_true", help="At the end, print a table "
+                    "to stderr that shows how much time was spent in "
+                    "each phase of the program: startup (interpreter and "
+                    "imports), finding and reading credentials, opening "
+                    "the store, resolving rooms, uploading keys, syncing, "
+                    "reading input, uploading and sending.")
+    ap.add_argument("--timings-json", required=False, type=str,
+                    metavar="FILE",
+                    help="At the end, write the timings of all phases "
+                    "(see --timings) as JSON to this file.")
+    ap.add_argument("--profiler", required=False, type=str,
+                    choices=["cprofile", "pyinstrument"],
+                    help="Run the program under a profiler. \"cprofile\" "
+                    "uses the profiler of the Python standard library. "
+                    "\"pyinstrument\" requires the Python package "
+                    "pyinstrument to be installed. The result is printed "
+                    "to stderr, or written to the file given with "
+                    "--profiler-output.")
+    ap.add_argument("--profiler-output", required=False, type=str,
+                    metavar="FILE",
+                    help="Write the result of --profiler to this file "
+                    "instead of printing it. For \"cprofile\" a pstats "
+                    "file is written, for \"pyinstrument\" an HTML file.")
+    ap.add_argument("--metrics", required=False, type=str,
+                    metavar="[HOST:]PORT",
+                    help="Serve Prometheus metrics via HTTP on "
+                    "http://HOST:PORT/metrics while the program runs in "
+                    "a long running mode (--verify, --watch, --webhook, "
+                    "--scheduler). "
+                    "By default, HOST is 127.0.0.1. Metrics include sent "
+                    "events, send errors, send latency, rate limiting, "
+                    "uploaded bytes, upload latency, encryption time, "
+                    "syncs and queue depth.")
+    ap.add_argument("--metrics-textfile", required=False, type=str,
+                    metavar="FILE",
+                    help="Write Prometheus metrics (see --metrics) to this "
+                    f"file every {METRICS_TEXTFILE_INTERVAL} seconds in "
+                    "long running modes and once at the end of the "
+                    "program, e.g. for the textfile collector of the "
+                    "Prometheus node exporter.")
     ap.add_argument("-v", "--verify", required=False, type=str,
                     help="Perform verification. By default, no "
                     "verification is performed. "
@@ -1542,22 +6724,29 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                     "files when you verify. ")
 
     pargs = ap.parse_args()
+    if pargs.log_format == "json":
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(JsonLogFormatter())
     if pargs.debug:
         # set log level on root logger
         logging.getLogger().setLevel(logging.DEBUG)
         logging.getLogger().info("Debug is turned on.")
+    elif logging.getLogger().getEffectiveLevel() > logging.DEBUG:
+        # matrix-nio logs every room of every sync with level INFO,
+        # for accounts in many rooms that is costly and not useful
+        logging.getLogger("nio").setLevel(logging.WARNING)
     logger = logging.getLogger(PROG_WITHOUT_EXT)
 
     if not pargs.encrypted:
         pargs.encrypted = True  # force it on
         logger.debug("Encryption is always enabled. It cannot be turned off.")
 
-    if pargs.config:
-        logger.info("This feature is not implemented yet. "
-                    "Please help me implement it. If you feel motivated "
-                    "please write code and submit a Pull Request. "
-                    "Your contribution is appreciated. Thnx!")
-        sys.exit(1)
+    if pargs.config or pargs.profile:
+        try:
+            apply_config_profile(ap)
+        except (OSError, ValueError) as e:
+            logger.error(f"Config file could not be used. {e}")
+            sys.exit(1)
 
     # this is set by default anyway, just defensive programming
     if pargs.encrypted and ((not pargs.store) or (pargs.store == "")):
@@ -1580,6 +6769,108 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
                      "No messages, images, or files can be sent.")
         sys.exit(1)
 
+    if ((pargs.watch or pargs.webhook or pargs.scheduler) and
+            (pargs.message or pargs.image or pargs.audio or pargs.file or
+             pargs.verify)):
+        logger.error("If --watch, --webhook or --scheduler is specified, "
+                     "no messages, images, or files can be given and "
+                     "--verify cannot be used.")
+        sys.exit(1)
+
+    if (pargs.shard_credentials and
+            (pargs.verify or pargs.watch or pargs.webhook or
+             pargs.scheduler)):
+        logger.error("--shard-credentials cannot be used with --verify, "
+                     "--watch, --webhook or --scheduler.")
+        sys.exit(1)
+
+    if (pargs.batch and (pargs.verify or pargs.watch or pargs.webhook or
+                         pargs.scheduler or pargs.shard_credentials)):
+        logger.error("--batch cannot be used with --verify, --watch, "
+                     "--webhook, --scheduler or --shard-credentials.")
+        sys.exit(1)
+
+    if pargs.job_id is not None and (
+            pargs.verify or pargs.watch or pargs.webhook or
+            pargs.scheduler):
+        logger.error("--job-id cannot be used with --verify, --watch, "
+                     "--webhook or --scheduler.")
+        sys.exit(1)
+
+    if pargs.send_retries < 0 or (
+            pargs.send_timeout is not None and pargs.send_timeout <= 0):
+        logger.error("--send-retries must not be negative and "
+                     "--send-timeout must be positive.")
+        sys.exit(1)
+
+    if pargs.language is not None and not re.fullmatch(
+            r"[A-Za-z0-9_+#.-]+", pargs.language):
+        logger.error("--language must be a name like \"python\" or "
+                     "\"c++\".")
+        sys.exit(1)
+
+    if pargs.attach_threshold < 0:
+        logger.error("--attach-threshold must not be negative.")
+        sys.exit(1)
+
+    if pargs.webhook_queue_size < 1:
+        logger.error("--webhook-queue-size must be at least 1.")
+        sys.exit(1)
+
+    if pargs.concurrency != "adaptive" and not (
+            pargs.concurrency.isdigit() and int(pargs.concurrency) > 0):
+        logger.error("--concurrency must be \"adaptive\" or a positive "
+                     "number.")
+        sys.exit(1)
+
+    if pargs.schedule_at or pargs.schedule_in:
+        if (pargs.schedule_at and pargs.schedule_in) or (
+                pargs.verify or pargs.watch or pargs.webhook or
+                pargs.scheduler or pargs.shard_credentials):
+            logger.error("--at and --in cannot be used together, and "
+                         "cannot be used with --verify, --watch, --webhook, "
+                         "--scheduler or --shard-credentials.")
+            sys.exit(1)
+        try:
+            if pargs.schedule_at:
+                parse_time(pargs.schedule_at)
+            else:
+                parse_duration(pargs.schedule_in)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+
+    if pargs.shard_credentials:
+        for shard_credentials_file in pargs.shard_credentials:
+            if not os.path.isfile(shard_credentials_file):
+                logger.error("Credentials file \""
+                             f"{shard_credentials_file}\" given with "
+                             "--shard-credentials does not exist.")
+                sys.exit(1)
+        # the store of a shard is named after its credentials file
+        shard_names = [
+            os.path.splitext(os.path.basename(shard_credentials_file))[0]
+            for shard_credentials_file in pargs.shard_credentials]
+        if len(set(shard_names)) < len(shard_names):
+            logger.error("The credentials files given with "
+                         "--shard-credentials must have different names, "
+                         "each shard needs its own device and store.")
+            sys.exit(1)
+
+    profiler = None
+    if pargs.profiler == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif pargs.profiler == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            logger.error("For --profiler pyinstrument the Python package "
+                         "pyinstrument must be installed.")
+            sys.exit(1)
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+
     try:
         if pargs.verify:
             asyncio.get_event_loop().run_until_complete(main_verify())
@@ -1594,5 +6885,27 @@ if __name__ == "__main__":  # noqa # ignore mccabe if-too-complex
     except KeyboardInterrupt:
         logger.debug("Keyboard interrupt received.")
         sys.exit(1)
+    finally:
+        if pargs.profiler == "cprofile":
+            profiler.disable()
+            if pargs.profiler_output:
+                profiler.dump_stats(pargs.profiler_output)
+            else:
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats(
+                    "cumulative").print_stats(30)
+        elif pargs.profiler == "pyinstrument":
+            profiler.stop()
+            if pargs.profiler_output:
+                with open(pargs.profiler_output, "w") as f:
+                    f.write(profiler.output_html())
+            else:
+                print(profiler.output_text(), file=sys.stderr)
+        if pargs.metrics_textfile:
+            metrics.write_textfile(pargs.metrics_textfile)
+        if pargs.timings:
+            print(timings.report(), file=sys.stderr)
+        if pargs.timings_json:
+            with open(pargs.timings_json, "w") as f:
+                json.dump(timings.to_dict(), f, indent=2)
 
 # EOF